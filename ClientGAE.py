@@ -13,7 +13,7 @@ Device data can then be retrieved as follows:
     Import the API:
         import DeviceAtlasCloud.Client
     
-    Create DA Cloud API object:
+    Create DA Cloud API object (one object can be shared by all threads):
         da = DeviceAtlasCloud.Client.Client()
 
     Get device data:
@@ -27,7 +27,41 @@ Device data can then be retrieved as follows:
         Or manually provide a dictionary of http headers:
             data = da.getDeviceData({HTTP-HEADERS})
 
-If you are using linux un-comment lines 55 and 360 to use file lock on cache file
+        Or spend at most 50 ms, the available data is returned with an
+        _error if the cloud is slower (the fetch fills the cache anyway):
+            data = da.getDeviceData(request.META, budget_ms=50)
+
+        Or get data for a batch of requests at once:
+            data_list = da.getDeviceDataMulti([{HTTP-HEADERS}, {HTTP-HEADERS}])
+
+        Non blocking lookups (ndb tasklets):
+            da     = DeviceAtlasCloud.Client.AsyncClient()
+            future = da.getDeviceDataAsync({HTTP-HEADERS})
+            data   = future.get_result()
+
+        Collect metrics (cache hits, latency histograms, failovers...):
+            DeviceAtlasCloud.Client.Client.metrics = DeviceAtlasCloud.Client.InMemoryMetrics()
+            figures = DeviceAtlasCloud.Client.Client.metrics.snapshot()
+
+Pre-warm the device cache from access logs (e.g. after a deploy or a memcache
+flush), the most frequent user agents which are not cached are fetched:
+
+    python ClientGAE.py warm --top 1000 --rate 20 access.log access.log.1.gz
+
+Build a local device index from the cached device data of the logged user
+agents (no cloud calls) and/or JSON lines dumps of device data, then set
+LOCAL_INDEX_PATH to resolve known devices and to answer when the cloud is down:
+
+    python ClientGAE.py build-index --output devices.idx access.log --dump results.jsonl
+
+With FILE_CACHE_INDEXED the file cache items are kept in one indexed file which
+is locked with flock() where available (linux)
+
+Outside Google App Engine the processes of a host (e.g. pre-fork server
+workers) can share one cache in memory, add the 'sharedcache' tier or set
+USE_SHARED_CACHE = True (see SharedMemoryCache):
+
+    Client.CACHE_TIERS = ('localcache', 'sharedcache', 'memcache')
 
 The returned data will be as:
 
@@ -35,382 +69,4259 @@ The returned data will be as:
     data['_error']     will exist if any errors happened while fetching data
     data['_useragent'] the useragent that was used to query data
     data['_source']    shows where the data came from and is one of:
+                            (with CACHE_BY_USER_AGENT_ONLY the cookie properties
+                            are merged over the data from any of these)
                             da.SOURCE_COOKIE
+                            da.SOURCE_LOCAL_CACHE
+                            da.SOURCE_SHARED_CACHE
+                            da.SOURCE_MEMCACHE
                             da.SOURCE_FILE_CACHE
                             da.SOURCE_CLOUD
+                            da.SOURCE_LOCAL_INDEX
+                            da.SOURCE_LOCAL_INDEX_FALLBACK (the cloud failed)
                             da.SOURCE_NONE
+                       a cached source ends with da.SOURCE_STALE_SUFFIX when
+                       the data is older than CACHE_SOFT_EXPIRY_SEC and is
+                       being refreshed in the background
 
 © 2013 Afilias Technologies Ltd (dotMobi). All rights reserved
 
 '''
 
-import sys, os, json, tempfile, time, atexit
+import sys, os, re, json, copy, tempfile, time, atexit, threading, socket, struct, zlib, mmap
+from collections import OrderedDict
 from hashlib import md5
 from pprint import PrettyPrinter
-from random import shuffle, randint
+from random import shuffle, randint, random
 from google.appengine.api import memcache
-#import fcntl
+from google.appengine.ext import ndb
+try:
+    # file locks shared with other processes, not available on windows
+    import fcntl
+except ImportError:
+    fcntl = None
 if sys.version_info[0] == 2:
     # python 2:
     from urllib2 import Request, quote, urlopen
+    from Queue import Queue, Empty
+    from httplib import HTTPConnection
 else:
     # python 3:
     from urllib.request import Request, urlopen, quote
+    from queue import Queue, Empty
+    from http.client import HTTPConnection
 
 
-class Client:
-
-    ############### BASIC SETUP ################################################
-
-    LICENCE_KEY = 'paste-licence-key-here'
+def runConcurrently(tasks, max_workers):
+    '''
+    Call a list of functions using at most max_workers threads
+    @param list tasks       functions which take no arguments
+    @param int  max_workers max number of threads
+    @return     list of the function results in the same order as tasks,
+                exceptions are not caught and must be handled by the tasks
+    '''
+    results = [None] * len(tasks)
+    if len(tasks) <= 1 or max_workers <= 1:
+        for i, task in enumerate(tasks):
+            results[i] = task()
+        return results
 
-    # true:  server preference is decided by the API (faster server is preferred) 
-    # false: server preference is SERVERS sort order (top server is preferred)
-    AUTO_SERVER_RANKING = True
+    indexes = list(range(len(tasks)))
+    lock    = threading.Lock()
 
-    # list of cloud service provider end points
-    # server preference is decided from this list
-    SERVERS = (
-        {'host': 'region0.deviceatlascloud.com', 'port': 80},
-        {'host': 'region1.deviceatlascloud.com', 'port': 80},
-        {'host': 'region2.deviceatlascloud.com', 'port': 80},
-        {'host': 'region3.deviceatlascloud.com', 'port': 80},
-    )
+    def worker():
+        while True:
+            with lock:
+                if not indexes:
+                    return
+                i = indexes.pop(0)
+            results[i] = tasks[i]()
 
-    ############### ADVANCED SETUP #############################################
-    # edit these if you want to tweak behaviour
+    threads = [
+        threading.Thread(target=worker)
+        for i in range(min(max_workers, len(tasks)))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
-    DEBUG = False
-    # build in test user agent
-    TEST_USERAGENT        = 'Mozilla/5.0 (Linux; U; Android 2.3.3; en-gb; GT-I9100 Build/GINGERBREAD) AppleWebKit/533.1 (KHTML, like Gecko) Version/4.0 Mobile Safari/533.1'
-    # time (seconds) to wait for each cloud server to give service
-    CLOUD_SERVICE_TIMEOUT = 2
-    # use device data which is created by the DeviceAtlas Client Side Component if exists
-    USE_CLIENT_COOKIE     = True
-    # memcache cloud results in files (Must use on Google App Engine)
-    USE_MEMCACHE         = True
-    # cache cloud results in files
-    USE_FILE_CACHE        = False
-    # memcache expire (for both file and cookie) 2592000 = 30 days in seconds
-    MEMCACHE_ITEM_EXPIRY_SEC = 2592000
-    # cache expire (for both file and cookie) 2592000 = 30 days in seconds
-    CACHE_ITEM_EXPIRY_SEC = 2592000
-    # file cache > directory name
-    CACHE_NAME            = 'deviceatlas_cache_py'
-    # memcache > prefix name
-    MEMCACHE_KEY_PREFIX   = 'deviceAtlas_'
-    # memcache > key for server rankings
-    MEMCACHE_KEY_SERVER_RANKS = 'deviceAtlas_serverRanks'
-    # file cache > leave as true to put cache in systems default temp directory
-    USE_SYSTEM_TEMP_DIR   = True
-    # file cache > this is only used if USE_SYSTEM_TEMP_DIR is false
-    CUSTOM_CACHE_DIR      = '/path/to/your/cache/'
-    # true:  extra headers are sent with each request to the service
-    # false: only select headers which are essential for detection are sent
-    SEND_EXTRA_HEADERS    = False
-    # name of the cookie created by "DeviceAtlas Client Side Component"
-    CLIENT_COOKIE_NAME    = 'DAPROPS'
-    # when ranking servers, if a server fails more than this number phase it out
-    AUTO_SERVER_RANKING_MAX_FAILURE  = 1
-    # number of requests to send when testing server latency
-    AUTO_SERVER_RANKING_NUM_REQUESTS = 3
-    # server preferred list will be updated when older than this amount of minutes
-    AUTO_SERVER_RANKING_LIFETIME     = 1440
-    # auto ranking = false > if top server fails it will be phased out for this amount of minutes
-    SERVER_PHASEOUT_LIFETIME         = 1440
-    # memcache expire (for server rank) 300 = 5 mins in seconds
-    MEMCACHE_SERVER_RANKS_EXPIRY_SEC = 300
+    return results
 
-    ############### END OF SETUP, do not edit below this point! ################
 
+class ConnectionPool:
+    '''
+    Thread safe pool of persistent HTTP/1.1 (keep-alive) connections. After a
+    request the connection is kept idle for its host and reused by the next
+    request to the same host, this saves a TCP handshake per request.
+    '''
 
-    ############### CONSTANTS ##################################################
-    API_VERSION           = 'python/1.3'
-    # keys of dictionary returned by getDeviceData()
-    USERAGENT             = '_useragent'
-    SOURCE                = '_source'
-    ERROR                 = '_error'
-    PROPERTIES            = 'properties'
-    # device data source
-    SOURCE_COOKIE         = 'cookie'
-    SOURCE_MEMCACHE     = 'memcache'
-    SOURCE_FILE_CACHE     = 'cache'
-    SOURCE_CLOUD          = 'cloud'
-    SOURCE_NONE           = 'none'
-    # headers
-    DA_HEADER_PREFIX      = 'X-DA-'
-    CLIENT_COOKIE_HEADER  = 'Client-Properties'
-    # cloud service
-    CLOUD_PATH            = '/v1/detect/properties?licencekey=%s&useragent=%s'
+    def __init__(self, max_idle=4, idle_timeout=60):
+        '''
+        @param int max_idle     max number of idle connections kept per host
+        @param int idle_timeout seconds after which an idle connection is closed
+        '''
+        self.max_idle     = max_idle
+        self.idle_timeout = idle_timeout
+        # (host, port) > [(connection, last used time),]
+        self.__idle       = {}
+        self.__lock       = threading.Lock()
 
-    # a list of headers from the end user to pass to DeviceAtlas Cloud. These
-    # help with detection, especially if a third party browser or a proxy
-    # changes the original user-agent.
-    ESSENTIAL_HEADERS = (
-        'HTTP_X_PROFILE',
-        'HTTP_X_WAP_PROFILE',
-        'HTTP_X_ATT_DEVICEID',
-        'HTTP_ACCEPT',
-        'HTTP_ACCEPT_LANGUAGE',
-    )
-    # a list of headers which may contain the original user agent.
-    # this headers are sent to cloud server beside ESSENTIAL_HEADERS
-    ESSENTIAL_USER_AGENT_HEADERS = (
-        'HTTP_X_DEVICE_USER_AGENT',
-        'HTTP_X_ORIGINAL_USER_AGENT',
-        'HTTP_X_OPERAMINI_PHONE_UA',
-        'HTTP_X_SKYFIRE_PHONE',
-        'HTTP_X_BOLT_PHONE_UA',
-        'HTTP_DEVICE_STOCK_UA',
-        'HTTP_X_UCBROWSER_DEVICE_UA',
-    )
-    # a list of additional headers to send to DeviceAtlas. These are not sent
-    # by default. These headers can be used for carrier detection and geoip.
-    EXTRA_HEADERS = (
-        'HTTP_CLIENT_IP',
-        'HTTP_X_FORWARDED_FOR',
-        'HTTP_X_FORWARDED',
-        'HTTP_FORWARDED_FOR',
-        'HTTP_FORWARDED',
-        'HTTP_PROXY_CLIENT_IP',
-        'HTTP_WL_PROXY_CLIENT_IP',
-        'REMOTE_ADDR',
-    )
 
-    rankOnDestruct   = False
-    calledServer = None
+    def request(self, host, port, path, headers, timeout, cancellation=None):
+        '''
+        Send a GET request, a reused connection which turns out to be stale
+        (closed by the server) is replaced by a new one and the request is
+        sent again
+        @param Cancellation cancellation closes the connection of the request
+                                         when cancelled, None = not cancellable
+        @return tuple (HTTP status, response body)
+        '''
+        while True:
+            conn, reused = self.__acquire(host, port, timeout)
+            if cancellation is not None and not cancellation.register(conn):
+                conn.close()
+                raise Exception('Request cancelled')
+            cancelled = False
+            try:
+                conn.request('GET', path, headers=headers)
+                res  = conn.getresponse()
+                body = res.read()
+            except socket.timeout:
+                conn.close()
+                raise
+            except Exception:
+                conn.close()
+                if reused and not (cancellation and cancellation.cancelled):
+                    continue
+                raise
+            finally:
+                if cancellation is not None:
+                    cancelled = cancellation.unregister(conn)
 
-    pp = PrettyPrinter(indent=4)
+            # a connection closed by cancel() must not go back to the pool
+            if res.will_close or cancelled:
+                conn.close()
+            else:
+                self.__release(host, port, conn)
+            return res.status, body
 
 
-    def __init__(self):
-        # if headers are passed to getDeviceData then put them in this variable
-        # None = when os.environ is used as headers container
-        self.__headers = None
+    def clear(self):
+        '''
+        Close all idle connections
+        '''
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for connections in idle.values():
+            for conn, used in connections:
+                conn.close()
 
 
-    def getDeviceData(self, headers={}, test_mode=False):
+    def __acquire(self, host, port, timeout):
         '''
-        Get device data from DeviceAtlas Cloud. Once data has been returned from
-        DeviceAtlas Cloud it can be cached locally to speed up subsequent requests.
-        If device data provided by "DeviceAtlas Client Side Component" exists in
-        a cookie then cloud data will be merged with the cookie data.
-        @param dict headers    a dictionary of HTTP headers set manually
-        @param bool test_mode  true = use a fake useragent to test and get results
-        @return     dictionary {properties: {name: value,}, _source: data-source,
-                            _useragent: string, _error: if-any-happens}
+        Get an idle connection to the host or create a new one
+        @return tuple (connection, true if the connection is reused)
         '''
+        expired = []
+        conn    = None
+        with self.__lock:
+            connections = self.__idle.get((host, port), [])
+            while connections:
+                idle_conn, used = connections.pop()
+                if used + self.idle_timeout > time.time():
+                    conn = idle_conn
+                    break
+                expired.append(idle_conn)
+        for idle_conn in expired:
+            idle_conn.close()
 
-        if self.DEBUG:
-            print "getting Device Data"
-        # unify headers to standard form - compatibility with legacy API
-        if headers == {}:
-            headers = os.environ
-        else:
-            if 'user_agent' in headers:
-                legacy_headers = {
-                    'user_agent': 'HTTP_USER_AGENT',
-                    'cookie':     'HTTP_COOKIE',
-                }
-                for header in self.ESSENTIAL_HEADERS:
-                    legacy_headers[header.lower().replace('http_', '')] = header
-                for header in self.ESSENTIAL_USER_AGENT_HEADERS:
-                    legacy_headers[header.lower().replace('http_', '')] = header
-                for header in self.EXTRA_HEADERS:
-                    legacy_headers[header.lower().replace('http_', '')] = header
-                new_headers = {}
-                for header in headers:
-                    headerX = header.lower().replace('-', '_').replace('http_', '')
-                    if headerX in legacy_headers:
-                        a = legacy_headers[headerX]
-                        b = headers[header]
-                        new_headers[a] = b
-                        #new_headers[legacy_headers[headerX]] = headers[header]
-        headers = new_headers
-        if self.DEBUG:
-            self.pp.pprint(headers)
-        # get user agent
-        user_agent = ''
-        if test_mode:
-            user_agent = self.TEST_USERAGENT
-        elif 'HTTP_USER_AGENT' in headers:
-            user_agent = headers['HTTP_USER_AGENT']
-            del headers['HTTP_USER_AGENT']
-
-        self.__headers = headers
+        if conn is None:
+            return HTTPConnection(host, port, timeout=timeout), False
 
-        # if "DeviceAtlas Client Side Component" cookie has been created use the data
-        cookie  = ''
-        cookies = {}
-        if self.USE_CLIENT_COOKIE:
-            if 'HTTP_COOKIE' in headers:
-                for raw in headers['HTTP_COOKIE'].split(';'):
-                   raw_list = raw.split('=')
-                   cookies[raw_list[0].strip()] = raw_list[1].strip()
-                if self.CLIENT_COOKIE_NAME in cookies:
-                    cookie = cookies[self.CLIENT_COOKIE_NAME]
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
 
-        # get device data from cache or cloud
-        results = {}
-        source  = self.SOURCE_NONE
-        try:
-            # check mem cache for cached data - cache is in JSON format
-            if self.USE_MEMCACHE:
-                source  = self.SOURCE_MEMCACHE
-                results = self.getMemCache(user_agent, cookie)
-            # check file cache for cached data - cache is in JSON format
-            elif self.USE_FILE_CACHE:
-                source  = self.SOURCE_FILE_CACHE
-                results = self.getFileCache(user_agent, cookie)
 
-            if results:
-                #results = json.loads(results)
-                #self.pp.pprint('WTF')
-                #self.pp.pprint(results)
-                if self.PROPERTIES not in results:
-                    results = None
+    def __release(self, host, port, conn):
+        '''
+        Put a connection back to the pool or close it if the pool is full
+        '''
+        with self.__lock:
+            connections = self.__idle.setdefault((host, port), [])
+            if len(connections) < self.max_idle:
+                connections.append((conn, time.time()))
+                return
+        conn.close()
 
-            # use cloud service to get data
-            if not results:
-                source  = self.SOURCE_CLOUD
-                results = self.__callCloudService(user_agent, cookie)
-                # set caches for future queries
-                if self.USE_MEMCACHE:
-                    self.setMemCache(user_agent, cookie, results)
-                elif self.USE_FILE_CACHE:
-                    self.setFileCache(user_agent, cookie, results)
 
-            # decode json
-            if results:
-                if self.PROPERTIES not in results:
-                    raise Exception(
-                        'Can not get device properties from "%s"' % device_data
-                    )
-            else:
-                results = {}
-    
-        except Exception as err:
-            results = {self.ERROR: str(err)}
+class Cancellation:
+    '''
+    Cancels the requests of a hedged cloud call which lost the race: the
+    connections of the running requests are closed at once (which ends
+    their blocked reads) and requests not sent yet are not sent.
+    '''
 
-        results[self.SOURCE]    = source
-        results[self.USERAGENT] = user_agent
-        return results
+    def __init__(self):
+        self.cancelled     = False
+        self.__connections = set()
+        self.__lock        = threading.Lock()
 
 
-    def __convertHeaders(self, header_keys):
+    def register(self, conn):
         '''
-        Converts HTTP header names from HTTP_HEADER_NAME to X-DA-header-name
+        Add the connection of a request about to be sent
+        @return bool false if already cancelled, the request must not be sent
         '''
-        headers     = self.__headers
-        new_headers = {}
-        for header in header_keys:
-            if header.startswith('HTTP_'):
-                key = header[5:].lower().replace('_', '-')
-            else:
-                key = header.lower().replace('_', '-')
-            if headers and header in headers:
-                new_headers[self.DA_HEADER_PREFIX + key] = headers[header]
+        with self.__lock:
+            if self.cancelled:
+                return False
+            self.__connections.add(conn)
+            return True
 
-        return new_headers
+
+    def unregister(self, conn):
+        '''
+        Remove the connection of a finished request
+        @return bool true if the connection was closed by cancel()
+        '''
+        with self.__lock:
+            self.__connections.discard(conn)
+            return self.cancelled
 
 
-    def __callCloudService(self, user_agent, cookie):
+    def cancel(self):
         '''
-        Get data from the DeviceAtlas Cloud service
-        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        Close the connections of the running requests
         '''
-        if self.DEBUG:
-            print ("connecting to Device Atlas service ")
-        errors  = []
-        servers = self.getServers()
-        i       = 0
+        with self.__lock:
+            self.cancelled = True
+            connections, self.__connections = self.__connections, set()
+        for conn in connections:
+            try:
+                if conn.sock is not None:
+                    # close() alone does not wake a thread blocked in recv()
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+            conn.close()
 
-        for server in servers:
-            response = self.__connectCloud(server, user_agent, cookie, errors)
-            self.calledServer = server
-            if response != None:
-                # i = index of healthy server, all servers with index less than
-                # i have failed, move them to the end of the list:
-                # save list to cache
-                # if param servers is provided it means only cache servers
-                # without ranking them.
-                if i > 0:
-                    self.rankServers(servers[i:]+servers[:i])
 
-                return response
-            i += 1
+class CircuitBreaker:
+    '''
+    Per server circuit breaker. A closed circuit lets requests through, when
+    the failures within the window reach both the count and the rate limits
+    or when a run of consecutive failures is long enough (a server which was
+    healthy until it hung has a low failure rate over the window) the
+    circuit opens and the server is skipped. After the phase out time the
+    circuit is half open: one trial request is let through, its success
+    closes the circuit and its failure opens it again. When all the servers
+    are phased out trial requests are let through without waiting for the
+    phase out time, see allowTrial().
+    '''
 
-        raise Exception(('\n').join(errors))
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, max_failures=3, failure_rate=0.5, window_sec=60, phaseout_sec=300, trial_timeout=2, max_consecutive=5):
+        '''
+        @param int   max_failures    min number of failures to open the circuit
+        @param float failure_rate    min failure rate (0-1) to open the circuit
+        @param int   window_sec      requests older than this are not counted
+        @param int   phaseout_sec    time an open circuit skips the server
+        @param int   trial_timeout   a trial request not reported after this
+                                     time is given up and a new one is allowed
+        @param int   max_consecutive consecutive failures which open the
+                                     circuit whatever the rate, 0 = off
+        '''
+        self.max_failures    = max_failures
+        self.failure_rate    = failure_rate
+        self.window_sec      = window_sec
+        self.phaseout_sec    = phaseout_sec
+        self.trial_timeout   = trial_timeout
+        self.max_consecutive = max_consecutive
+        # host > {state:, opened: time, trial: time, results: [(time, ok),],
+        #         consecutive: failures since the last success}
+        self.__circuits    = {}
+        self.__lock        = threading.Lock()
 
 
-    def __connectCloud(self, server, user_agent, cookie, errors, latency_checker=False):
+    def isAvailable(self, host):
         '''
-        Connect to a cloud server and get device data, return data or null
+        Check if requests can be sent to a server, nothing is changed
         '''
-        if self.DEBUG:
-            print ("connecting to Device Atlas server " + server['host'])
-        # add "essential" headers
-        # add any Opera or any other special headers as these may contain
-        # extra device information
-        headers = self.__convertHeaders(
-            self.ESSENTIAL_HEADERS +
-            self.ESSENTIAL_USER_AGENT_HEADERS
-        )
-        # API info
-        headers[self.DA_HEADER_PREFIX + 'Version'] = self.API_VERSION
-        # add the "DeviceAtlas Client Side Component" cookie data
-        if cookie:
-            headers[self.DA_HEADER_PREFIX + self.CLIENT_COOKIE_HEADER] = cookie
-        # latency checker
-        if latency_checker:
-            headers[self.DA_HEADER_PREFIX+'Latency-Checker'] = '1'
-        # add extra "optional" headers
-        if self.SEND_EXTRA_HEADERS:
-            headers.update(self.convertHeader(self.EXTRA_HEADERS))
-        # build request
-        req = Request(
-            'http://' + server['host'] + ':' + str(server['port']) +
-            self.CLOUD_PATH % (self.LICENCE_KEY, quote(user_agent))
-        )
+        with self.__lock:
+            return self.__isAvailable(self.__circuits.get(host), time.time())
 
-        for header in headers:
-            req.add_header(header, headers[header])
-        try:
-            res  = urlopen(req, None, self.CLOUD_SERVICE_TIMEOUT)
-            data = res.read().decode('utf8').strip()
-            if data:
-                device_data = json.loads(data)
-                if self.PROPERTIES in device_data:
-                    return device_data
-
-                errors.append('Server ('+server['host']+') returned invalid data')
-            else:
-                errors.append('Server ('+server['host']+') returned nothing')
 
-        except Exception as err:
-            errors.append(
-                'Error fetching DeviceAtlas data from Cloud server "' + \
-                server['host'] + '". ' + str(err)
-            )
+    def allow(self, host):
+        '''
+        Check if a request can be sent to a server, if the server is due for
+        a trial request the caller makes it
+        '''
+        now = time.time()
+        with self.__lock:
+            circuit = self.__circuits.get(host)
+            if circuit is None or circuit['state'] == self.CLOSED:
+                return True
+            if circuit['state'] == self.OPEN:
+                if circuit['opened'] + self.phaseout_sec > now:
+                    return False
+                circuit['state'] = self.HALF_OPEN
+            elif circuit['trial'] + self.trial_timeout > now:
+                # another trial request is running
+                return False
+            circuit['trial'] = now
+            return True
 
-        return None
+
+    def allowTrial(self, host, hosts):
+        '''
+        Let a trial request through to a phased out server if all the servers
+        are phased out, otherwise every request would fail without trying any
+        server and the circuits could never close before the phase out time.
+        One trial request per server runs at a time.
+        @param list hosts all the servers
+        @return     bool true = the caller makes the trial request
+        '''
+        now = time.time()
+        with self.__lock:
+            for other in hosts:
+                if self.__isAvailable(self.__circuits.get(other), now):
+                    return False
+            circuit = self.__circuits.get(host)
+            if circuit is None or circuit['state'] == self.CLOSED:
+                return True
+            if circuit['state'] == self.HALF_OPEN and \
+               circuit['trial'] + self.trial_timeout > now:
+                return False
+            circuit['state'] = self.HALF_OPEN
+            circuit['trial'] = now
+            return True
 
 
-    def setFileCache(self, user_agent, cookie, device_data):
+    def record(self, host, ok):
         '''
-        FILE CACHE > Cache device data into a file
-        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        Record the result of a request
+        @param bool ok true = the server gave service
+        @return    bool true if the circuit opened or closed
         '''
+        now = time.time()
+        with self.__lock:
+            circuit = self.__circuits.setdefault(host, {
+                'state': self.CLOSED, 'opened': 0, 'trial': 0, 'results': [],
+                'consecutive': 0,
+            })
+            circuit['consecutive'] = 0 if ok else circuit['consecutive'] + 1
+            if circuit['state'] != self.CLOSED:
+                if ok:
+                    circuit['state']   = self.CLOSED
+                    circuit['results'] = []
+                else:
+                    circuit['state']  = self.OPEN
+                    circuit['opened'] = now
+                return True
 
-        path     = self.getFileCacheDir(user_agent, cookie)
-        dir_name = os.path.dirname(path)
+            results = [x for x in circuit['results'] if x[0] + self.window_sec > now]
+            results.append((now, ok))
+            circuit['results'] = results
+            failures = len([x for x in results if not x[1]])
+            if (failures >= self.max_failures and \
+                failures >= self.failure_rate * len(results)) or \
+               (self.max_consecutive and circuit['consecutive'] >= self.max_consecutive):
+                circuit['state']       = self.OPEN
+                circuit['opened']      = now
+                circuit['results']     = []
+                circuit['consecutive'] = 0
+                return True
 
-        try:
-            if not os.path.exists(dir_name):
+        return False
+
+
+    def __isAvailable(self, circuit, now):
+        if circuit is None or circuit['state'] == self.CLOSED:
+            return True
+        if circuit['state'] == self.OPEN:
+            return circuit['opened'] + self.phaseout_sec <= now
+        return circuit['trial'] + self.trial_timeout <= now
+
+
+    def getState(self, host):
+        '''
+        @return string CLOSED, OPEN or HALF_OPEN
+        '''
+        with self.__lock:
+            circuit = self.__circuits.get(host)
+            return circuit['state'] if circuit else self.CLOSED
+
+
+    def getOpenCircuits(self):
+        '''
+        @return dict {host: time the circuit opened,} of the open circuits
+        '''
+        with self.__lock:
+            return dict(
+                (host, circuit['opened'])
+                for host, circuit in self.__circuits.items()
+                if circuit['state'] != self.CLOSED
+            )
+
+
+    def merge(self, open_circuits):
+        '''
+        Open the circuits which were opened by other instances
+        @param dict open_circuits {host: time the circuit opened,}
+        '''
+        now = time.time()
+        with self.__lock:
+            for host, opened in open_circuits.items():
+                if opened + self.phaseout_sec <= now:
+                    continue
+                circuit = self.__circuits.setdefault(host, {
+                    'state': self.CLOSED, 'opened': 0, 'trial': 0, 'results': [],
+                    'consecutive': 0,
+                })
+                if circuit['state'] == self.CLOSED or circuit['opened'] < opened:
+                    circuit['state']   = self.OPEN
+                    circuit['opened']  = opened
+                    circuit['results'] = []
+
+
+class LatencyTracker:
+    '''
+    Per server latency estimates built from the answered cloud requests: an
+    exponentially weighted moving average and the percentiles of a window of
+    recent samples. Samples older than max_age are dropped so an old slow
+    answer does not hold the estimate up, and the requests a server failed to
+    answer since its last answer are counted. The count is forgotten
+    failure_ttl seconds after the first of these failures. Estimates shared
+    by other instances are used for the servers with too few samples of
+    their own.
+    '''
+
+    def __init__(self, alpha=0.2, window=100, min_samples=20, max_age=300, failure_ttl=60):
+        '''
+        @param float alpha       weight of a new sample in the moving average
+        @param int   window      number of recent samples kept per server
+        @param int   min_samples samples needed before an estimate is used
+        @param float max_age     seconds a sample is kept
+        @param float failure_ttl seconds the failures of a server are counted
+        '''
+        self.alpha       = alpha
+        self.window      = window
+        self.min_samples = min_samples
+        self.max_age     = max_age
+        self.failure_ttl = failure_ttl
+        # host > {samples: [(time, ms),], count:, failures:, failed: time of
+        #         the first failure, ewma:, p50:, p90:, p99:}
+        self.__servers   = {}
+        # host > estimate published by other instances
+        self.__shared    = {}
+        self.__lock      = threading.Lock()
+
+
+    def record(self, host, ms):
+        '''
+        Add the latency of an answered request
+        @param float ms duration of the request in milliseconds
+        '''
+        with self.__lock:
+            server = self.__getServer(host)
+            server['samples'].append((time.time(), ms))
+            del server['samples'][:-self.window]
+            server['count']   += 1
+            server['failures'] = 0
+            server['failed']   = None
+            if server['ewma'] is None:
+                server['ewma'] = ms
+            else:
+                server['ewma'] = self.alpha * ms + (1 - self.alpha) * server['ewma']
+            self.__update(server)
+
+
+    def recordFailure(self, host):
+        '''
+        Count a request which the server did not answer (timed out or failed)
+        '''
+        with self.__lock:
+            server = self.__getServer(host)
+            if server['failures'] == 0:
+                server['failed'] = time.time()
+            server['failures'] += 1
+
+
+    def getFailures(self, host):
+        '''
+        @return int number of requests the server failed since its last
+                answer, 0 once the first of them is older than failure_ttl
+        '''
+        with self.__lock:
+            server = self.__servers.get(host)
+            if server is None or server['failures'] == 0:
+                return 0
+            if server['failed'] + self.failure_ttl <= time.time():
+                server['failures'] = 0
+                server['failed']   = None
+            return server['failures']
+
+
+    def getLatency(self, host):
+        '''
+        @return float the latest known p99 or moving average latency of a
+                server if higher (milliseconds), expired samples included,
+                or None if the server never answered
+        '''
+        with self.__lock:
+            server = self.__servers.get(host)
+            if server is None or 'p99' not in server:
+                server = self.__shared.get(host)
+            if server is None:
+                return None
+            return max(server['p99'], server['ewma'])
+
+
+    def getEstimate(self, host):
+        '''
+        @return dict {ewma:, p50:, p90:, p99:, count:} (milliseconds) or None
+                if there are not enough samples, neither local nor shared
+        '''
+        with self.__lock:
+            server = self.__servers.get(host)
+            if server is not None and self.__isKnown(server):
+                return self.__summary(server)
+            return self.__shared.get(host)
+
+
+    def getEstimates(self):
+        '''
+        @return dict {host: estimate,} of the servers with enough local samples
+        '''
+        with self.__lock:
+            return dict(
+                (host, self.__summary(server))
+                for host, server in self.__servers.items()
+                if self.__isKnown(server)
+            )
+
+
+    def merge(self, estimates):
+        '''
+        Use the estimates published by other instances
+        @param dict estimates {host: estimate,}
+        '''
+        with self.__lock:
+            self.__shared = dict(estimates)
+
+
+    def __getServer(self, host):
+        return self.__servers.setdefault(host, {
+            'samples': [], 'count': 0, 'failures': 0, 'failed': None, 'ewma': None,
+        })
+
+
+    def __isKnown(self, server):
+        '''
+        Drop the expired samples of a server
+        @return bool true = the server has enough samples for an estimate
+        '''
+        expired = time.time() - self.max_age
+        if server['samples'] and server['samples'][0][0] < expired:
+            server['samples'] = [x for x in server['samples'] if x[0] >= expired]
+            self.__update(server)
+        return len(server['samples']) >= self.min_samples
+
+
+    def __update(self, server):
+        '''
+        Compute the percentiles of the samples of a server, interpolating
+        between the two closest samples so that p99 is not simply the slowest
+        sample of the window
+        '''
+        samples = sorted(x[1] for x in server['samples'])
+        if not samples:
+            return
+        last = len(samples) - 1
+        for name, rank in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            position = rank * last
+            i        = int(position)
+            j        = min(i + 1, last)
+            server[name] = samples[i] + (samples[j] - samples[i]) * (position - i)
+
+
+    def __summary(self, server):
+        return dict(
+            (name, server[name]) for name in ('ewma', 'p50', 'p90', 'p99', 'count')
+        )
+
+
+class SingleFlight:
+    '''
+    Coalesces concurrent calls for the same key, the first caller runs the
+    function and callers arriving while it runs wait for and share its
+    result (or exception).
+    '''
+
+    def __init__(self):
+        # key > {event:, result:, error:}
+        self.__calls = {}
+        self.__lock  = threading.Lock()
+
+
+    def do(self, key, func):
+        '''
+        Call func or wait for the call which is already running for the key
+        @param string   key  calls with the same key are coalesced
+        @param function func function which takes no arguments
+        @return         the result of func, shared by all the waiting callers
+        '''
+        with self.__lock:
+            call   = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self.__calls[key] = call
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+        except Exception as err:
+            call['error'] = err
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call['event'].set()
+
+        return call['result']
+
+
+    def __len__(self):
+        return len(self.__calls)
+
+
+class UserAgentCanonicalizer:
+    '''
+    Removes or normalizes user agent tokens which do not affect detection so
+    more requests share a cache key. The rules are compiled once and applied
+    in order. Keeps statistics of the rule hits, of the cardinality reduction
+    and of the verification of canonical against raw results.
+    '''
+
+    def __init__(self, rules, max_tracked=100000, max_mismatches=20):
+        '''
+        @param list rules          ordered (name, regular expression, replacement)
+        @param int  max_tracked    max number of distinct user agents tracked
+                                   for the cardinality statistics
+        @param int  max_mismatches max number of failed verifications kept
+        '''
+        self.rules          = [
+            (name, re.compile(pattern), replacement)
+            for name, pattern, replacement in rules
+        ]
+        self.max_tracked    = max_tracked
+        self.max_mismatches = max_mismatches
+        self.__lock         = threading.Lock()
+        self.reset()
+
+
+    def canonicalize(self, user_agent, track=True):
+        '''
+        @param  string user_agent raw user agent
+        @param  bool   track      false = do not count in the statistics
+        @return string canonical user agent
+        '''
+        canonical = user_agent
+        hits      = []
+        for name, pattern, replacement in self.rules:
+            canonical, count = pattern.subn(replacement, canonical)
+            if count:
+                hits.append(name)
+        canonical = canonical.strip()
+
+        if track:
+            with self.__lock:
+                self.__lookups += 1
+                for name in hits:
+                    self.__ruleHits[name] = self.__ruleHits.get(name, 0) + 1
+                if len(self.__raw) < self.max_tracked:
+                    self.__raw.add(hash(user_agent))
+                if len(self.__canonical) < self.max_tracked:
+                    self.__canonical.add(hash(canonical))
+
+        return canonical
+
+
+    def recordVerification(self, user_agent, canonical, match):
+        '''
+        Record if the canonical user agent gave the same results as the raw one
+        '''
+        with self.__lock:
+            self.__verified += 1
+            if not match:
+                self.__mismatchCount += 1
+                if len(self.__mismatches) < self.max_mismatches:
+                    self.__mismatches.append((user_agent, canonical))
+
+
+    def getStats(self):
+        '''
+        @return dict {lookups:, raw_unique:, canonical_unique:, reduction:,
+                      rule_hits: {name: count,}, verified:, mismatches:,
+                      mismatch_samples: [(raw, canonical),]}
+        '''
+        with self.__lock:
+            raw       = len(self.__raw)
+            canonical = len(self.__canonical)
+            return {
+                'lookups':          self.__lookups,
+                'raw_unique':       raw,
+                'canonical_unique': canonical,
+                # how many raw user agents share a canonical one on average
+                'reduction':        float(raw) / canonical if canonical else 1.0,
+                'rule_hits':        dict(self.__ruleHits),
+                'verified':         self.__verified,
+                'mismatches':       self.__mismatchCount,
+                'mismatch_samples': list(self.__mismatches),
+            }
+
+
+    def reset(self):
+        '''
+        Clear the statistics
+        '''
+        with self.__lock:
+            self.__lookups       = 0
+            self.__ruleHits      = {}
+            self.__raw           = set()
+            self.__canonical     = set()
+            self.__verified      = 0
+            self.__mismatchCount = 0
+            self.__mismatches    = []
+
+
+class RecordCodec:
+    '''
+    Compact versioned binary encoding of cached device data. Property names
+    found in the name table are stored as their index, booleans cost no
+    more than the name reference and integers are stored as varints. Single
+    properties can be read without decoding the whole record. JSON strings
+    and dictionaries (older cache items) are decoded transparently.
+
+    record:   MAGIC, version byte, flags byte, body (zlib compressed if flagged)
+    body:     varint count, count x property, varint length + JSON of the
+              other top level keys (empty if none)
+    property: varint (name index + 1) << 3 | value type, the name follows
+              inline if it is not in the table (index -1), then the value
+    '''
+
+    MAGIC           = b'\xdaR'
+    VERSION         = 1
+    FLAG_COMPRESSED = 1
+    # value types
+    TYPE_NONE       = 0
+    TYPE_FALSE      = 1
+    TYPE_TRUE       = 2
+    TYPE_INT        = 3
+    TYPE_FLOAT      = 4
+    TYPE_STRING     = 5
+    TYPE_JSON       = 6
+
+    # shared property name table, only append to this list (and increase
+    # VERSION) so records written by older versions can still be read
+    NAMES = (
+        'accessDom', 'js.supportBasicJavaScript', 'displayPpi', 'js.indexedDB',
+        'js.webSockets', 'js.querySelector', 'hscsd', 'js.geoLocation',
+        'flashCapable', 'js.json', 'isMediaPlayer', 'isTablet',
+        'osWindowsPhone', 'js.supportConsoleLog', 'isSetTopBox',
+        'memoryLimitDownload', 'js.deviceOrientation', 'mobileDevice',
+        'osAndroid', 'osBada', 'html.inlinesvg', 'displayHeight', 'jsr118',
+        'image.Png', 'isEReader', 'js.supportEvents', 'js.webGl',
+        'image.Gif89a', 'js.modifyCss', 'isMobilePhone', 'browserVersion',
+        'js.modifyDom', 'css.transitions', 'jsr37', 'drmOmaCombinedDelivery',
+        'uriSchemeTel', 'usableDisplayWidth', 'jsr30', 'https', 'image.Jpg',
+        'osVersion', 'edge', 'vendor', 'memoryLimitMarkup', 'jsr139',
+        'css.columns', 'markup.xhtmlMp12', 'markup.xhtmlMp11',
+        'displayColorDepth', 'deviceAspectRatio', 'js.sessionStorage',
+        'isGamesConsole', 'markup.xhtmlMp10', 'markup.xhtmlBasic10',
+        'browserName', 'html.audio', 'image.Gif87', 'osRim',
+        'devicePixelRatio', 'cookieSupport', 'markup.wml1', 'gprs',
+        'js.applicationCache', 'umts', 'js.webSqlDatabase', 'marketingName',
+        'hsdpa', 'js.webWorkers', 'vCardDownload', 'js.deviceMotion',
+        'touchScreen', 'osWebOs', 'isTV', 'osiOs', 'js.touchEvents',
+        'js.supportEventListener', 'model', 'html.svg', 'drmOmaForwardLock',
+        'js.xhr', 'html.canvas', 'displayWidth', 'id', 'usableDisplayHeight',
+        'osWindowsMobile', 'uriSchemeSmsTo', 'uriSchemeSms',
+        'drmOmaSeparateDelivery', 'osSymbian', 'yearReleased',
+        'css.transforms', 'js.localStorage', 'jqm', 'memoryLimitEmbeddedMedia',
+        'html.video', 'csd', 'css.animations', 'userMedia', 'isBrowser',
+        'isChecker', 'isDownloader', 'isFeedReader', 'isFilter', 'isRobot',
+        'isSpam', 'isMasqueradingAsDesktop', 'osName',
+        'browserRenderingEngine', 'primaryHardwareType', 'manufacturer',
+    )
+
+    def __init__(self, compress=False, compress_min_bytes=512):
+        '''
+        @param bool compress           true = zlib compress large records
+        @param int  compress_min_bytes records smaller than this are not compressed
+        '''
+        self.compress           = compress
+        self.compress_min_bytes = compress_min_bytes
+        self.__indexes          = dict((name, i) for i, name in enumerate(self.NAMES))
+
+
+    def encode(self, device_data, properties_key='properties'):
+        '''
+        @param dict device_data {properties: {name: value,}, other keys:}
+        @return     bytes the encoded record
+        '''
+        properties = device_data.get(properties_key, {})
+        body       = bytearray()
+        self.__writeVarint(body, len(properties))
+        for name, value in properties.items():
+            if value is None:
+                value_type = self.TYPE_NONE
+            elif value is True:
+                value_type = self.TYPE_TRUE
+            elif value is False:
+                value_type = self.TYPE_FALSE
+            elif isinstance(value, int) or \
+                 (sys.version_info[0] == 2 and isinstance(value, long)):
+                value_type = self.TYPE_INT
+            elif isinstance(value, float):
+                value_type = self.TYPE_FLOAT
+            elif isinstance(value, (type(u''), type(b''))):
+                value_type = self.TYPE_STRING
+            else:
+                value_type = self.TYPE_JSON
+
+            index = self.__indexes.get(name, -1)
+            self.__writeVarint(body, (index + 1) << 3 | value_type)
+            if index == -1:
+                self.__writeString(body, name)
+
+            if value_type == self.TYPE_INT:
+                # zigzag encoding keeps small negative numbers small
+                self.__writeVarint(body, value << 1 if value >= 0 else (-value << 1) - 1)
+            elif value_type == self.TYPE_FLOAT:
+                body += struct.pack('>d', value)
+            elif value_type == self.TYPE_STRING:
+                self.__writeString(body, value)
+            elif value_type == self.TYPE_JSON:
+                self.__writeString(body, json.dumps(value))
+
+        others = dict(
+            (key, value) for key, value in device_data.items() if key != properties_key
+        )
+        self.__writeString(body, json.dumps(others) if others else '')
+
+        flags = 0
+        if self.compress and len(body) >= self.compress_min_bytes:
+            body   = bytearray(zlib.compress(bytes(body)))
+            flags |= self.FLAG_COMPRESSED
+
+        return bytes(bytearray(self.MAGIC) + bytearray((self.VERSION, flags)) + body)
+
+
+    def isEncoded(self, value):
+        '''
+        Check if a cached value is an encoded record
+        '''
+        return isinstance(value, (bytes, bytearray)) and \
+            bytes(value[:len(self.MAGIC)]) == self.MAGIC
+
+
+    def decode(self, value, properties_key='properties'):
+        '''
+        Decode a cached value, encoded records, JSON strings and dictionaries
+        are accepted
+        @return dict device data or None if the value is empty
+        '''
+        if not value:
+            return None
+        if isinstance(value, dict):
+            return value
+        if not self.isEncoded(value):
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            return json.loads(value)
+
+        properties = {}
+        body, pos  = self.__body(value)
+        count, pos = self.__readVarint(body, pos)
+        for i in range(count):
+            name, value_type, pos = self.__readName(body, pos)
+            properties[name], pos = self.__readValue(body, pos, value_type)
+
+        others, pos = self.__readString(body, pos)
+        device_data = json.loads(others) if others else {}
+        device_data[properties_key] = properties
+        return device_data
+
+
+    def decodeLazy(self, value, properties_key='properties'):
+        '''
+        Decode a cached value with the properties as a DeviceProperties
+        mapping. The properties of an encoded record are only indexed (one
+        pass which skips the values), a value is decoded when it is read.
+        @return dict device data or None if the value is empty
+        '''
+        if not self.isEncoded(value):
+            device_data = self.decode(value, properties_key)
+            if device_data and isinstance(device_data.get(properties_key), dict):
+                device_data = dict(device_data)
+                device_data[properties_key] = DeviceProperties(device_data[properties_key])
+            return device_data
+
+        # the loop reads one byte varints inline, it runs for every property
+        # of every cache hit
+        index      = {}
+        names      = self.NAMES
+        body, pos  = self.__body(value)
+        count, pos = self.__readVarint(body, pos)
+        for i in range(count):
+            ref = body[pos]
+            if ref & 0x80:
+                ref, pos = self.__readVarint(body, pos)
+            else:
+                pos += 1
+            value_type = ref & 7
+            if ref >> 3:
+                name = names[(ref >> 3) - 1]
+            else:
+                name, pos = self.__readString(body, pos)
+            index[name] = (value_type, pos)
+
+            if value_type >= self.TYPE_STRING:
+                length = body[pos]
+                if length & 0x80:
+                    length, pos = self.__readVarint(body, pos)
+                else:
+                    pos += 1
+                pos += length
+            elif value_type == self.TYPE_INT:
+                while body[pos] & 0x80:
+                    pos += 1
+                pos += 1
+            elif value_type == self.TYPE_FLOAT:
+                pos += 8
+
+        others, pos = self.__readString(body, pos)
+        device_data = json.loads(others) if others else {}
+        device_data[properties_key] = DeviceProperties(
+            codec=self, body=body, index=index
+        )
+        return device_data
+
+
+    def decodeValue(self, body, value_type, pos):
+        '''
+        Decode one property value of a record body indexed by decodeLazy()
+        '''
+        return self.__readValue(body, pos, value_type)[0]
+
+
+    def getProperty(self, value, name, default=None, properties_key='properties'):
+        '''
+        Decode a single property of a cached value, encoded records are
+        scanned without building the properties dictionary
+        @return the property value or default if the property does not exist
+        '''
+        if not self.isEncoded(value):
+            device_data = self.decode(value) or {}
+            return device_data.get(properties_key, {}).get(name, default)
+
+        body, pos  = self.__body(value)
+        count, pos = self.__readVarint(body, pos)
+        for i in range(count):
+            item_name, value_type, pos = self.__readName(body, pos)
+            if item_name == name:
+                return self.__readValue(body, pos, value_type)[0]
+            pos = self.__skipValue(body, pos, value_type)
+
+        return default
+
+
+    def __body(self, value):
+        '''
+        @return tuple (body, position of the first property byte)
+        '''
+        value   = bytearray(value)
+        start   = len(self.MAGIC)
+        version = value[start]
+        if version > self.VERSION:
+            raise Exception('Unsupported cache record version %d' % version)
+        if value[start + 1] & self.FLAG_COMPRESSED:
+            return bytearray(zlib.decompress(bytes(value[start + 2:]))), 0
+        return value, start + 2
+
+
+    def __readName(self, body, pos):
+        '''
+        @return tuple (name, value type, next position)
+        '''
+        ref, pos = self.__readVarint(body, pos)
+        index    = (ref >> 3) - 1
+        if index == -1:
+            name, pos = self.__readString(body, pos)
+        else:
+            name = self.NAMES[index]
+        return name, ref & 7, pos
+
+
+    def __readValue(self, body, pos, value_type):
+        '''
+        @return tuple (value, next position)
+        '''
+        if value_type == self.TYPE_NONE:
+            return None, pos
+        if value_type == self.TYPE_TRUE:
+            return True, pos
+        if value_type == self.TYPE_FALSE:
+            return False, pos
+        if value_type == self.TYPE_INT:
+            value, pos = self.__readVarint(body, pos)
+            if value & 1:
+                return -((value + 1) >> 1), pos
+            return value >> 1, pos
+        if value_type == self.TYPE_FLOAT:
+            return struct.unpack('>d', bytes(body[pos:pos + 8]))[0], pos + 8
+        value, pos = self.__readString(body, pos)
+        if value_type == self.TYPE_JSON:
+            value = json.loads(value)
+        return value, pos
+
+
+    def __skipValue(self, body, pos, value_type):
+        '''
+        @return next position after the value
+        '''
+        if value_type == self.TYPE_INT:
+            return self.__readVarint(body, pos)[1]
+        if value_type == self.TYPE_FLOAT:
+            return pos + 8
+        if value_type in (self.TYPE_STRING, self.TYPE_JSON):
+            length, pos = self.__readVarint(body, pos)
+            return pos + length
+        return pos
+
+
+    def __writeVarint(self, buf, value):
+        while value > 0x7f:
+            buf.append((value & 0x7f) | 0x80)
+            value >>= 7
+        buf.append(value)
+
+
+    def __readVarint(self, buf, pos):
+        value = shift = 0
+        while True:
+            byte   = buf[pos]
+            pos   += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value, pos
+            shift += 7
+
+
+    def __writeString(self, buf, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        self.__writeVarint(buf, len(value))
+        buf += value
+
+
+    def __readString(self, buf, pos):
+        length, pos = self.__readVarint(buf, pos)
+        return bytes(buf[pos:pos + length]).decode('utf-8'), pos + length
+
+
+class DeviceProperties(object):
+    '''
+    Read only mapping of the properties of a device, with
+    Client.USE_LAZY_RESULTS it replaces the properties dictionary of the
+    results. The cached payload is shared instead of copied: a properties
+    dictionary is wrapped as it is and the values of a compact record are
+    decoded on first access (see RecordCodec.decodeLazy) and kept, so the
+    object shared through the in-process cache decodes each value once. The
+    "DeviceAtlas Client Side Component" cookie properties are layered over
+    the payload. It pickles as a dictionary, use copy() to get one.
+    '''
+
+    __slots__ = ('__values', '__index', '__body', '__codec', '__overrides')
+
+    def __init__(self, values=None, overrides=None, codec=None, body=None, index=None):
+        '''
+        @param dict        values    decoded properties, shared and never changed
+                                     unless the index is given
+        @param dict        overrides properties taking precedence
+        @param RecordCodec codec     decodes the values of the index
+        @param bytearray   body      record body the index points to
+        @param dict        index     {name: (value type, position in the body)}
+        '''
+        self.__values    = {} if values is None else values
+        self.__overrides = overrides
+        self.__codec     = codec
+        self.__body      = body
+        self.__index     = index
+
+
+    def withOverrides(self, overrides):
+        '''
+        @param  dict overrides properties taking precedence over these ones
+        @return DeviceProperties sharing the payload and its decoded values
+        '''
+        if self.__overrides:
+            merged = dict(self.__overrides)
+            merged.update(overrides)
+            overrides = merged
+        return DeviceProperties(
+            self.__values, overrides, self.__codec, self.__body, self.__index
+        )
+
+
+    def __getitem__(self, name):
+        if self.__overrides and name in self.__overrides:
+            return self.__overrides[name]
+        values = self.__values
+        if name in values:
+            return values[name]
+        if self.__index is not None and name in self.__index:
+            value_type, pos = self.__index[name]
+            value = values[name] = self.__codec.decodeValue(self.__body, value_type, pos)
+            return value
+        raise KeyError(name)
+
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
+    def __contains__(self, name):
+        return (self.__overrides is not None and name in self.__overrides) or \
+            name in self.__values or \
+            (self.__index is not None and name in self.__index)
+
+    has_key = __contains__
+
+
+    def keys(self):
+        if self.__index is not None:
+            names = set(self.__index)
+            names.update(self.__values)
+        else:
+            names = set(self.__values)
+        if self.__overrides:
+            names.update(self.__overrides)
+        return list(names)
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+
+    def itervalues(self):
+        return iter(self.values())
+
+
+    def iteritems(self):
+        return iter(self.items())
+
+
+    def copy(self):
+        '''
+        @return dict all the properties decoded
+        '''
+        return dict(self.items())
+
+
+    def __eq__(self, other):
+        if isinstance(other, DeviceProperties):
+            other = other.copy()
+        return self.copy() == other
+
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+
+    def __reduce__(self):
+        return dict, (self.copy(),)
+
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+class LruCache:
+    '''
+    Bounded in-process LRU cache with a per item expiry time. One instance is
+    shared by all Client objects of a process so it must be thread safe.
+    The size is limited by the number of items and optionally by an
+    approximated byte budget (size of the JSON encoded item).
+    '''
+
+    def __init__(self, max_items=1000, max_bytes=0, expiry_sec=3600):
+        '''
+        @param int max_items  max number of items to keep, 0 = no limit
+        @param int max_bytes  max approximated size of all items, 0 = no limit
+        @param int expiry_sec default lifetime of an item in seconds
+        '''
+        self.max_items  = max_items
+        self.max_bytes  = max_bytes
+        self.expiry_sec = expiry_sec
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        # key > (expire time, size, value) - oldest used item comes first
+        self.__items    = OrderedDict()
+        self.__bytes    = 0
+        self.__lock     = threading.Lock()
+
+
+    def get(self, key):
+        '''
+        Get an item and mark it as the most recently used one
+        @return the cached value or None if not cached or expired
+        '''
+        with self.__lock:
+            item = self.__items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            if item[0] < time.time():
+                self.__bytes -= item[1]
+                self.misses  += 1
+                return None
+            self.__items[key] = item
+            self.hits += 1
+            return item[2]
+
+
+    def set(self, key, value, expiry_sec=None):
+        '''
+        Put an item into the cache, least recently used items are evicted
+        when the cache is full
+        @param int expiry_sec lifetime of the item, None = use the default
+        '''
+        if expiry_sec is None:
+            expiry_sec = self.expiry_sec
+        size = 0
+        if self.max_bytes:
+            size = len(json.dumps(value, default=dict))
+            if size > self.max_bytes:
+                return False
+
+        with self.__lock:
+            old = self.__items.pop(key, None)
+            if old is not None:
+                self.__bytes -= old[1]
+            self.__items[key] = (time.time() + expiry_sec, size, value)
+            self.__bytes     += size
+            self.__evict()
+
+        return True
+
+
+    def delete(self, key):
+        '''
+        Remove an item from the cache
+        '''
+        with self.__lock:
+            item = self.__items.pop(key, None)
+            if item is not None:
+                self.__bytes -= item[1]
+
+
+    def clear(self):
+        '''
+        Remove all items from the cache
+        '''
+        with self.__lock:
+            self.__items.clear()
+            self.__bytes = 0
+
+
+    def __len__(self):
+        return len(self.__items)
+
+
+    def __evict(self):
+        '''
+        Drop least recently used items until the limits are met, the caller
+        must hold the lock
+        '''
+        while self.__items and (
+            (self.max_items and len(self.__items) > self.max_items) or
+            (self.max_bytes and self.__bytes > self.max_bytes)
+        ):
+            key, item     = self.__items.popitem(last=False)
+            self.__bytes -= item[1]
+            self.evictions += 1
+
+
+class DiskCache:
+    '''
+    Disk cache keeping all items in one append-only file instead of one file
+    per item. An in-memory hash index maps the md5 of a key to the position
+    of its latest entry and values are read from a memory map of the file,
+    so a hit costs no system call and readers do not lock. Writers append
+    whole entries under a lock (and flock() where available) so processes
+    sharing the file only see complete entries. Replaced, deleted and
+    expired entries are dropped by a compaction which rewrites the file, it
+    is started in a background thread when enough of the file is garbage.
+
+    entry: header (MAGIC, flags, value length, expire time, crc32 of the
+           key digest + value, key digest) + value
+    '''
+
+    MAGIC        = b'DC'
+    FLAG_DELETED = 1
+    HEADER       = struct.Struct('>2sBxIdI16s')
+
+    def __init__(self, path, expiry_sec=2592000, compact_ratio=0.5,
+                 compact_min_bytes=1048576, refresh_sec=1):
+        '''
+        @param string path              cache file path, the directory is created if missing
+        @param int    expiry_sec        default lifetime of an item in seconds
+        @param float  compact_ratio     compact when this part of the file is garbage
+        @param int    compact_min_bytes never compact files smaller than this
+        @param float  refresh_sec       look for entries written by other processes
+                                        at most this often on cache hits (always
+                                        on misses)
+        '''
+        self.path              = path
+        self.expiry_sec        = expiry_sec
+        self.compact_ratio     = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.refresh_sec       = refresh_sec
+        self.hits              = 0
+        self.misses            = 0
+        self.compactions       = 0
+        self.__lock            = threading.Lock()
+        self.__compacting      = False
+        self.__fd              = None
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name, mode=0o755)
+        with self.__lock:
+            self.__open()
+
+
+    def get(self, key):
+        '''
+        Get an item, no lock is taken when the item is in the index
+        @return bytes the cached value or None if not cached or expired
+        '''
+        digest = md5(self.__toBytes(key)).digest()
+        if self.__refreshed + self.refresh_sec < time.time():
+            self.__refresh()
+        # the state tuple is replaced as a whole, the index is updated in place
+        mapped, index, end = self.__state
+        entry = index.get(digest)
+        if entry is None and self.__refresh():
+            # another process has appended entries
+            mapped, index, end = self.__state
+            entry = index.get(digest)
+        if entry is None or entry[2] < time.time():
+            self.misses += 1
+            return None
+
+        offset, length, expires = entry
+        if mapped is None or offset + length > len(mapped):
+            with self.__lock:
+                mapped = self.__remap()
+        self.hits += 1
+        return bytes(mapped[offset:offset + length])
+
+
+    def set(self, key, value, expiry_sec=None):
+        '''
+        Append an item, the entry of an older value becomes garbage
+        @param bytes value
+        @param int   expiry_sec lifetime of the item, None = use the default
+        '''
+        self.setMulti({key: value}, expiry_sec)
+
+
+    def setMulti(self, mapping, expiry_sec=None):
+        '''
+        Append several items with one write under one lock
+        @param dict mapping    {key: bytes value,}
+        @param int  expiry_sec lifetime of the items, None = use the default
+        '''
+        if expiry_sec is None:
+            expiry_sec = self.expiry_sec
+        expires = time.time() + expiry_sec
+        self.__append([
+            (key, self.__toBytes(value), expires, 0) for key, value in mapping.items()
+        ])
+
+
+    def delete(self, key):
+        '''
+        Remove an item by appending a deleted entry
+        '''
+        self.__append([(key, b'', 0, self.FLAG_DELETED)])
+
+
+    def compact(self):
+        '''
+        Rewrite the file keeping the live entries only. The new file replaces
+        the old one atomically, readers still using the old memory map are
+        not affected.
+        '''
+        with self.__lock:
+            self.__lockFile()
+            try:
+                self.__scan()
+                mapped, index, end = self.__state
+                now     = time.time()
+                entries = []
+                for digest, (offset, length, expires) in index.items():
+                    if expires >= now:
+                        entries.append(self.__entry(
+                            digest, mapped[offset:offset + length], expires, 0
+                        ))
+                self.__replace(entries)
+                self.compactions += 1
+            finally:
+                self.__unlockFile()
+
+
+    def clear(self):
+        '''
+        Remove all items, the file is replaced (not truncated) because other
+        processes may still read their memory map of it
+        '''
+        with self.__lock:
+            self.__lockFile()
+            try:
+                self.__replace([])
+            finally:
+                self.__unlockFile()
+
+
+    def __len__(self):
+        return len(self.__state[1])
+
+
+    def __append(self, items):
+        '''
+        @param list items [(key, value, expire time, flags),]
+        '''
+        entry = b''.join(
+            self.__entry(md5(self.__toBytes(key)).digest(), value, expires, flags)
+            for key, value, expires, flags in items
+        )
+        with self.__lock:
+            self.__lockFile()
+            try:
+                # index the entries of other processes first so the index
+                # ends up pointing to the latest entry
+                end  = self.__scan()
+                size = os.fstat(self.__fd).st_size
+                if size > end and fcntl is not None:
+                    # all writers hold the file lock, so this is the remains
+                    # of a writer which died while appending
+                    os.ftruncate(self.__fd, end)
+                os.write(self.__fd, entry)
+                self.__scan()
+            finally:
+                self.__unlockFile()
+
+            end = self.__state[2]
+            start_compaction = \
+                not self.__compacting and \
+                end > self.compact_min_bytes and \
+                self.__garbage > end * self.compact_ratio
+            if start_compaction:
+                self.__compacting = True
+
+        if start_compaction:
+            thread = threading.Thread(target=self.__compactInBackground)
+            thread.daemon = True
+            thread.start()
+
+
+    def __compactInBackground(self):
+        try:
+            self.compact()
+        except Exception:
+            pass
+        finally:
+            self.__compacting = False
+
+
+    def __entry(self, digest, value, expires, flags):
+        value = bytes(value)
+        crc   = zlib.crc32(digest + value) & 0xffffffff
+        return self.HEADER.pack(self.MAGIC, flags, len(value), expires, crc, digest) + value
+
+
+    def __replace(self, entries):
+        '''
+        Replace the file with one containing the entries, the caller must
+        hold both locks
+        '''
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        fp = open(tmp_path, 'wb')
+        try:
+            for entry in entries:
+                fp.write(entry)
+        finally:
+            fp.close()
+        os.rename(tmp_path, self.path)
+        # closing the old file releases its lock, take the lock of the new one
+        self.__open()
+        self.__lockFile()
+
+
+    def __open(self):
+        '''
+        (Re)open the file and build the index, the caller must hold the lock
+        '''
+        if self.__fd is not None:
+            # the old memory map stays valid until no reader uses it
+            os.close(self.__fd)
+        self.__fd        = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.__inode     = os.fstat(self.__fd).st_ino
+        self.__garbage   = 0
+        self.__refreshed = time.time()
+        # readers use the old index until the new file is indexed
+        self.__state     = self.__scanState((None, {}, 0))
+
+
+    def __refresh(self):
+        '''
+        Index the entries appended by other processes, reopen the file if it
+        has been replaced by a compaction
+        @return bool true if the index has changed
+        '''
+        self.__refreshed = time.time()
+        if not self.__isReplaced() and \
+           os.fstat(self.__fd).st_size <= self.__state[2]:
+            return False
+        with self.__lock:
+            if self.__isReplaced():
+                self.__open()
+                return True
+            end = self.__state[2]
+            return self.__scan() > end
+
+
+    def __isReplaced(self):
+        try:
+            return os.stat(self.path).st_ino != self.__inode
+        except OSError:
+            return True
+
+
+    def __scan(self):
+        '''
+        Index the complete entries after the last indexed one, the caller
+        must hold the lock
+        @return int the end of the last complete entry
+        '''
+        self.__state = self.__scanState(self.__state)
+        return self.__state[2]
+
+
+    def __scanState(self, state):
+        '''
+        Index the complete entries after the last indexed one of a state, the
+        caller must hold the lock
+        @param  tuple state (memory map, index, end of the last indexed entry)
+        @return tuple the new state, its index is the one of the given state
+        '''
+        mapped = self.__remap(state)
+        index, end = state[1:]
+        size   = len(mapped) if mapped is not None else 0
+        while end + self.HEADER.size <= size:
+            magic, flags, length, expires, crc, digest = \
+                self.HEADER.unpack_from(mapped, end)
+            offset = end + self.HEADER.size
+            if magic != self.MAGIC or offset + length > size or \
+               zlib.crc32(digest + mapped[offset:offset + length]) & 0xffffffff != crc:
+                # incomplete entry, being written by another process
+                break
+
+            old = index.pop(digest, None)
+            if old is not None:
+                self.__garbage += self.HEADER.size + old[1]
+            if flags & self.FLAG_DELETED:
+                self.__garbage += self.HEADER.size
+            else:
+                index[digest] = (offset, length, expires)
+            end = offset + length
+
+        return (mapped, index, end)
+
+
+    def __remap(self, state=None):
+        '''
+        Map the whole file if it has grown, the caller must hold the lock
+        @param  tuple state the state to map the file for, None = the current
+                            state, which is updated
+        @return the memory map or None if the file is empty
+        '''
+        size = os.fstat(self.__fd).st_size
+        mapped, index, end = self.__state if state is None else state
+        if size and (mapped is None or len(mapped) < size):
+            mapped = mmap.mmap(self.__fd, size, access=mmap.ACCESS_READ)
+            if state is None:
+                self.__state = (mapped, index, end)
+        return mapped
+
+
+    def __lockFile(self):
+        '''
+        Take the file lock shared with other processes, the caller must hold
+        the lock. The file is reopened if another process has replaced it.
+        '''
+        while True:
+            if fcntl is not None:
+                fcntl.flock(self.__fd, fcntl.LOCK_EX)
+            if not self.__isReplaced():
+                return
+            if fcntl is not None:
+                fcntl.flock(self.__fd, fcntl.LOCK_UN)
+            self.__open()
+
+
+    def __unlockFile(self):
+        if fcntl is not None:
+            fcntl.flock(self.__fd, fcntl.LOCK_UN)
+
+
+    def __toBytes(self, value):
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, bytearray):
+            return bytes(value)
+        return value.encode('utf-8')
+
+
+class SharedMemoryCache:
+    '''
+    Cache shared by the processes of a host (e.g. the workers of a pre-fork
+    server) through a memory mapped file, put it in /dev/shm to keep it in
+    memory. The file is a fixed size hash table: the md5 of a key picks a
+    bucket of ways slots and the key can only be stored in those slots, so a
+    lookup reads at most ways slot headers. Readers take no lock, each slot
+    has a sequence number which writers make odd while they change the slot
+    (a seqlock) and a reader retries if the number was odd or changed while
+    it copied the value. Writers lock the bucket, with fcntl.lockf() of its
+    byte range where available and a thread lock. A full bucket evicts with
+    the clock algorithm: a read sets the reference bit of the slot, the hand
+    of the bucket clears the bits of the referenced slots it passes and
+    stops at the first slot not referenced since the last pass.
+
+    file:   header (MAGIC, version, bucket count, ways, slot bytes), buckets
+    bucket: clock hand (padded to 8 bytes), ways x slot
+    slot:   header (sequence, reference bit, value length, expire time, key
+            digest) + value padded to slot bytes
+    '''
+
+    MAGIC         = b'DASM'
+    VERSION       = 1
+    HEADER        = struct.Struct('>4sBxxxIII')
+    BUCKET_HEADER = 8
+    SLOT          = struct.Struct('>IBxxxId16s')
+    SEQUENCE      = struct.Struct('>I')
+    # offset of the reference bit in the slot header
+    REFERENCED    = 4
+    READ_RETRIES  = 3
+
+    def __init__(self, path, slots=16384, slot_bytes=2048, ways=8, expiry_sec=86400):
+        '''
+        The geometry arguments are used when the file is created, processes
+        opening an existing file use its geometry
+        @param string path       cache file path, the directory is created if missing
+        @param int    slots      number of items the cache can hold
+        @param int    slot_bytes bytes per item, larger values are not cached
+        @param int    ways       slots per bucket (a key can be in one of them)
+        @param int    expiry_sec default lifetime of an item in seconds
+        '''
+        self.path       = path
+        self.expiry_sec = expiry_sec
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+        self.rejected   = 0
+        self.__lock     = threading.Lock()
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name, mode=0o755)
+
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self.__lockRange(0, 0)
+            try:
+                header = os.read(self.__fd, self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    header = self.__create(slots, slot_bytes, ways)
+            finally:
+                self.__unlockRange(0, 0)
+            magic, version, self.buckets, self.ways, self.slot_bytes = \
+                self.HEADER.unpack(header)
+            if magic != self.MAGIC:
+                raise Exception('"%s" is not a shared memory cache' % path)
+            if version > self.VERSION:
+                raise Exception('Unsupported shared memory cache version %d' % version)
+            self.capacity     = self.slot_bytes - self.SLOT.size
+            self.bucket_bytes = self.BUCKET_HEADER + self.ways * self.slot_bytes
+            self.__map = mmap.mmap(
+                self.__fd, self.HEADER.size + self.buckets * self.bucket_bytes
+            )
+        except Exception:
+            os.close(self.__fd)
+            raise
+
+
+    def __len__(self):
+        '''
+        @return int number of live items, counted by scanning all the slots
+        '''
+        count = 0
+        now   = time.time()
+        for bucket in range(self.buckets):
+            offset = self.HEADER.size + bucket * self.bucket_bytes + self.BUCKET_HEADER
+            for way in range(self.ways):
+                length, expires = self.SLOT.unpack_from(self.__map, offset)[2:4]
+                if length and expires >= now:
+                    count += 1
+                offset += self.slot_bytes
+        return count
+
+
+    def get(self, key):
+        '''
+        Get an item without taking a lock
+        @return bytes the cached value or None if not cached or expired
+        '''
+        digest = md5(self.__toBytes(key)).digest()
+        mapped = self.__map
+        for attempt in range(self.READ_RETRIES):
+            offset = self.__find(digest)
+            if offset is None:
+                break
+            sequence, referenced, length, expires, slot_digest = \
+                self.SLOT.unpack_from(mapped, offset)
+            if sequence & 1:
+                # a writer is changing the slot
+                continue
+            start = offset + self.SLOT.size
+            value = mapped[start:start + min(length, self.capacity)]
+            if self.SEQUENCE.unpack_from(mapped, offset)[0] != sequence or \
+               slot_digest != digest:
+                continue
+            if expires < time.time():
+                break
+            if not referenced:
+                mapped[offset + self.REFERENCED:offset + self.REFERENCED + 1] = b'\x01'
+            self.hits += 1
+            return bytes(value)
+
+        self.misses += 1
+        return None
+
+
+    def set(self, key, value, expiry_sec=None):
+        '''
+        Put an item into the slot holding the key, an empty or expired slot
+        of its bucket or the slot chosen by the clock hand
+        @param bytes value
+        @param int   expiry_sec lifetime of the item, None = use the default
+        @return      bool false if the value is larger than a slot
+        '''
+        value = self.__toBytes(value)
+        if len(value) > self.capacity:
+            self.rejected += 1
+            return False
+        if expiry_sec is None:
+            expiry_sec = self.expiry_sec
+        digest = md5(self.__toBytes(key)).digest()
+        bucket = self.__bucket(digest)
+        with self.__lock:
+            self.__lockRange(bucket, self.bucket_bytes)
+            try:
+                offset = self.__find(digest)
+                if offset is None:
+                    offset = self.__evict(bucket)
+                self.__write(offset, value, time.time() + expiry_sec, digest)
+            finally:
+                self.__unlockRange(bucket, self.bucket_bytes)
+        return True
+
+
+    def delete(self, key):
+        '''
+        Remove an item
+        '''
+        digest = md5(self.__toBytes(key)).digest()
+        bucket = self.__bucket(digest)
+        with self.__lock:
+            self.__lockRange(bucket, self.bucket_bytes)
+            try:
+                offset = self.__find(digest)
+                if offset is not None:
+                    self.__write(offset, b'', 0, b'\0' * 16)
+            finally:
+                self.__unlockRange(bucket, self.bucket_bytes)
+
+
+    def close(self):
+        self.__map.close()
+        os.close(self.__fd)
+
+
+    def __create(self, slots, slot_bytes, ways):
+        '''
+        Size a new (zero filled) file and write its header, the caller must
+        hold the file lock
+        @return bytes header
+        '''
+        ways       = max(1, min(ways, 255))
+        buckets    = max(1, (slots + ways - 1) // ways)
+        slot_bytes = max(slot_bytes, self.SLOT.size + 1)
+        header     = self.HEADER.pack(self.MAGIC, self.VERSION, buckets, ways, slot_bytes)
+        os.ftruncate(
+            self.__fd,
+            self.HEADER.size + buckets * (self.BUCKET_HEADER + ways * slot_bytes)
+        )
+        os.lseek(self.__fd, 0, os.SEEK_SET)
+        os.write(self.__fd, header)
+        return header
+
+
+    def __bucket(self, digest):
+        '''
+        @return int offset of the bucket of a key digest
+        '''
+        return self.HEADER.size + \
+            struct.unpack('>Q', digest[:8])[0] % self.buckets * self.bucket_bytes
+
+
+    def __find(self, digest):
+        '''
+        @return int offset of the slot holding the key digest or None
+        '''
+        offset = self.__bucket(digest) + self.BUCKET_HEADER
+        for way in range(self.ways):
+            # the digest is the last field of the slot header
+            if self.__map[offset + self.SLOT.size - 16:offset + self.SLOT.size] == digest:
+                return offset
+            offset += self.slot_bytes
+        return None
+
+
+    def __evict(self, bucket):
+        '''
+        Choose the slot for a new key, the caller must hold the bucket lock
+        @return int slot offset
+        '''
+        mapped = self.__map
+        first  = bucket + self.BUCKET_HEADER
+        now    = time.time()
+        for way in range(self.ways):
+            offset = first + way * self.slot_bytes
+            length, expires = self.SLOT.unpack_from(mapped, offset)[2:4]
+            if not length or expires < now:
+                return offset
+
+        hand = bytearray(mapped[bucket:bucket + 1])[0] % self.ways
+        while True:
+            offset = first + hand * self.slot_bytes
+            hand   = (hand + 1) % self.ways
+            if bytearray(mapped[offset + self.REFERENCED:offset + self.REFERENCED + 1])[0]:
+                mapped[offset + self.REFERENCED:offset + self.REFERENCED + 1] = b'\x00'
+                continue
+            mapped[bucket:bucket + 1] = bytes(bytearray((hand,)))
+            self.evictions += 1
+            return offset
+
+
+    def __write(self, offset, value, expires, digest):
+        '''
+        Change a slot, readers see the odd sequence number until it is done
+        '''
+        mapped   = self.__map
+        sequence = self.SEQUENCE.unpack_from(mapped, offset)[0] | 1
+        self.SEQUENCE.pack_into(mapped, offset, sequence)
+        start = offset + self.SLOT.size
+        mapped[start:start + len(value)] = value
+        self.SLOT.pack_into(mapped, offset, sequence, 0, len(value), expires, digest)
+        self.SEQUENCE.pack_into(mapped, offset, (sequence + 1) & 0xffffffff)
+
+
+    def __lockRange(self, start, length):
+        if fcntl is not None:
+            fcntl.lockf(self.__fd, fcntl.LOCK_EX, length, start)
+
+
+    def __unlockRange(self, start, length):
+        if fcntl is not None:
+            fcntl.lockf(self.__fd, fcntl.LOCK_UN, length, start)
+
+
+    def __toBytes(self, value):
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, bytearray):
+            return bytes(value)
+        return value.encode('utf-8')
+
+
+class WriteBehindQueue:
+    '''
+    Thread safe buffer of cache writes which a background thread flushes in
+    batches, as soon as max_batch items are pending or flush_sec after the
+    first pending write. A newer write of a key replaces the pending one and
+    pending items can be read (get) until they are written. When max_items
+    are pending the writing thread flushes a batch itself so the memory
+    stays bounded. The queue is drained and its thread stopped when the
+    interpreter exits.
+    '''
+
+    def __init__(self, write, max_batch=100, flush_sec=0.5, max_items=10000):
+        '''
+        @param function write     writes a batch, called with a list of
+                                  (key, item) by one thread at a time
+        @param int      max_batch max number of items written at once
+        @param float    flush_sec max seconds an item waits to be written
+        @param int      max_items max number of pending items
+        '''
+        self.write      = write
+        self.max_batch  = max_batch
+        self.flush_sec  = flush_sec
+        self.max_items  = max_items
+        self.flushes    = 0
+        self.errors     = 0
+        self.__items    = OrderedDict()
+        # the batch being written, still visible to get()
+        self.__flushing = {}
+        self.__condition = threading.Condition()
+        self.__flushLock = threading.Lock()
+        self.__thread    = None
+        self.__closed    = False
+        atexit.register(self.close)
+
+
+    def __len__(self):
+        with self.__condition:
+            return len(self.__items) + len(self.__flushing)
+
+
+    def put(self, key, item):
+        '''
+        Queue an item to be written
+        '''
+        with self.__condition:
+            self.__items.pop(key, None)
+            self.__items[key] = item
+            pending = len(self.__items)
+            if pending == 1 or pending >= self.max_batch:
+                self.__condition.notify()
+            if self.__thread is None and not self.__closed:
+                self.__thread = threading.Thread(target=self.__run)
+                self.__thread.daemon = True
+                self.__thread.start()
+        if pending >= self.max_items:
+            self.flush()
+
+
+    def get(self, key):
+        '''
+        @return the pending item or None if the key is not waiting to be written
+        '''
+        with self.__condition:
+            item = self.__items.get(key)
+            if item is None:
+                item = self.__flushing.get(key)
+            return item
+
+
+    def flush(self):
+        '''
+        Write one batch of the pending items now, errors are raised
+        @return int number of items written
+        '''
+        with self.__flushLock:
+            with self.__condition:
+                while self.__items and len(self.__flushing) < self.max_batch:
+                    key, item = self.__items.popitem(last=False)
+                    self.__flushing[key] = item
+                batch = list(self.__flushing.items())
+            if not batch:
+                return 0
+            try:
+                self.write(batch)
+            finally:
+                with self.__condition:
+                    self.__flushing = {}
+                self.flushes += 1
+            return len(batch)
+
+
+    def drain(self):
+        '''
+        Write all the pending items, errors are ignored
+        '''
+        while True:
+            try:
+                if not self.flush():
+                    return
+            except Exception as err:
+                self.errors += 1
+
+
+    def close(self):
+        '''
+        Stop the background thread and write all the pending items, later
+        writes are flushed by the writing threads
+        '''
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+            thread = self.__thread
+        if thread is not None:
+            thread.join(self.flush_sec + 1)
+        self.max_items = 1
+        self.drain()
+
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__items and not self.__closed:
+                    self.__condition.wait()
+                if len(self.__items) < self.max_batch and not self.__closed:
+                    self.__condition.wait(self.flush_sec)
+                closed = self.__closed
+            self.drain()
+            if closed:
+                return
+
+
+class Metrics:
+    '''
+    Metrics interface of the Client, this implementation ignores everything.
+    Set Client.metrics to an object with these methods, e.g. InMemoryMetrics
+    or an adapter to a monitoring system, to collect the figures. Names are
+    dotted e.g. "cache.memcache.hits", durations are in milliseconds.
+    '''
+
+    def increment(self, name, value=1):
+        '''
+        Add to a counter
+        '''
+        pass
+
+
+    def observe(self, name, value):
+        '''
+        Add a value (a duration or a size) to a histogram
+        '''
+        pass
+
+
+    def snapshot(self, reset=False):
+        '''
+        @param bool reset true = start counting from zero again
+        @return     dict {counters: {name: count,},
+                          histograms: {name: {count:, sum:, min:, max:, mean:,
+                                              p50:, p90:, p99:,
+                                              buckets: [(upper bound, count),]},}}
+        '''
+        return {'counters': {}, 'histograms': {}}
+
+
+class InMemoryMetrics(Metrics):
+    '''
+    Thread safe metrics kept in the process. Histograms count values in
+    power of two buckets, percentiles are estimated as the upper bound of the
+    bucket they fall into (but not more than the largest value).
+    '''
+
+    BUCKETS = tuple(2 ** i for i in range(31))
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters   = {}
+        # name > [count, sum, min, max, bucket counts]
+        self.__histograms = {}
+
+
+    def increment(self, name, value=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+
+    def observe(self, name, value):
+        bucket = 0
+        while bucket < len(self.BUCKETS) - 1 and value > self.BUCKETS[bucket]:
+            bucket += 1
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = \
+                    [0, 0, value, value, [0] * len(self.BUCKETS)]
+            histogram[0] += 1
+            histogram[1] += value
+            histogram[2]  = min(histogram[2], value)
+            histogram[3]  = max(histogram[3], value)
+            histogram[4][bucket] += 1
+
+
+    def snapshot(self, reset=False):
+        with self.__lock:
+            counters   = dict(self.__counters)
+            histograms = dict(
+                (name, [x for x in histogram[:4]] + [list(histogram[4])])
+                for name, histogram in self.__histograms.items()
+            )
+            if reset:
+                self.__counters   = {}
+                self.__histograms = {}
+
+        for name, (count, total, low, high, buckets) in histograms.items():
+            histograms[name] = {
+                'count':   count,
+                'sum':     total,
+                'min':     low,
+                'max':     high,
+                'mean':    float(total) / count,
+                'p50':     self.__percentile(buckets, count, high, 0.5),
+                'p90':     self.__percentile(buckets, count, high, 0.9),
+                'p99':     self.__percentile(buckets, count, high, 0.99),
+                'buckets': [
+                    (self.BUCKETS[i], n) for i, n in enumerate(buckets) if n
+                ],
+            }
+        return {'counters': counters, 'histograms': histograms}
+
+
+    def __percentile(self, buckets, count, high, rank):
+        seen = 0
+        for i, n in enumerate(buckets):
+            seen += n
+            if seen >= count * rank:
+                return min(self.BUCKETS[i], high)
+        return high
+
+
+class HeaderTables:
+    '''
+    Header name tables of a Client configuration, built once and shared by
+    all requests. Raw header names of any form (WSGI environ and Django META
+    names like HTTP_X_WAP_PROFILE, HTTP names like X-Wap-Profile or legacy
+    names like x_wap_profile) are mapped to the standard form through a memo
+    of the names seen, so a request costs one dict lookup per header. The
+    "DeviceAtlas Client Side Component" cookie is found without splitting
+    the other cookies.
+    '''
+
+    # max number of distinct raw header names remembered
+    MAX_NAMES = 4096
+
+    def __init__(self, essential, user_agent, extra, cookie_name, da_prefix):
+        '''
+        @param tuple  essential   Client.ESSENTIAL_HEADERS
+        @param tuple  user_agent  Client.ESSENTIAL_USER_AGENT_HEADERS
+        @param tuple  extra       Client.EXTRA_HEADERS
+        @param string cookie_name Client.CLIENT_COOKIE_NAME
+        @param string da_prefix   Client.DA_HEADER_PREFIX
+        '''
+        self.source      = (essential, user_agent, extra, cookie_name, da_prefix)
+        self.cookie_name = cookie_name
+        self.legacy      = {
+            'user_agent': 'HTTP_USER_AGENT',
+            'cookie':     'HTTP_COOKIE',
+        }
+        for header in essential + user_agent + extra:
+            self.legacy[header.lower().replace('http_', '')] = header
+        # raw header name > standard name or None if not used
+        self.names       = {}
+        # (standard name, cloud request header name) of the headers sent
+        self.cloud       = tuple(
+            (header, da_prefix + self.__cloudName(header))
+            for header in essential + user_agent
+        )
+        self.cloud_extra = tuple(
+            (header, da_prefix + self.__cloudName(header)) for header in extra
+        )
+        # starts with the name so the regular expression engine can search
+        # the name as a literal
+        self.cookie      = re.compile(re.escape(cookie_name) + r'\s*=([^;]*)')
+
+
+    def normalize(self, headers):
+        '''
+        @param  dict headers any mapping of raw header names, it is not copied
+        @return dict {standard name: value} of the headers the client uses
+        '''
+        names   = self.names
+        results = {}
+        for header in headers:
+            name = names.get(header, False)
+            if name is False:
+                name = self.legacy.get(
+                    header.lower().replace('-', '_').replace('http_', '')
+                )
+                if len(names) < self.MAX_NAMES:
+                    names[header] = name
+            if name is not None:
+                results[name] = headers[header]
+        return results
+
+
+    def getCookie(self, cookies):
+        '''
+        @param  string cookies the Cookie header
+        @return string value of the client side component cookie, '' if none
+        '''
+        value = ''
+        for match in self.cookie.finditer(cookies):
+            # the name must start a cookie, the last cookie of the name wins
+            start = match.start()
+            if not cookies[cookies.rfind(';', 0, start) + 1:start].strip():
+                value = match.group(1).strip()
+        return value
+
+
+    def getCloudHeaders(self, headers, extra=False):
+        '''
+        @param  dict headers standard request headers
+        @param  bool extra   true = add EXTRA_HEADERS
+        @return dict {X-DA-header-name: value,}
+        '''
+        results = {}
+        if headers:
+            for header, cloud_header in self.cloud_extra if extra else self.cloud:
+                if header in headers:
+                    results[cloud_header] = headers[header]
+        return results
+
+
+    def __cloudName(self, header):
+        '''
+        Converts HTTP header names from HTTP_HEADER_NAME to header-name
+        '''
+        if header.startswith('HTTP_'):
+            header = header[5:]
+        return header.lower().replace('_', '-')
+
+
+class RequestContext:
+    '''
+    State of one device data lookup. A Client keeps the context of the
+    lookup running in each thread apart, so one Client object can be shared
+    by all threads of a process.
+    '''
+
+    def __init__(self, user_agent=None, headers=None, cookie=None):
+        '''
+        @param dict headers the normalized request headers
+        '''
+        self.userAgent    = user_agent
+        self.headers      = headers
+        self.cookie       = cookie
+        # the cloud server which gave the device data, None = from a cache
+        self.calledServer = None
+        # the canonical user agent, see Client.getCanonicalUserAgent()
+        self.canonicalUserAgent = None
+
+
+class LocalIndex:
+    '''
+    Read only device index used without network calls. User agents are
+    split into tokens and the entries are sorted by their token sequence, a
+    user agent is matched to the entry sharing the longest token prefix with
+    it (one of the two entries next to its sorted position). The file is
+    memory mapped and searched in place so it loads in no time, property
+    records are stored once in the RecordCodec format and shared by all user
+    agents giving the same device data.
+
+    file:    header (MAGIC, version, entry count, record count), entry table
+             (key offset, key length, record number) sorted by key, record
+             table (offset, length), keys and records
+    key:     tokens of the canonical user agent, each followed by a zero byte
+    '''
+
+    MAGIC   = b'DAIX'
+    VERSION = 1
+    HEADER  = struct.Struct('>4sBxxxII')
+    ENTRY   = struct.Struct('>III')
+    RECORD  = struct.Struct('>II')
+    TOKENS  = re.compile(r'[^\s;()/,\[\]]+')
+
+    def __init__(self, path, codec=None, canonicalize=None):
+        '''
+        @param string          path         index file made by build()
+        @param RecordCodec     codec        None = a default RecordCodec
+        @param function        canonicalize applied to the user agents before
+                                            they are split, None = as they are
+        '''
+        self.path         = path
+        self.codec        = codec or RecordCodec()
+        self.canonicalize = canonicalize
+        fp = open(path, 'rb')
+        try:
+            self.__map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        magic, version, self.count, self.records = self.HEADER.unpack_from(self.__map, 0)
+        if magic != self.MAGIC:
+            raise Exception('"%s" is not a device index' % path)
+        if version > self.VERSION:
+            raise Exception('Unsupported device index version %d' % version)
+        self.__records = self.HEADER.size + self.count * self.ENTRY.size
+
+
+    def __len__(self):
+        return self.count
+
+
+    def lookup(self, user_agent, properties_key='properties'):
+        '''
+        Find the device data of the entry sharing the longest token prefix
+        with the user agent
+        @return tuple (device data or None, score = shared tokens / tokens of
+                       the longer of both, 1.0 = same token sequence)
+        '''
+        if not self.count:
+            return None, 0.0
+        tokens = self.tokenize(user_agent, self.canonicalize)
+        key    = self.makeKey(tokens)
+
+        # binary search of the first entry not less than the key
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.__key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        best = best_shared = None
+        for i in (low, low - 1):
+            if i < 0 or i >= self.count:
+                continue
+            entry_tokens = self.__key(i).split(b'\0')[:-1]
+            shared = 0
+            for token, entry_token in zip(tokens, entry_tokens):
+                if token != entry_token:
+                    break
+                shared += 1
+            score = float(shared) / max(len(tokens), len(entry_tokens), 1)
+            if best is None or score > best[1]:
+                best = (i, score)
+
+        if best is None or best[1] == 0:
+            return None, 0.0
+        return self.__record(best[0], properties_key), best[1]
+
+
+    @classmethod
+    def tokenize(cls, user_agent, canonicalize=None):
+        '''
+        @param  function canonicalize applied before splitting, None = no change
+        @return list of the tokens (bytes) of the user agent
+        '''
+        if canonicalize is not None:
+            user_agent = canonicalize(user_agent)
+        if isinstance(user_agent, bytes):
+            user_agent = user_agent.decode('utf-8', 'replace')
+        return [token.encode('utf-8') for token in cls.TOKENS.findall(user_agent)]
+
+
+    @classmethod
+    def makeKey(cls, tokens):
+        return b''.join(token + b'\0' for token in tokens)
+
+
+    @classmethod
+    def build(cls, path, items, codec=None, canonicalize=None, properties_key='properties'):
+        '''
+        Write an index file, the file is replaced atomically
+        @param list items iterable of (user agent, device data)
+        @return     int number of entries
+        '''
+        codec   = codec or RecordCodec()
+        entries = {}
+        records = []
+        record_numbers = {}
+        for user_agent, device_data in items:
+            if not device_data or properties_key not in device_data:
+                continue
+            record = codec.encode(
+                {properties_key: device_data[properties_key]}, properties_key
+            )
+            if record not in record_numbers:
+                record_numbers[record] = len(records)
+                records.append(record)
+            entries[cls.makeKey(cls.tokenize(user_agent, canonicalize))] = \
+                record_numbers[record]
+
+        keys   = sorted(entries)
+        offset = cls.HEADER.size + len(keys) * cls.ENTRY.size + \
+                 len(records) * cls.RECORD.size
+        table  = []
+        for key in keys:
+            table.append(cls.ENTRY.pack(offset, len(key), entries[key]))
+            offset += len(key)
+        record_table = []
+        for record in records:
+            record_table.append(cls.RECORD.pack(offset, len(record)))
+            offset += len(record)
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        fp = open(tmp_path, 'wb')
+        try:
+            fp.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(keys), len(records)))
+            for part in (table, record_table, keys, records):
+                for item in part:
+                    fp.write(item)
+        finally:
+            fp.close()
+        os.rename(tmp_path, path)
+        return len(keys)
+
+
+    def __key(self, i):
+        offset, length, record = self.ENTRY.unpack_from(
+            self.__map, self.HEADER.size + i * self.ENTRY.size
+        )
+        return self.__map[offset:offset + length]
+
+
+    def __record(self, i, properties_key):
+        record = self.ENTRY.unpack_from(
+            self.__map, self.HEADER.size + i * self.ENTRY.size
+        )[2]
+        offset, length = self.RECORD.unpack_from(
+            self.__map, self.__records + record * self.RECORD.size
+        )
+        return self.codec.decode(self.__map[offset:offset + length], properties_key)
+
+
+class Client:
+
+    ############### BASIC SETUP ################################################
+
+    LICENCE_KEY = 'paste-licence-key-here'
+
+    # true:  server preference is decided by the API (faster server is preferred) 
+    # false: server preference is SERVERS sort order (top server is preferred)
+    AUTO_SERVER_RANKING = True
+
+    # list of cloud service provider end points
+    # server preference is decided from this list
+    SERVERS = (
+        {'host': 'region0.deviceatlascloud.com', 'port': 80},
+        {'host': 'region1.deviceatlascloud.com', 'port': 80},
+        {'host': 'region2.deviceatlascloud.com', 'port': 80},
+        {'host': 'region3.deviceatlascloud.com', 'port': 80},
+    )
+
+    ############### ADVANCED SETUP #############################################
+    # edit these if you want to tweak behaviour
+
+    DEBUG = False
+    # build in test user agent
+    TEST_USERAGENT        = 'Mozilla/5.0 (Linux; U; Android 2.3.3; en-gb; GT-I9100 Build/GINGERBREAD) AppleWebKit/533.1 (KHTML, like Gecko) Version/4.0 Mobile Safari/533.1'
+    # time (seconds) to wait for each cloud server to give service
+    CLOUD_SERVICE_TIMEOUT = 2
+    # reuse keep-alive connections to the cloud servers instead of opening a
+    # new connection for each request
+    USE_CONNECTION_POOL   = True
+    # connection pool > max number of idle connections kept per server
+    CONNECTION_POOL_SIZE  = 4
+    # connection pool > idle connections older than this (seconds) are closed
+    CONNECTION_POOL_IDLE_TIMEOUT = 60
+    # max number of cloud requests running at the same time (batch lookups)
+    CLOUD_SERVICE_MAX_CONCURRENCY = 8
+    # true:  if a server does not answer within the hedge delay the request is
+    #        also sent to the next server, the first valid answer is used
+    # false: servers are tried one after another
+    CLOUD_SERVICE_HEDGED  = False
+    # time (seconds) to wait for a server before sending a hedged request, the
+    # slowest latency measured when ranking the server is used if known
+    CLOUD_SERVICE_HEDGE_DELAY = 0.3
+    # max hedged requests in flight in the process (requests sent while the
+    # first request of their call is still running), when reached the calls
+    # wait for their running request instead of hedging
+    CLOUD_SERVICE_MAX_HEDGES = 8
+    # use device data which is created by the DeviceAtlas Client Side Component if exists
+    USE_CLIENT_COOKIE     = True
+    # memcache cloud results in files (Must use on Google App Engine)
+    USE_MEMCACHE         = True
+    # cache cloud results in files
+    USE_FILE_CACHE        = False
+    # ordered cache tiers checked before calling the cloud, any of
+    # 'localcache' (in-process), 'sharedcache' (shared by the processes of
+    # the host), 'memcache' and 'cache' (files) e.g.
+    # ('localcache', 'memcache', 'cache'). A hit is copied to the tiers above
+    # the one which served it and cloud results are written to all tiers.
+    # None = USE_LOCAL_CACHE, USE_SHARED_CACHE, then USE_MEMCACHE or else
+    # USE_FILE_CACHE
+    CACHE_TIERS           = None
+    # write the cache tiers (other than the in-process cache) in a background
+    # thread instead of before returning the results
+    CACHE_WRITE_BACKGROUND = False
+    # queue the writes of the cache tiers (other than the in-process cache)
+    # and write them in batches from a background thread, memcache items with
+    # one set_multi() and indexed file cache items with one append. Queued
+    # items are served by this process until they are written
+    CACHE_WRITE_BEHIND    = False
+    # write behind > max number of items written at once
+    CACHE_WRITE_BEHIND_BATCH = 100
+    # write behind > max seconds an item is queued
+    CACHE_WRITE_BEHIND_SEC = 0.5
+    # write behind > max number of queued items, when reached the request
+    # writes a batch itself
+    CACHE_WRITE_BEHIND_MAX_ITEMS = 10000
+    # memcache expire (for both file and cookie) 2592000 = 30 days in seconds
+    MEMCACHE_ITEM_EXPIRY_SEC = 2592000
+    # stale while revalidate > cached items older than this (seconds) are still
+    # returned (_source gets the SOURCE_STALE_SUFFIX) and refreshed from the
+    # cloud in a background thread, the item expiry times above are the hard
+    # limits. 0 = off, items are used as they are until they expire
+    CACHE_SOFT_EXPIRY_SEC = 0
+    # stale while revalidate > if the refresh fails serve the stale item for
+    # this long (seconds) before trying again
+    CACHE_STALE_RETRY_SEC = 300
+    # cache expire (for both file and cookie) 2592000 = 30 days in seconds
+    CACHE_ITEM_EXPIRY_SEC = 2592000
+    # cache device data as compact binary records instead of dictionaries
+    # (memcache) or JSON (file cache), both formats are always readable
+    USE_COMPACT_RECORDS   = False
+    # compact records > zlib compress large records
+    COMPACT_RECORDS_COMPRESS = False
+    # return the properties as a read only DeviceProperties mapping which
+    # shares the cached payload instead of a new dictionary per call, the
+    # values of compact records are decoded when they are read. Use
+    # properties.copy() where a real dictionary is needed (e.g. json.dumps)
+    USE_LAZY_RESULTS      = False
+    # file cache > directory name
+    CACHE_NAME            = 'deviceatlas_cache_py'
+    # file cache > keep all items in one indexed file instead of one file per
+    # item, see DiskCache
+    FILE_CACHE_INDEXED    = False
+    # file cache > indexed file > compact when this part of the file is garbage
+    FILE_CACHE_COMPACT_RATIO = 0.5
+    # memcache > prefix name
+    MEMCACHE_KEY_PREFIX   = 'deviceAtlas_'
+    # memcache > key for server rankings
+    MEMCACHE_KEY_SERVER_RANKS = 'deviceAtlas_serverRanks'
+    # file cache > leave as true to put cache in systems default temp directory
+    USE_SYSTEM_TEMP_DIR   = True
+    # file cache > this is only used if USE_SYSTEM_TEMP_DIR is false
+    CUSTOM_CACHE_DIR      = '/path/to/your/cache/'
+    # remove user agent tokens which do not affect detection (app builds,
+    # in-app browser suffixes, locales, tracking ids) before creating cache
+    # keys, so more requests share a cache item
+    USE_UA_CANONICALIZATION = False
+    # ua canonicalization > ordered rules (name, regular expression, replacement)
+    UA_CANONICALIZATION_RULES = (
+        # Facebook in-app browser suffix "[FBAN/FBIOS;FBDV/iPhone10,3;...]"
+        ('facebook',     r'\s*\[(?:FBAN|FB_IAB|FBAV)/[^\]]*\]', ''),
+        # Instagram in-app browser suffix "Instagram 123.0.0.21.114 (...)"
+        ('instagram',    r'\s*Instagram [\d.]+(?: \([^)]*\))?', ''),
+        # app build numbers "Build/GINGERBREAD", "Build/QP1A.190711.020"
+        ('build',        r' Build/[^;)]+', ''),
+        # locale fragments "; en-gb" or "; zh_CN"
+        ('locale',       r';\s*[a-z]{2}[-_][a-zA-Z]{2}(?=[;)])', ''),
+        # random tracking ids: uuids and long hex strings
+        ('uuid',         r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b', ''),
+        ('hex',          r'\b[0-9a-fA-F]{16,}\b', ''),
+        ('whitespace',   r'\s{2,}', ' '),
+    )
+    # ua canonicalization > share (0-1) of cloud requests which also fetch the
+    # canonical user agent to verify both give the same properties, 0 = off
+    UA_CANONICALIZATION_VERIFY_RATE = 0
+    # local device index file used without network calls, it is built from
+    # the cached device data with "python ClientGAE.py build-index", None = off
+    LOCAL_INDEX_PATH      = None
+    # local index > answer without calling the cloud if the user agent matches
+    # an index entry with at least this score (shared tokens / tokens, 1 = the
+    # same canonical user agent), more than 1 = only when the cloud fails
+    LOCAL_INDEX_MIN_SCORE = 1.0
+    # local index > min score of the match used if the cloud can not be reached
+    LOCAL_INDEX_FALLBACK_MIN_SCORE = 0.5
+    # true:  extra headers are sent with each request to the service
+    # false: only select headers which are essential for detection are sent
+    SEND_EXTRA_HEADERS    = False
+    # name of the cookie created by "DeviceAtlas Client Side Component"
+    CLIENT_COOKIE_NAME    = 'DAPROPS'
+    # true:  cloud results are cached (and requested) by user agent only, the
+    #        "DeviceAtlas Client Side Component" cookie properties are merged
+    #        into the results locally - fewer cache items and cloud calls
+    # false: the cookie is part of the cache key and is sent to the cloud
+    CACHE_BY_USER_AGENT_ONLY = False
+    # when ranking servers, if a server fails more than this number phase it out
+    AUTO_SERVER_RANKING_MAX_FAILURE  = 1
+    # number of requests to send when testing server latency
+    AUTO_SERVER_RANKING_NUM_REQUESTS = 3
+    # server preferred list will be updated when older than this amount of minutes
+    AUTO_SERVER_RANKING_LIFETIME     = 1440
+    # auto ranking = false > if top server fails it will be phased out for this amount of minutes
+    SERVER_PHASEOUT_LIFETIME         = 5
+    # memcache expire (for server rank) 300 = 5 mins in seconds
+    MEMCACHE_SERVER_RANKS_EXPIRY_SEC = 300
+    # phase out servers which keep failing (circuit breaker), a phased out
+    # server is skipped for SERVER_PHASEOUT_LIFETIME then one trial request
+    # decides if it is used again. When all the servers are phased out the
+    # requests are trial requests.
+    USE_CIRCUIT_BREAKER              = True
+    # circuit breaker > min number of failures within the window to phase out
+    CIRCUIT_BREAKER_MAX_FAILURES     = 3
+    # circuit breaker > min failure rate (0-1) within the window to phase out
+    CIRCUIT_BREAKER_FAILURE_RATE     = 0.5
+    # circuit breaker > requests older than this (seconds) are not counted
+    CIRCUIT_BREAKER_WINDOW_SEC       = 60
+    # circuit breaker > consecutive failures which phase out the server
+    # whatever the failure rate (a server hanging after a healthy period),
+    # 0 = off
+    CIRCUIT_BREAKER_MAX_CONSECUTIVE_FAILURES = 5
+    # memcache > key for the servers which are phased out
+    MEMCACHE_KEY_CIRCUITS            = 'deviceAtlas_serverCircuits'
+    # derive the timeout of each cloud request from the latencies observed
+    # for the server instead of always waiting CLOUD_SERVICE_TIMEOUT, so a
+    # stuck server is given up sooner. CLOUD_SERVICE_TIMEOUT is the ceiling
+    # and the timeout until enough latencies are known.
+    USE_ADAPTIVE_TIMEOUT             = True
+    # adaptive timeout > timeout = this factor x the p99 (or moving average
+    # if higher) latency of the server, halved for each request the server
+    # failed to answer since its last answer
+    ADAPTIVE_TIMEOUT_FACTOR          = 3
+    # adaptive timeout > the halved timeout is never shorter than this factor
+    # x the latest known p99 (or moving average if higher) latency of the
+    # server, a slow server which failed a few requests can still answer
+    ADAPTIVE_TIMEOUT_FAILURE_MARGIN  = 1.5
+    # adaptive timeout > the failures of a server stop halving its timeout
+    # this long (seconds) after the first of them, then the full timeout is
+    # tried again
+    ADAPTIVE_TIMEOUT_FAILURE_TTL_SEC = 60
+    # adaptive timeout > the timeout is never shorter than this (seconds)
+    ADAPTIVE_TIMEOUT_MIN_SEC         = 0.3
+    # adaptive timeout > latencies of a server needed before its timeout adapts
+    ADAPTIVE_TIMEOUT_MIN_SAMPLES     = 20
+    # adaptive timeout > latencies older than this (seconds) are forgotten
+    ADAPTIVE_TIMEOUT_MAX_AGE_SEC     = 300
+    # adaptive timeout > count the latencies measured when ranking servers too
+    ADAPTIVE_TIMEOUT_USE_PROBES      = True
+    # adaptive timeout > publish the latency estimates to memcache at most
+    # this often (seconds) so other instances can use them
+    ADAPTIVE_TIMEOUT_PUBLISH_SEC     = 30
+    # memcache > key for the server latency estimates
+    MEMCACHE_KEY_SERVER_LATENCIES    = 'deviceAtlas_serverLatencies'
+    # memcache > key of the lease held by the instance which ranks the servers
+    MEMCACHE_KEY_SERVER_RANKS_LEASE  = 'deviceAtlas_serverRanksLease'
+    # the ranking lease expires after this time (seconds) if not released
+    SERVER_RANKING_LEASE_SEC         = 60
+    # keep the most used results in an in-process LRU cache which is checked
+    # before memcache/file cache, the cache is shared by all Client objects
+    USE_LOCAL_CACHE                  = True
+    # local cache > max number of items, 0 = no limit
+    LOCAL_CACHE_MAX_ITEMS            = 1000
+    # local cache > max approximated size of all items in bytes, 0 = no limit
+    LOCAL_CACHE_MAX_BYTES            = 0
+    # local cache > item expire 3600 = 1 hour in seconds
+    LOCAL_CACHE_ITEM_EXPIRY_SEC      = 3600
+    # keep results in a memory mapped file shared by the processes of the
+    # host (e.g. pre-fork server workers, not on Google App Engine), checked
+    # after the local cache, see SharedMemoryCache
+    USE_SHARED_CACHE                 = False
+    # shared cache > file path, None = SHARED_CACHE_NAME in /dev/shm if it
+    # exists or else in the system temp dir
+    SHARED_CACHE_PATH                = None
+    # shared cache > file name
+    SHARED_CACHE_NAME                = 'deviceatlas_shared_cache_py'
+    # shared cache > max number of items, the file takes about
+    # SHARED_CACHE_SLOTS * SHARED_CACHE_SLOT_BYTES bytes
+    SHARED_CACHE_SLOTS               = 16384
+    # shared cache > bytes per item, larger (encoded) items are not cached
+    SHARED_CACHE_SLOT_BYTES          = 2048
+    # shared cache > item expire 86400 = 1 day in seconds
+    SHARED_CACHE_ITEM_EXPIRY_SEC     = 86400
+    # concurrent cache misses for the same device wait for one cloud request
+    # instead of each calling the cloud service
+    USE_SINGLE_FLIGHT                = True
+    # single flight > also take a memcache lease on the device key so other
+    # instances wait for the cloud request of the lease holder
+    SINGLE_FLIGHT_USE_LEASE          = False
+    # single flight > the lease expires after this time (seconds) if not released
+    SINGLE_FLIGHT_LEASE_SEC          = 10
+    # single flight > max time (seconds) to wait for another instance, then
+    # the cloud service is called anyway
+    SINGLE_FLIGHT_LEASE_WAIT_SEC     = 1
+    # single flight > interval (seconds) of checking memcache while waiting
+    SINGLE_FLIGHT_POLL_SEC           = 0.05
+
+    ############### END OF SETUP, do not edit below this point! ################
+
+
+    ############### CONSTANTS ##################################################
+    API_VERSION           = 'python/1.3'
+    # keys of dictionary returned by getDeviceData()
+    USERAGENT             = '_useragent'
+    SOURCE                = '_source'
+    ERROR                 = '_error'
+    PROPERTIES            = 'properties'
+    # device data source
+    SOURCE_COOKIE         = 'cookie'
+    SOURCE_LOCAL_CACHE    = 'localcache'
+    SOURCE_SHARED_CACHE   = 'sharedcache'
+    SOURCE_MEMCACHE     = 'memcache'
+    SOURCE_FILE_CACHE     = 'cache'
+    SOURCE_CLOUD          = 'cloud'
+    SOURCE_LOCAL_INDEX    = 'localindex'
+    # the cloud could not be reached, a less confident local index match
+    SOURCE_LOCAL_INDEX_FALLBACK = 'localindex-fallback'
+    SOURCE_NONE           = 'none'
+    # added to the source when the cached data is being refreshed
+    SOURCE_STALE_SUFFIX   = '-stale'
+    # cached device data key > time the data was fetched from the cloud
+    CACHED_AT             = '_cachedat'
+    # headers
+    DA_HEADER_PREFIX      = 'X-DA-'
+    CLIENT_COOKIE_HEADER  = 'Client-Properties'
+    # cloud service
+    CLOUD_PATH            = '/v1/detect/properties?licencekey=%s&useragent=%s'
+
+    # a list of headers from the end user to pass to DeviceAtlas Cloud. These
+    # help with detection, especially if a third party browser or a proxy
+    # changes the original user-agent.
+    ESSENTIAL_HEADERS = (
+        'HTTP_X_PROFILE',
+        'HTTP_X_WAP_PROFILE',
+        'HTTP_X_ATT_DEVICEID',
+        'HTTP_ACCEPT',
+        'HTTP_ACCEPT_LANGUAGE',
+    )
+    # a list of headers which may contain the original user agent.
+    # this headers are sent to cloud server beside ESSENTIAL_HEADERS
+    ESSENTIAL_USER_AGENT_HEADERS = (
+        'HTTP_X_DEVICE_USER_AGENT',
+        'HTTP_X_ORIGINAL_USER_AGENT',
+        'HTTP_X_OPERAMINI_PHONE_UA',
+        'HTTP_X_SKYFIRE_PHONE',
+        'HTTP_X_BOLT_PHONE_UA',
+        'HTTP_DEVICE_STOCK_UA',
+        'HTTP_X_UCBROWSER_DEVICE_UA',
+    )
+    # a list of additional headers to send to DeviceAtlas. These are not sent
+    # by default. These headers can be used for carrier detection and geoip.
+    EXTRA_HEADERS = (
+        'HTTP_CLIENT_IP',
+        'HTTP_X_FORWARDED_FOR',
+        'HTTP_X_FORWARDED',
+        'HTTP_FORWARDED_FOR',
+        'HTTP_FORWARDED',
+        'HTTP_PROXY_CLIENT_IP',
+        'HTTP_WL_PROXY_CLIENT_IP',
+        'REMOTE_ADDR',
+    )
+
+    # the objects shared by all Client objects are kept by the class of the
+    # Client objects, a subclass with other settings gets its own
+    # header name tables of the header lists above, see getHeaderTables()
+    headerTables   = None
+    # background thread ranking the servers, see startServerRanking()
+    rankingThread  = None
+    # in-process cache shared by all Client objects, see getLocalCache()
+    localCache     = None
+    # guards the creation of objects shared by all Client objects
+    sharedLock     = threading.Lock()
+    # keep-alive connections shared by all Client objects, see getConnectionPool()
+    connectionPool = None
+    # in-flight cloud requests shared by all Client objects, see getSingleFlight()
+    singleFlight   = None
+    # server circuit states shared by all Client objects, see getCircuitBreaker()
+    circuitBreaker = None
+    # server latency estimates shared by all Client objects, see getLatencyTracker()
+    latencyTracker = None
+    # time the latency estimates were last published to memcache
+    latenciesPublished = 0
+    # cache record codec shared by all Client objects, see getRecordCodec()
+    recordCodec    = None
+    # user agent canonicalizer shared by all Client objects,
+    # see getUserAgentCanonicalizer()
+    userAgentCanonicalizer = None
+    # indexed file cache shared by all Client objects, see getDiskCache()
+    diskCache      = None
+    # local device index shared by all Client objects, see getLocalIndex()
+    localIndex     = None
+    # memory mapped cache shared by all Client objects, see getSharedCache()
+    sharedCache    = None
+    # queued cache writes shared by all Client objects, see getWriteBehindQueue()
+    writeBehindQueue = None
+    # memcache keys of the stale items being refreshed, see checkStale()
+    staleRefreshes = set()
+    # canonical user agents being verified, see UA_CANONICALIZATION_VERIFY_RATE
+    canonicalVerifications = set()
+    # cloud fetches which outlived the budget of their lookup by memcache key,
+    # see fetchDeviceDataWithin()
+    backgroundFetches = {}
+    # hedged requests in flight, see CLOUD_SERVICE_MAX_HEDGES
+    hedgesInFlight = 0
+    # metrics of all Client objects, the default ignores them. Set to an
+    # InMemoryMetrics object (or an adapter to your monitoring system) to
+    # collect them, Client.metrics.snapshot() returns the figures
+    metrics        = Metrics()
+
+    pp = PrettyPrinter(indent=4)
+
+
+    def __init__(self):
+        # the RequestContext of the lookup running in each thread, see
+        # getRequestContext(). Everything else shared by the lookups is either
+        # read only or guarded by a lock.
+        self.__local = threading.local()
+
+
+    def beginRequest(self, user_agent, headers, cookie=None):
+        '''
+        Start a lookup in the current thread, methods called without headers
+        use the headers of this request
+        @param dict headers the normalized request headers
+        @return     RequestContext
+        '''
+        context = RequestContext(user_agent, headers, cookie)
+        self.__local.context = context
+        return context
+
+
+    def getRequestContext(self):
+        '''
+        Get the context of the lookup running in the current thread
+        @return RequestContext, an empty one if no lookup was started
+        '''
+        context = getattr(self.__local, 'context', None)
+        if context is None:
+            context = self.__local.context = RequestContext()
+        return context
+
+
+    def getDeviceData(self, headers={}, test_mode=False, budget_ms=None):
+        '''
+        Get device data from DeviceAtlas Cloud. Once data has been returned from
+        DeviceAtlas Cloud it can be cached locally to speed up subsequent requests.
+        If device data provided by "DeviceAtlas Client Side Component" exists in
+        a cookie then cloud data will be merged with the cookie data.
+        @param dict headers    a dictionary of HTTP headers set manually
+        @param bool test_mode  true = use a fake useragent to test and get results
+        @param int  budget_ms  max milliseconds to spend, None = no limit. When
+                               the budget runs out the data available is
+                               returned (cookie properties, a local index
+                               match or none) with an _error and the cloud
+                               fetch goes on in the background to fill the cache
+        @return     dictionary {properties: {name: value,}, _source: data-source,
+                            _useragent: string, _error: if-any-happens}
+        '''
+        deadline = None
+        if budget_ms is not None:
+            deadline = time.time() + budget_ms / 1000.0
+
+        if self.DEBUG:
+            print "getting Device Data"
+        user_agent, headers, cookie = self.prepareRequest(headers, test_mode)
+        cookie, cookie_properties   = self.splitClientCookie(cookie)
+        self.beginRequest(user_agent, headers, cookie)
+
+        # get device data from cache or cloud
+        results = {}
+        source  = self.SOURCE_NONE
+        try:
+            # check the cache tiers in order
+            results, source = self.getCachedDeviceData(
+                user_agent, cookie, headers, deadline
+            )
+
+            # the local index answers confident matches without network calls
+            if not results:
+                results, source = self.getLocalIndexData(user_agent, cookie)
+
+            # use cloud service to get data
+            if not results:
+                source  = self.SOURCE_CLOUD
+                try:
+                    if deadline is None:
+                        results, source = self.__fetchDeviceData(
+                            user_agent, cookie, headers
+                        )
+                    else:
+                        results, source = self.fetchDeviceDataWithin(
+                            user_agent, cookie, headers, deadline
+                        )
+                    if results is None:
+                        # out of budget, return what is available
+                        self.metrics.increment('deadline.exceeded')
+                        results, source = self.getLocalIndexData(
+                            user_agent, cookie, True
+                        )
+                        results = dict(results or {})
+                        if cookie_properties is None and cookie:
+                            # the cloud did not merge the cookie, whatever
+                            # the cache key is the caller gets its properties
+                            cookie_properties = self.parseClientCookie(cookie)
+                        results[self.ERROR] = \
+                            'DeviceAtlas lookup budget of %d ms exceeded, ' \
+                            'the device data is being fetched in the background' % budget_ms
+                        return self.completeResults(
+                            results, source, user_agent, cookie_properties
+                        )
+                except Exception as err:
+                    # degraded answer from the local index
+                    results, source = self.getLocalIndexData(user_agent, cookie, True)
+                    if not results:
+                        raise err
+                # the calls sharing a cloud request get the same results
+                results = self.copyDeviceData(results)
+
+            # decode json
+            if results:
+                if self.PROPERTIES not in results:
+                    raise Exception(
+                        'Can not get device properties from "%s"' % user_agent
+                    )
+            else:
+                results = {}
+    
+        except Exception as err:
+            results = {self.ERROR: str(err)}
+
+        return self.completeResults(results, source, user_agent, cookie_properties)
+
+
+    def getDeviceDataMulti(self, headers_list, test_mode=False):
+        '''
+        Get device data for a batch of requests. The memcache tier is checked
+        with one memcache.get_multi(), cache misses are fetched from DeviceAtlas
+        Cloud concurrently (at most CLOUD_SERVICE_MAX_CONCURRENCY at a time)
+        and cached with one memcache.set_multi().
+        @param list headers_list  a list of dictionaries of HTTP headers
+        @param bool test_mode     true = use a fake useragent to test and get results
+        @return     list of dictionaries formatted as getDeviceData() results,
+                    in the same order as headers_list
+        '''
+
+        if self.DEBUG:
+            print "getting Device Data for %d requests" % len(headers_list)
+        requests = []
+        for headers in headers_list:
+            user_agent, headers, cookie = self.prepareRequest(headers, test_mode)
+            cookie, cookie_properties   = self.splitClientCookie(cookie)
+            if self.USE_UA_CANONICALIZATION:
+                # counted once per request, the keys do not count it
+                self.getUserAgentCanonicalizer().canonicalize(user_agent)
+            requests.append({
+                'user_agent': user_agent,
+                'headers':    headers,
+                'cookie':     cookie,
+                'cookie_properties': cookie_properties,
+                'key':        self.getMemCacheHashKey(user_agent, cookie, headers),
+            })
+        results = [None] * len(requests)
+        sources = [self.SOURCE_NONE] * len(requests)
+        misses  = list(range(len(requests)))
+        tiers   = self.getCacheTiers()
+
+        # check the cache tiers in order, memcache is checked with a single call
+        for t, tier in enumerate(tiers):
+            if not misses:
+                break
+            if tier == self.SOURCE_MEMCACHE:
+                started = time.time()
+                try:
+                    cached = memcache.get_multi(
+                        list(set([requests[i]['key'] for i in misses]))
+                    )
+                except Exception as err:
+                    cached = {}
+                self.metrics.observe(
+                    'cache.memcache.get_multi_ms', (time.time() - started) * 1000
+                )
+            still_missing = []
+            for i in misses:
+                request = requests[i]
+                if tier == self.SOURCE_MEMCACHE:
+                    device_data = self.decodeRecord(cached.get(request['key']))
+                else:
+                    device_data = self.getCacheTier(
+                        tier, request['user_agent'], request['cookie'],
+                        request['headers']
+                    )
+                if device_data and self.PROPERTIES in device_data:
+                    self.metrics.increment('cache.' + tier + '.hits')
+                    results[i] = self.copyDeviceData(device_data)
+                    sources[i] = self.checkStale(
+                        request['user_agent'], request['cookie'], device_data,
+                        tier, request['headers']
+                    )
+                    # promote to the upper tiers
+                    self.setCaches(
+                        request['user_agent'], request['cookie'], device_data,
+                        request['headers'], tiers[:t]
+                    )
+                else:
+                    self.metrics.increment('cache.' + tier + '.misses')
+                    still_missing.append(i)
+            misses = still_missing
+
+        # the local index answers confident matches without network calls
+        still_missing = []
+        for i in misses:
+            results[i], sources[i] = self.getLocalIndexData(
+                requests[i]['user_agent'], requests[i]['cookie']
+            )
+            if not results[i]:
+                still_missing.append(i)
+        misses = still_missing
+
+        # fetch the remaining misses from the cloud, same keys are fetched once
+        pending = OrderedDict()
+        for i in misses:
+            pending.setdefault(requests[i]['key'], []).append(i)
+
+        def fetch(key):
+            request = requests[pending[key][0]]
+            try:
+                return self.__fetchDeviceData(
+                    request['user_agent'], request['cookie'], request['headers'],
+                    False
+                )
+            except Exception as err:
+                # degraded answer from the local index
+                device_data, source = self.getLocalIndexData(
+                    request['user_agent'], request['cookie'], True
+                )
+                if device_data:
+                    return device_data, source
+                return {self.ERROR: str(err)}, self.SOURCE_CLOUD
+
+        fetched = runConcurrently(
+            [lambda key=key: fetch(key) for key in pending],
+            self.CLOUD_SERVICE_MAX_CONCURRENCY
+        )
+
+        # write the results through to the tiers, memcache with a single call
+        to_memcache = {}
+        for key, (device_data, source) in zip(pending, fetched):
+            request = requests[pending[key][0]]
+            if self.PROPERTIES in device_data and \
+               source != self.SOURCE_LOCAL_INDEX_FALLBACK:
+                write_tiers = [tier for tier in tiers if tier != self.SOURCE_MEMCACHE]
+                if source == self.SOURCE_CLOUD and self.SOURCE_MEMCACHE in tiers:
+                    if self.CACHE_WRITE_BEHIND:
+                        # queued with the writes of the other lookups
+                        write_tiers = tiers
+                    else:
+                        to_memcache[key] = device_data
+                try:
+                    self.setCaches(
+                        request['user_agent'], request['cookie'], device_data,
+                        request['headers'], write_tiers
+                    )
+                except Exception as err:
+                    device_data = {self.ERROR: str(err)}
+            for i in pending[key]:
+                results[i] = self.copyDeviceData(device_data)
+                sources[i] = source
+
+        if to_memcache:
+            try:
+                memcache.set_multi(
+                    dict(
+                        (key, self.encodeRecord(device_data))
+                        for key, device_data in to_memcache.items()
+                    ),
+                    time=self.MEMCACHE_ITEM_EXPIRY_SEC
+                )
+            except Exception as err:
+                if self.DEBUG:
+                    print "writing cache tier " + self.SOURCE_MEMCACHE + " failed: " + str(err)
+
+        for i, request in enumerate(requests):
+            results[i] = self.completeResults(
+                results[i] or {}, sources[i], request['user_agent'],
+                request['cookie_properties']
+            )
+
+        return results
+
+
+    def splitClientCookie(self, cookie):
+        '''
+        With CACHE_BY_USER_AGENT_ONLY the "DeviceAtlas Client Side Component"
+        cookie is not used for caching or sent to the cloud, its properties
+        are merged into the results locally
+        @param  string cookie "DeviceAtlas Client Side Component" cookie data
+        @return tuple (cookie to use for caching and cloud requests,
+                       cookie properties to merge or None)
+        '''
+        if self.CACHE_BY_USER_AGENT_ONLY and cookie:
+            return '', self.parseClientCookie(cookie)
+        return cookie, None
+
+
+    def parseClientCookie(self, cookie):
+        '''
+        Parse the "DeviceAtlas Client Side Component" cookie, the property
+        names are prefixed with their type: b = boolean, i = integer,
+        s = string e.g. "bjs.webGl:1|idisplayColorDepth:24|sdeviceAspectRatio:16/9"
+        @param  string cookie "DeviceAtlas Client Side Component" cookie data
+        @return dict {name: value,}
+        '''
+        properties = {}
+        for item in cookie.strip('"').split('|'):
+            name, sep, value = item.partition(':')
+            if not sep or len(name) < 2:
+                continue
+            type_code, name = name[0], name[1:]
+            if type_code == 'b':
+                properties[name] = value == '1'
+            elif type_code == 'i':
+                try:
+                    properties[name] = int(value)
+                except ValueError:
+                    pass
+            elif type_code == 's':
+                properties[name] = value
+
+        return properties
+
+
+    def copyDeviceData(self, device_data):
+        '''
+        Copy device data going into or out of a cache shared by the lookups,
+        the callers own the properties of their results and may change them.
+        DeviceProperties are read only and are shared as they are.
+        @return dict device data with its own properties dictionary
+        '''
+        device_data = dict(device_data)
+        properties  = device_data.get(self.PROPERTIES)
+        if isinstance(properties, dict):
+            properties = device_data[self.PROPERTIES] = dict(properties)
+            for name, value in properties.items():
+                # JSON property values are the only mutable ones
+                if isinstance(value, (dict, list)):
+                    properties[name] = copy.deepcopy(value)
+        return device_data
+
+
+    def completeResults(self, results, source, user_agent, cookie_properties=None):
+        '''
+        Add the data source and the user agent to the results and merge the
+        "DeviceAtlas Client Side Component" cookie properties over the cached
+        properties. If there are no other properties the results come from
+        the cookie. With USE_LAZY_RESULTS the properties become a
+        DeviceProperties mapping and the cookie properties are layered over
+        the cached ones instead of copying them.
+        @param dict results           device data, must not be a cached dict
+        @param dict cookie_properties properties parsed from the cookie
+        @return     dict results
+        '''
+        if self.USE_LAZY_RESULTS:
+            properties = results.get(self.PROPERTIES)
+            if cookie_properties:
+                if self.PROPERTIES not in results:
+                    source = self.SOURCE_COOKIE
+                if not isinstance(properties, DeviceProperties):
+                    properties = DeviceProperties(properties)
+                results[self.PROPERTIES] = properties.withOverrides(cookie_properties)
+            elif properties is not None and not isinstance(properties, DeviceProperties):
+                results[self.PROPERTIES] = DeviceProperties(properties)
+
+        elif cookie_properties:
+            if self.PROPERTIES not in results:
+                source = self.SOURCE_COOKIE
+            properties = dict(results.get(self.PROPERTIES, {}))
+            properties.update(cookie_properties)
+            results[self.PROPERTIES] = properties
+
+        results.pop(self.CACHED_AT, None)
+        results[self.SOURCE]    = source
+        results[self.USERAGENT] = user_agent
+        return results
+
+
+    def __fetchDeviceData(self, user_agent, cookie, headers=None, set_caches=True):
+        '''
+        Get device data from the cloud and cache it. Concurrent calls for the
+        same device within the process wait for one cloud request, with
+        SINGLE_FLIGHT_USE_LEASE other instances wait for it too.
+        @param bool set_caches false = the caller caches the results
+        @return     tuple (device data shared by the waiting calls, source)
+        '''
+        if headers is None:
+            headers = self.getRequestContext().headers
+
+        def fetch():
+            results, source = self.__fetchDeviceDataLeased(
+                user_agent, cookie, headers, set_caches
+            )
+            return results, source, self.getRequestContext().calledServer
+
+        if self.USE_SINGLE_FLIGHT:
+            results, source, server = self.getSingleFlight().do(
+                self.getMemCacheHashKey(user_agent, cookie, headers),
+                fetch
+            )
+            # the waiting calls report the server of the shared request
+            self.getRequestContext().calledServer = server
+            return results, source
+        return fetch()[:2]
+
+
+    def fetchDeviceDataWithin(self, user_agent, cookie, headers, deadline):
+        '''
+        DEADLINE > Get device data from the cloud and cache it, waiting at most
+        until the deadline. The fetch runs in a background thread which goes on
+        (and fills the caches) after the deadline, lookups of the same device
+        wait for the running fetch instead of starting another one.
+        @param float deadline time.time() to stop waiting
+        @return       tuple (device data, source) or (None, SOURCE_NONE) if the
+                      fetch did not finish in time
+        '''
+        key       = self.getMemCacheHashKey(user_agent, cookie, headers)
+        canonical = self.getRequestContext().canonicalUserAgent
+        cls       = self.__class__
+        with cls.sharedLock:
+            fetch = cls.backgroundFetches.get(key)
+            start = fetch is None
+            if start:
+                fetch = cls.backgroundFetches[key] = {'done': threading.Event()}
+
+        if start:
+            def run():
+                # the user agent of the lookup is not canonicalized again
+                self.beginRequest(user_agent, headers, cookie).canonicalUserAgent = canonical
+                try:
+                    fetch['results'] = self.__fetchDeviceData(user_agent, cookie, headers)
+                    fetch['server']  = self.getRequestContext().calledServer
+                except Exception as err:
+                    fetch['error'] = err
+                finally:
+                    with cls.sharedLock:
+                        cls.backgroundFetches.pop(key, None)
+                    fetch['done'].set()
+
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+
+        if not fetch['done'].wait(max(0, deadline - time.time())):
+            return None, self.SOURCE_NONE
+        if 'error' in fetch:
+            raise fetch['error']
+        self.getRequestContext().calledServer = fetch['server']
+        return fetch['results']
+
+
+    def __fetchDeviceDataLeased(self, user_agent, cookie, headers, set_caches):
+        '''
+        Get device data from the cloud holding a memcache lease on the device
+        key. If another instance holds the lease wait for its results to show
+        up in memcache, up to SINGLE_FLIGHT_LEASE_WAIT_SEC.
+        @return tuple (device data, source)
+        '''
+        lease_key = None
+        tiers     = self.getCacheTiers()
+        if self.SOURCE_MEMCACHE in tiers and self.SINGLE_FLIGHT_USE_LEASE:
+            lease_key = self.getMemCacheHashKey(user_agent, cookie, headers) + '_lease'
+            if not memcache.add(
+                key = lease_key, value = 1, time = self.SINGLE_FLIGHT_LEASE_SEC
+            ):
+                lease_key = None
+                wait_until = time.time() + self.SINGLE_FLIGHT_LEASE_WAIT_SEC
+                while time.time() < wait_until:
+                    time.sleep(self.SINGLE_FLIGHT_POLL_SEC)
+                    results = self.getMemCache(user_agent, cookie, headers)
+                    if results and self.PROPERTIES in results:
+                        if set_caches:
+                            self.setCaches(
+                                user_agent, cookie, results, headers,
+                                tiers[:tiers.index(self.SOURCE_MEMCACHE)]
+                            )
+                        return results, self.SOURCE_MEMCACHE
+
+        try:
+            results = self.__callCloudService(user_agent, cookie, headers)
+            if self.CACHE_SOFT_EXPIRY_SEC:
+                results[self.CACHED_AT] = time.time()
+            # set caches for future queries
+            if set_caches:
+                self.setCaches(user_agent, cookie, results, headers)
+        finally:
+            if lease_key is not None:
+                memcache.delete(key = lease_key)
+
+        if self.USE_UA_CANONICALIZATION and \
+           random() < self.UA_CANONICALIZATION_VERIFY_RATE:
+            self.__verifyCanonicalization(user_agent, cookie, headers, results)
+        return results, self.SOURCE_CLOUD
+
+
+    def __verifyCanonicalization(self, user_agent, cookie, headers, results):
+        '''
+        Safety check of the user agent canonicalization, get the device data of
+        the canonical user agent too and record if it agrees with the results
+        of the raw user agent. The second cloud request is made by a background
+        thread, neither the lookup nor the callers waiting for its results wait
+        for it.
+        @param dict results device data of the raw user agent
+        '''
+        canonical = self.getCanonicalUserAgent(user_agent)
+        if canonical == user_agent:
+            return
+        cls = self.__class__
+        with cls.sharedLock:
+            if canonical in cls.canonicalVerifications:
+                return
+            cls.canonicalVerifications.add(canonical)
+        # the results are handed to the callers, which may change them
+        properties = copy.deepcopy(results.get(self.PROPERTIES))
+
+        def verify():
+            try:
+                canonical_results = self.__callCloudService(canonical, cookie, headers)
+                self.getUserAgentCanonicalizer().recordVerification(
+                    user_agent,
+                    canonical,
+                    properties == canonical_results.get(self.PROPERTIES)
+                )
+            except Exception as err:
+                if self.DEBUG:
+                    print "verifying the canonical user agent failed: " + str(err)
+            finally:
+                with cls.sharedLock:
+                    cls.canonicalVerifications.discard(canonical)
+
+        thread = threading.Thread(target=verify)
+        thread.daemon = True
+        thread.start()
+
+
+    def prepareRequest(self, headers, test_mode=False):
+        '''
+        Unify the headers of a request to the standard form and extract the
+        user agent and the "DeviceAtlas Client Side Component" cookie
+        @param dict headers    a dictionary of HTTP headers, {} = os.environ
+        @param bool test_mode  true = use a fake useragent
+        @return     tuple (user_agent, headers, cookie)
+        '''
+        # unify headers to standard form - compatibility with legacy API
+        if headers == {}:
+            headers = os.environ
+        tables  = self.getHeaderTables()
+        headers = tables.normalize(headers)
+        if self.DEBUG:
+            self.pp.pprint(headers)
+        # get user agent
+        user_agent = ''
+        if test_mode:
+            user_agent = self.TEST_USERAGENT
+        elif 'HTTP_USER_AGENT' in headers:
+            user_agent = headers['HTTP_USER_AGENT']
+            del headers['HTTP_USER_AGENT']
+
+        # if "DeviceAtlas Client Side Component" cookie has been created use the data
+        cookie = ''
+        if self.USE_CLIENT_COOKIE and 'HTTP_COOKIE' in headers:
+            cookie = tables.getCookie(headers['HTTP_COOKIE'])
+
+        return user_agent, headers, cookie
+
+
+    def getHeaderTables(self):
+        '''
+        Get the header name tables of the header lists, they are built again
+        only if a list is changed
+        @return HeaderTables
+        '''
+        cls    = self.__class__
+        tables = cls.headerTables
+        source = (
+            self.ESSENTIAL_HEADERS, self.ESSENTIAL_USER_AGENT_HEADERS,
+            self.EXTRA_HEADERS, self.CLIENT_COOKIE_NAME, self.DA_HEADER_PREFIX
+        )
+        if tables is None or tables.source != source:
+            tables = cls.headerTables = HeaderTables(*source)
+        return tables
+
+
+    def __callCloudService(self, user_agent, cookie, headers=None):
+        '''
+        Get data from the DeviceAtlas Cloud service
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        @param dict headers  request headers, None = headers of the current request
+        '''
+        if self.DEBUG:
+            print ("connecting to Device Atlas service ")
+        errors  = []
+        servers = self.getServers()
+        i       = 0
+
+        if self.CLOUD_SERVICE_HEDGED:
+            if headers is None:
+                headers = self.getRequestContext().headers
+            return self.__callCloudServiceHedged(
+                servers, user_agent, cookie, headers
+            )
+
+        for server in servers:
+            response = self.__connectCloud(
+                server, user_agent, cookie, errors, headers=headers
+            )
+            self.getRequestContext().calledServer = server
+            if response != None:
+                # i = index of healthy server, all servers with index less than
+                # i have failed, move them to the end of the list:
+                # save list to cache
+                # if param servers is provided it means only cache servers
+                # without ranking them.
+                if i > 0:
+                    self.metrics.increment('cloud.failovers')
+                    self.rankServers(self.getFailoverRanking(servers, i))
+
+                return response
+            i += 1
+
+        self.metrics.increment('cloud.failures')
+        raise Exception(('\n').join(errors))
+
+
+    def __callCloudServiceHedged(self, servers, user_agent, cookie, headers):
+        '''
+        Send the request to the preferred server, if no answer arrives within
+        the hedge delay send it to the next server as well (a failed server is
+        replaced at once). At most CLOUD_SERVICE_MAX_HEDGES hedged requests
+        are in flight in the process. The first valid response is used, the
+        requests still running are cancelled: their connections are closed
+        (connections opened without the connection pool are left to their
+        timeout) and their responses are ignored.
+        @param list servers  servers sorted by preference
+        @param dict headers  request headers
+        '''
+        errors       = []
+        answers      = Queue()
+        state        = {'started': 0, 'running': 0}
+        cancellation = Cancellation()
+        cls          = self.__class__
+
+        def attempt(i, hedge):
+            attempt_errors = []
+            response       = None
+            try:
+                response = self.__connectCloud(
+                    servers[i], user_agent, cookie, attempt_errors,
+                    headers=headers, cancellation=cancellation
+                )
+            finally:
+                if hedge:
+                    with cls.sharedLock:
+                        cls.hedgesInFlight -= 1
+                answers.put((i, response, attempt_errors))
+
+        def start(hedge=False):
+            if state['started'] >= len(servers):
+                return
+            thread = threading.Thread(target=attempt, args=(state['started'], hedge))
+            thread.daemon = True
+            thread.start()
+            state['started'] += 1
+            state['running'] += 1
+
+        start()
+        while state['running']:
+            timeout = None
+            if state['started'] < len(servers):
+                timeout = self.getHedgeDelay(servers[state['started'] - 1])
+            try:
+                i, response, attempt_errors = answers.get(True, timeout)
+            except Empty:
+                with cls.sharedLock:
+                    capped = cls.hedgesInFlight >= self.CLOUD_SERVICE_MAX_HEDGES
+                    if not capped:
+                        cls.hedgesInFlight += 1
+                if capped:
+                    # try again after another hedge delay
+                    self.metrics.increment('cloud.hedges_capped')
+                    continue
+                if self.DEBUG:
+                    print ("hedging request to " + servers[state['started']]['host'])
+                self.metrics.increment('cloud.hedges')
+                start(True)
+                continue
+
+            state['running'] -= 1
+            errors.extend(attempt_errors)
+            if response != None:
+                if state['running']:
+                    self.metrics.increment('cloud.hedges_cancelled', state['running'])
+                    cancellation.cancel()
+                self.getRequestContext().calledServer = servers[i]
+                # rank servers by the one which actually answered
+                if i > 0:
+                    self.metrics.increment('cloud.failovers')
+                    self.rankServers(self.getFailoverRanking(servers, i))
+                return response
+            # failover to the next server without waiting
+            start()
+
+        self.metrics.increment('cloud.failures')
+        raise Exception(('\n').join(errors))
+
+
+    def getHedgeDelay(self, server):
+        '''
+        Time (seconds) to wait for a server before hedging the request to the
+        next server. With USE_ADAPTIVE_TIMEOUT the p90 latency estimate of the
+        server is used if known, else the slowest latency measured when the
+        server was ranked, otherwise CLOUD_SERVICE_HEDGE_DELAY.
+        @param dict server {host:, port:, latencies:}
+        '''
+        if self.USE_ADAPTIVE_TIMEOUT:
+            estimate = self.getLatencyTracker().getEstimate(server['host'])
+            if estimate is not None:
+                return min(estimate['p90'] / 1000.0, self.CLOUD_SERVICE_TIMEOUT)
+        latencies = [x for x in server.get('latencies', []) if x > 0]
+        if latencies:
+            return min(max(latencies) / 1000.0, self.CLOUD_SERVICE_TIMEOUT)
+        return self.CLOUD_SERVICE_HEDGE_DELAY
+
+
+    def __connectCloud(self, server, user_agent, cookie, errors, latency_checker=False, headers=None, cancellation=None):
+        '''
+        Connect to a cloud server and get device data, return data or null
+        @param dict         headers      request headers, None = headers of the current request
+        @param Cancellation cancellation a cancelled request is not counted as
+                                         a failure of the server
+        '''
+        if self.DEBUG:
+            print ("connecting to Device Atlas server " + server['host'])
+        # latency probes bypass the circuit breaker
+        use_breaker = self.USE_CIRCUIT_BREAKER and not latency_checker
+        if use_breaker and not self.allowServer(server):
+            errors.append('Server ('+server['host']+') is phased out')
+            self.metrics.increment('cloud.' + server['host'] + '.phased_out')
+            return None
+        # build request
+        path, headers = self.getCloudRequest(
+            user_agent, cookie, latency_checker, headers
+        )
+        # latency probes must not give up on slow servers
+        if latency_checker:
+            timeout = self.CLOUD_SERVICE_TIMEOUT
+        else:
+            timeout = self.getCloudTimeout(server)
+        device_data = None
+        data        = None
+        started     = time.time()
+        try:
+            if self.USE_CONNECTION_POOL:
+                status, data = self.getConnectionPool().request(
+                    server['host'],
+                    server['port'],
+                    path,
+                    headers,
+                    timeout,
+                    cancellation
+                )
+                if status < 200 or status >= 300:
+                    raise Exception('HTTP Error %d' % status)
+            else:
+                req = Request(
+                    'http://' + server['host'] + ':' + str(server['port']) + path
+                )
+                for header in headers:
+                    req.add_header(header, headers[header])
+                data = urlopen(req, None, timeout).read()
+
+            device_data = self.parseCloudResponse(server, data, errors)
+
+        except Exception as err:
+            errors.append(
+                'Error fetching DeviceAtlas data from Cloud server "' + \
+                server['host'] + '". ' + str(err)
+            )
+
+        if device_data is None and cancellation is not None and cancellation.cancelled:
+            # another server answered, this one did not fail
+            return None
+        self.recordCloudMetrics(server, started, data, device_data, latency_checker)
+        if self.USE_ADAPTIVE_TIMEOUT and \
+           (self.ADAPTIVE_TIMEOUT_USE_PROBES or not latency_checker):
+            if device_data != None:
+                self.recordServerLatency(server['host'], (time.time() - started) * 1000)
+            else:
+                self.getLatencyTracker().recordFailure(server['host'])
+        if use_breaker:
+            self.recordServerResult(server['host'], device_data != None)
+        return device_data
+
+
+    def recordCloudMetrics(self, server, started, data, device_data, latency_checker=False):
+        '''
+        Record the duration, the payload size and the result of a cloud
+        request, latency probes are recorded apart as "ranking.probe"
+        @param float  started     time the request was started
+        @param string data        the response body or None
+        @param dict   device_data the parsed response or None if the request failed
+        '''
+        prefix = 'ranking.probe' if latency_checker else 'cloud'
+        ms     = (time.time() - started) * 1000
+        self.metrics.observe(prefix + '.connect_ms', ms)
+        self.metrics.observe(prefix + '.' + server['host'] + '.connect_ms', ms)
+        if data is not None:
+            self.metrics.observe(prefix + '.payload_bytes', len(data))
+        if device_data is None:
+            self.metrics.increment(prefix + '.errors')
+            self.metrics.increment(prefix + '.' + server['host'] + '.errors')
+
+
+    def getCloudRequest(self, user_agent, cookie, latency_checker=False, headers=None):
+        '''
+        Build the path and the headers of a cloud service request
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        @param dict headers  request headers, None = headers of the current request
+        @return tuple (path, {header-name: value,})
+        '''
+        if headers is None:
+            headers = self.getRequestContext().headers
+        request_headers = headers
+        tables          = self.getHeaderTables()
+        # add "essential" headers
+        # add any Opera or any other special headers as these may contain
+        # extra device information
+        headers = tables.getCloudHeaders(request_headers)
+        # API info
+        headers[self.DA_HEADER_PREFIX + 'Version'] = self.API_VERSION
+        # add the "DeviceAtlas Client Side Component" cookie data
+        if cookie:
+            headers[self.DA_HEADER_PREFIX + self.CLIENT_COOKIE_HEADER] = cookie
+        # latency checker
+        if latency_checker:
+            headers[self.DA_HEADER_PREFIX+'Latency-Checker'] = '1'
+        # add extra "optional" headers
+        if self.SEND_EXTRA_HEADERS:
+            headers.update(tables.getCloudHeaders(request_headers, True))
+
+        return self.CLOUD_PATH % (self.LICENCE_KEY, quote(user_agent)), headers
+
+
+    def parseCloudResponse(self, server, data, errors):
+        '''
+        Decode the body of a cloud service response
+        @param string data   response body
+        @param list   errors error messages are appended to this list
+        @return       dict device data or None if the response is invalid
+        '''
+        data = data.decode('utf8').strip()
+        if data:
+            device_data = json.loads(data)
+            if self.PROPERTIES in device_data:
+                return device_data
+
+            errors.append('Server ('+server['host']+') returned invalid data')
+        else:
+            errors.append('Server ('+server['host']+') returned nothing')
+
+        return None
+
+
+    def getCacheTiers(self):
+        '''
+        Get the cache tiers in lookup order
+        @return list of tier names, the names are the data sources
+        '''
+        if self.CACHE_TIERS is not None:
+            return list(self.CACHE_TIERS)
+        tiers = []
+        if self.USE_LOCAL_CACHE:
+            tiers.append(self.SOURCE_LOCAL_CACHE)
+        if self.USE_SHARED_CACHE:
+            tiers.append(self.SOURCE_SHARED_CACHE)
+        if self.USE_MEMCACHE:
+            tiers.append(self.SOURCE_MEMCACHE)
+        elif self.USE_FILE_CACHE:
+            tiers.append(self.SOURCE_FILE_CACHE)
+        return tiers
+
+
+    def getCacheTier(self, tier, user_agent, cookie, headers=None):
+        '''
+        Get device data from one cache tier
+        @param string tier tier name, see getCacheTiers()
+        @return       dict device data or None/empty if not cached
+        '''
+        if tier == self.SOURCE_LOCAL_CACHE:
+            return self.getLocalCache().get(
+                self.getLocalCacheKey(user_agent, cookie, headers)
+            )
+        if tier == self.SOURCE_SHARED_CACHE:
+            return self.getSharedCacheItem(user_agent, cookie, headers)
+        if self.CACHE_WRITE_BEHIND:
+            queued = self.getWriteBehindQueue().get(
+                (tier, self.getMemCacheHashKey(user_agent, cookie, headers))
+            )
+            if queued is not None:
+                return queued[2]
+        if tier == self.SOURCE_MEMCACHE:
+            return self.getMemCache(user_agent, cookie, headers)
+        if tier == self.SOURCE_FILE_CACHE:
+            return self.getFileCache(user_agent, cookie, headers)
+        raise Exception('Unknown cache tier "%s"' % tier)
+
+
+    def setCacheTier(self, tier, user_agent, cookie, device_data, headers=None):
+        '''
+        Put device data into one cache tier
+        @param string tier tier name, see getCacheTiers()
+        '''
+        if tier == self.SOURCE_LOCAL_CACHE:
+            self.setLocalCache(user_agent, cookie, device_data, headers)
+        elif tier == self.SOURCE_SHARED_CACHE:
+            self.setSharedCacheItem(user_agent, cookie, device_data, headers)
+        elif tier == self.SOURCE_MEMCACHE:
+            self.setMemCache(user_agent, cookie, device_data, headers)
+        elif tier == self.SOURCE_FILE_CACHE:
+            self.setFileCache(user_agent, cookie, device_data, headers)
+        else:
+            raise Exception('Unknown cache tier "%s"' % tier)
+
+
+    def getCachedDeviceData(self, user_agent, cookie, headers=None, deadline=None):
+        '''
+        Look the device up in the cache tiers in order, a hit is copied
+        (promoted) to the tiers above the one which served it
+        @param string cookie   "DeviceAtlas Client Side Component" cookie data
+        @param float  deadline time.time() after which no more tiers are
+                               checked, None = no limit
+        @return       tuple (copy of the device data or None,
+                             source = name of the tier which served it,
+                             see checkStale())
+        '''
+        if headers is None:
+            headers = self.getRequestContext().headers
+        tiers = self.getCacheTiers()
+        for i, tier in enumerate(tiers):
+            if deadline is not None and time.time() >= deadline:
+                break
+            device_data = self.getCacheTier(tier, user_agent, cookie, headers)
+            if device_data and self.PROPERTIES in device_data:
+                self.metrics.increment('cache.' + tier + '.hits')
+                self.setCaches(user_agent, cookie, device_data, headers, tiers[:i])
+                return self.copyDeviceData(device_data), self.checkStale(
+                    user_agent, cookie, device_data, tier, headers
+                )
+            self.metrics.increment('cache.' + tier + '.misses')
+
+        return None, self.SOURCE_NONE
+
+
+    def setCaches(self, user_agent, cookie, device_data, headers=None, tiers=None):
+        '''
+        Write device data through to the cache tiers. With
+        CACHE_WRITE_BEHIND the tiers other than the in-process and shared
+        caches are queued to be written in batches, with
+        CACHE_WRITE_BACKGROUND they are written by a background thread.
+        Their errors are ignored.
+        @param list tiers tier names, None = all tiers
+        '''
+        if headers is None:
+            headers = self.getRequestContext().headers
+        if tiers is None:
+            tiers = self.getCacheTiers()
+        background = []
+        for tier in tiers:
+            if tier in (self.SOURCE_LOCAL_CACHE, self.SOURCE_SHARED_CACHE):
+                # memory writes, not worth a thread
+                self.setCacheTier(tier, user_agent, cookie, device_data, headers)
+            elif self.CACHE_WRITE_BEHIND:
+                self.getWriteBehindQueue().put(
+                    (tier, self.getMemCacheHashKey(user_agent, cookie, headers)),
+                    (user_agent, cookie, device_data, headers)
+                )
+            elif self.CACHE_WRITE_BACKGROUND:
+                background.append(tier)
+            else:
+                self.setCacheTier(tier, user_agent, cookie, device_data, headers)
+
+        if background:
+            def write():
+                for tier in background:
+                    try:
+                        self.setCacheTier(
+                            tier, user_agent, cookie, device_data, headers
+                        )
+                    except Exception as err:
+                        if self.DEBUG:
+                            print "writing cache tier " + tier + " failed: " + str(err)
+            thread = threading.Thread(target=write)
+            thread.daemon = True
+            thread.start()
+
+
+    def getWriteBehindQueue(self):
+        '''
+        WRITE BEHIND > Get the queue of cache writes, it is created on first
+        use and shared by all Client objects
+        @return WriteBehindQueue
+        '''
+        return self.__getShared('writeBehindQueue', lambda: WriteBehindQueue(
+            self.writeBehind,
+            self.CACHE_WRITE_BEHIND_BATCH,
+            self.CACHE_WRITE_BEHIND_SEC,
+            self.CACHE_WRITE_BEHIND_MAX_ITEMS
+        ))
+
+
+    def writeBehind(self, batch):
+        '''
+        WRITE BEHIND > Write a batch of queued cache items, the memcache items
+        with one memcache.set_multi() and the indexed file cache items with
+        one append, other items one by one
+        @param list batch [((tier, memcache key), (user_agent, cookie,
+                          device_data, headers)),]
+        '''
+        started     = time.time()
+        to_memcache = {}
+        to_disk     = {}
+        for (tier, key), (user_agent, cookie, device_data, headers) in batch:
+            if tier == self.SOURCE_MEMCACHE:
+                to_memcache[key] = self.encodeRecord(device_data)
+            elif tier == self.SOURCE_FILE_CACHE and self.FILE_CACHE_INDEXED:
+                if self.USE_COMPACT_RECORDS:
+                    value = self.getRecordCodec().encode(device_data, self.PROPERTIES)
+                else:
+                    value = json.dumps(device_data, default=dict).encode('utf-8')
+                to_disk[self.getCacheKeySource(user_agent, cookie, headers)] = value
+            else:
+                try:
+                    self.setCacheTier(tier, user_agent, cookie, device_data, headers)
+                except Exception as err:
+                    if self.DEBUG:
+                        print "writing cache tier " + tier + " failed: " + str(err)
+
+        # each destination on its own, a failure of one does not lose the other
+        if to_memcache:
+            try:
+                memcache.set_multi(to_memcache, time=self.MEMCACHE_ITEM_EXPIRY_SEC)
+            except Exception as err:
+                if self.DEBUG:
+                    print "writing cache tier " + self.SOURCE_MEMCACHE + " failed: " + str(err)
+        if to_disk:
+            try:
+                self.getDiskCache().setMulti(to_disk)
+            except Exception as err:
+                if self.DEBUG:
+                    print "writing cache tier " + self.SOURCE_FILE_CACHE + " failed: " + str(err)
+        self.metrics.increment('cache.write_behind.flushes')
+        self.metrics.observe('cache.write_behind.batch', len(batch))
+        self.metrics.observe('cache.write_behind.flush_ms', (time.time() - started) * 1000)
+
+
+    def checkStale(self, user_agent, cookie, device_data, source, headers=None):
+        '''
+        STALE WHILE REVALIDATE > Check if cached device data is older than
+        CACHE_SOFT_EXPIRY_SEC, if so start refreshing it in a background
+        thread unless it is already being refreshed (by this process or, when
+        memcache is a cache tier, by another instance)
+        @param dict   device_data cached device data
+        @param string source      the tier which served the data
+        @return       string source, with SOURCE_STALE_SUFFIX if the data is stale
+        '''
+        cached_at = device_data.get(self.CACHED_AT)
+        if not self.CACHE_SOFT_EXPIRY_SEC or cached_at is None or \
+           cached_at + self.CACHE_SOFT_EXPIRY_SEC > time.time():
+            return source
+
+        key = self.getMemCacheHashKey(user_agent, cookie, headers)
+        cls = self.__class__
+        with cls.sharedLock:
+            if key in cls.staleRefreshes:
+                return source + self.SOURCE_STALE_SUFFIX
+            cls.staleRefreshes.add(key)
+        if self.SOURCE_MEMCACHE in self.getCacheTiers():
+            try:
+                refresh = memcache.add(
+                    key = key + '_refresh', value = 1,
+                    time = self.CACHE_STALE_RETRY_SEC
+                )
+            except Exception as err:
+                refresh = True
+            if not refresh:
+                with cls.sharedLock:
+                    cls.staleRefreshes.discard(key)
+                return source + self.SOURCE_STALE_SUFFIX
+
+        if self.DEBUG:
+            print "refreshing stale devicedata " + user_agent
+
+        def refresh():
+            try:
+                self.refreshStale(user_agent, cookie, device_data, headers)
+            finally:
+                with cls.sharedLock:
+                    cls.staleRefreshes.discard(key)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+        return source + self.SOURCE_STALE_SUFFIX
+
+
+    def refreshStale(self, user_agent, cookie, device_data, headers=None):
+        '''
+        STALE WHILE REVALIDATE > Get fresh device data from the cloud and cache
+        it. If the cloud can not be reached the stale data is cached again to
+        be served for CACHE_STALE_RETRY_SEC before the next try.
+        @param dict device_data the stale device data
+        @return     bool true if the data has been refreshed
+        '''
+        try:
+            results, source = self.__fetchDeviceData(user_agent, cookie, headers)
+            if self.PROPERTIES in results:
+                return True
+        except Exception as err:
+            if self.DEBUG:
+                print "refreshing stale devicedata failed: " + str(err)
+
+        device_data = dict(device_data)
+        device_data[self.CACHED_AT] = \
+            time.time() - self.CACHE_SOFT_EXPIRY_SEC + self.CACHE_STALE_RETRY_SEC
+        try:
+            self.setCaches(user_agent, cookie, device_data, headers)
+        except Exception as err:
+            pass
+        return False
+
+
+    def getLocalIndex(self):
+        '''
+        LOCAL INDEX > Get the local device index from LOCAL_INDEX_PATH, it is
+        opened on first use and shared by all Client objects
+        @return LocalIndex or None if there is no index
+        '''
+        if not self.LOCAL_INDEX_PATH:
+            return None
+        # created before, the shared objects are created holding the lock
+        codec         = self.getRecordCodec()
+        canonicalizer = self.getLocalIndexCanonicalizer()
+        return self.__getShared('localIndex', lambda: LocalIndex(
+            self.LOCAL_INDEX_PATH, codec, canonicalizer
+        ))
+
+
+    def getLocalIndexCanonicalizer(self):
+        '''
+        LOCAL INDEX > The function applied to the user agents before they are
+        indexed or looked up
+        @return function or None
+        '''
+        if not self.USE_UA_CANONICALIZATION:
+            return None
+        canonicalizer = self.getUserAgentCanonicalizer()
+        return lambda user_agent: canonicalizer.canonicalize(user_agent, False)
+
+
+    def getLocalIndexData(self, user_agent, cookie, fallback=False):
+        '''
+        LOCAL INDEX > Look the user agent up in the local device index. The
+        "DeviceAtlas Client Side Component" cookie properties are merged into
+        the properties as the cloud would do.
+        @param bool fallback true = the cloud can not be reached, a match with
+                             LOCAL_INDEX_FALLBACK_MIN_SCORE is enough
+        @return     tuple (device data or None, source)
+        '''
+        try:
+            index = self.getLocalIndex()
+        except Exception as err:
+            if self.DEBUG:
+                print "opening the local index failed: " + str(err)
+            return None, self.SOURCE_NONE
+        if index is None:
+            return None, self.SOURCE_NONE
+
+        device_data, score = index.lookup(user_agent, self.PROPERTIES)
+        if fallback:
+            min_score = self.LOCAL_INDEX_FALLBACK_MIN_SCORE
+            source    = self.SOURCE_LOCAL_INDEX_FALLBACK
+        else:
+            min_score = self.LOCAL_INDEX_MIN_SCORE
+            source    = self.SOURCE_LOCAL_INDEX
+        if device_data is None or score < min_score:
+            self.metrics.increment('localindex.misses')
+            return None, self.SOURCE_NONE
+
+        self.metrics.increment(
+            'localindex.fallbacks' if fallback else 'localindex.hits'
+        )
+        if cookie:
+            device_data[self.PROPERTIES].update(self.parseClientCookie(cookie))
+        return device_data, source
+
+
+    def __getShared(self, name, create):
+        '''
+        Get an object shared by the Client objects, it is created on first use.
+        The object is kept by the class of the Client object and not looked up
+        in the parent classes, a subclass which changes the settings of the
+        object (e.g. LOCAL_CACHE_MAX_ITEMS) gets its own.
+        @param string   name   the class attribute of the object
+        @param function create called to create the object
+        @return               the object
+        '''
+        cls    = self.__class__
+        shared = cls.__dict__.get(name)
+        if shared is None:
+            with cls.sharedLock:
+                shared = cls.__dict__.get(name)
+                if shared is None:
+                    shared = create()
+                    setattr(cls, name, shared)
+        return shared
+
+
+    def getConnectionPool(self):
+        '''
+        Get the pool of keep-alive connections to the cloud servers, it is
+        created on first use and shared by all Client objects
+        @return ConnectionPool
+        '''
+        return self.__getShared('connectionPool', lambda: ConnectionPool(
+            self.CONNECTION_POOL_SIZE,
+            self.CONNECTION_POOL_IDLE_TIMEOUT
+        ))
+
+
+    def getCircuitBreaker(self):
+        '''
+        Get the circuit breaker of the cloud servers, it is created on first
+        use and shared by all Client objects
+        @return CircuitBreaker
+        '''
+        return self.__getShared('circuitBreaker', lambda: CircuitBreaker(
+            self.CIRCUIT_BREAKER_MAX_FAILURES,
+            self.CIRCUIT_BREAKER_FAILURE_RATE,
+            self.CIRCUIT_BREAKER_WINDOW_SEC,
+            self.SERVER_PHASEOUT_LIFETIME * 60,
+            self.CLOUD_SERVICE_TIMEOUT,
+            self.CIRCUIT_BREAKER_MAX_CONSECUTIVE_FAILURES
+        ))
+
+
+    def getLatencyTracker(self):
+        '''
+        Get the latency estimates of the cloud servers, created on first use
+        and shared by all Client objects
+        @return LatencyTracker
+        '''
+        return self.__getShared('latencyTracker', lambda: LatencyTracker(
+            min_samples = self.ADAPTIVE_TIMEOUT_MIN_SAMPLES,
+            max_age     = self.ADAPTIVE_TIMEOUT_MAX_AGE_SEC,
+            failure_ttl = self.ADAPTIVE_TIMEOUT_FAILURE_TTL_SEC
+        ))
+
+
+    def getSingleFlight(self):
+        '''
+        Get the registry of in-flight cloud requests, it is created on first
+        use and shared by all Client objects
+        @return SingleFlight
+        '''
+        return self.__getShared('singleFlight', SingleFlight)
+
+
+    def getUserAgentCanonicalizer(self):
+        '''
+        Get the user agent canonicalizer built from UA_CANONICALIZATION_RULES,
+        it is created on first use and shared by all Client objects
+        @return UserAgentCanonicalizer
+        '''
+        return self.__getShared('userAgentCanonicalizer', lambda: UserAgentCanonicalizer(
+            self.UA_CANONICALIZATION_RULES
+        ))
+
+
+    def getRecordCodec(self):
+        '''
+        Get the codec of compact cache records, it is created on first use
+        and shared by all Client objects
+        @return RecordCodec
+        '''
+        return self.__getShared('recordCodec', lambda: RecordCodec(self.COMPACT_RECORDS_COMPRESS))
+
+
+    def encodeRecord(self, device_data):
+        '''
+        Encode device data for memcache, with USE_COMPACT_RECORDS it is a
+        compact binary record otherwise the dictionary is left to memcache
+        '''
+        if self.USE_COMPACT_RECORDS:
+            return self.getRecordCodec().encode(device_data, self.PROPERTIES)
+        return device_data
+
+
+    def decodeRecord(self, value):
+        '''
+        Decode a cached value, compact records, JSON and dictionaries are
+        accepted whatever USE_COMPACT_RECORDS is set to, with USE_LAZY_RESULTS
+        the properties are a DeviceProperties mapping
+        @return dict device data or None
+        '''
+        if self.USE_LAZY_RESULTS:
+            return self.getRecordCodec().decodeLazy(value, self.PROPERTIES)
+        return self.getRecordCodec().decode(value, self.PROPERTIES)
+
+
+    def getLocalCache(self):
+        '''
+        LOCAL CACHE > Get the in-process LRU cache, it is created on first use
+        and shared by all Client objects
+        @return LruCache
+        '''
+        return self.__getShared('localCache', lambda: LruCache(
+            self.LOCAL_CACHE_MAX_ITEMS,
+            self.LOCAL_CACHE_MAX_BYTES,
+            self.LOCAL_CACHE_ITEM_EXPIRY_SEC
+        ))
+
+
+    def setLocalCache(self, user_agent, cookie, device_data, headers=None):
+        '''
+        LOCAL CACHE > Cache device data into the in-process cache
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        '''
+        key = self.getLocalCacheKey(user_agent, cookie, headers)
+        # keep a copy, the caller owns its results and may change them
+        return self.getLocalCache().set(key, self.copyDeviceData(device_data))
+
+
+    def getLocalCacheKey(self, user_agent, cookie, headers=None):
+        '''
+        LOCAL CACHE > The key is the raw string which the memcache and file
+        cache keys are hashed from, this saves an md5 on each lookup
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        '''
+        return self.getCacheKeySource(user_agent, cookie, headers)
+
+
+    def getSharedCache(self):
+        '''
+        SHARED CACHE > Get the memory mapped cache, it is opened (created by
+        the first process) on first use and shared by all Client objects
+        @return SharedMemoryCache
+        '''
+        return self.__getShared('sharedCache', lambda: SharedMemoryCache(
+            self.getSharedCachePath(),
+            self.SHARED_CACHE_SLOTS,
+            self.SHARED_CACHE_SLOT_BYTES,
+            expiry_sec = self.SHARED_CACHE_ITEM_EXPIRY_SEC
+        ))
+
+
+    def getSharedCachePath(self):
+        '''
+        SHARED CACHE > SHARED_CACHE_PATH or the default path in /dev/shm
+        (memory) or else in the system temp dir
+        '''
+        if self.SHARED_CACHE_PATH:
+            return self.SHARED_CACHE_PATH
+        base_path = '/dev/shm'
+        if not os.path.isdir(base_path):
+            base_path = tempfile.gettempdir()
+        return base_path + os.sep + self.SHARED_CACHE_NAME
+
+
+    def getSharedCacheItem(self, user_agent, cookie, headers=None):
+        '''
+        SHARED CACHE > Get device data from the memory mapped cache, the
+        items are keyed as in memcache
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        '''
+        key     = self.getMemCacheHashKey(user_agent, cookie, headers)
+        started = time.time()
+        try:
+            return self.decodeRecord(self.getSharedCache().get(key))
+        finally:
+            self.metrics.observe('cache.sharedcache.get_ms', (time.time() - started) * 1000)
+
+
+    def setSharedCacheItem(self, user_agent, cookie, device_data, headers=None):
+        '''
+        SHARED CACHE > Cache device data into the memory mapped cache, always
+        as a compact record
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        '''
+        key = self.getMemCacheHashKey(user_agent, cookie, headers)
+        if not self.getSharedCache().set(
+            key, self.getRecordCodec().encode(device_data, self.PROPERTIES)
+        ):
+            self.metrics.increment('cache.sharedcache.rejected')
+
+
+    def setFileCache(self, user_agent, cookie, device_data, headers=None):
+        '''
+        FILE CACHE > Cache device data into a file
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        '''
+
+        if self.USE_COMPACT_RECORDS:
+            value = self.getRecordCodec().encode(device_data, self.PROPERTIES)
+        else:
+            value = json.dumps(device_data, default=dict).encode('utf-8')
+
+        if self.FILE_CACHE_INDEXED:
+            try:
+                self.getDiskCache().set(
+                    self.getCacheKeySource(user_agent, cookie, headers), value
+                )
+            except Exception as err:
+                raise Exception(
+                    'Can not write cache file data at ' + self.getCacheBasePath() +
+                    ' Error: ' + str(err)
+                )
+            return
+
+        path     = self.getFileCacheDir(user_agent, cookie, headers)
+        dir_name = os.path.dirname(path)
+
+        try:
+            if not os.path.exists(dir_name):
                 os.makedirs(dir_name, mode=0o755)
-            fp = open(path, 'w')
-            #fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            fp.write(json.dumps(device_data))
+            fp = open(path, 'wb')
+            fp.write(value)
             fp.close()
 
         except IOError as err:
@@ -424,235 +4335,913 @@ class Client:
                 'Can not write cache file data at ' + path + ' Error: ' + str(err)
             )
 
-    def setMemCache(self, user_agent, cookie, device_data):
+    def setMemCache(self, user_agent, cookie, device_data, headers=None):
         '''
         MEM CACHE > Cache device data into memcache
         @param string cookie "DeviceAtlas Client Side Component" cookie data
         '''
 
-        if self.DEBUG:
-            print "memcaching devicedata " + user_agent
+        if self.DEBUG:
+            print "memcaching devicedata " + user_agent
+
+        key = self.getMemCacheHashKey(user_agent, cookie, headers)
+
+        memcache.set(key = key, value = self.encodeRecord(device_data), time = self.MEMCACHE_ITEM_EXPIRY_SEC)
+
+
+    def getMemCache(self, user_agent, cookie, headers=None):
+        '''
+        MEM CACHE > Creates a memcache key for this item by taking the md5 hash.
+        Uses key to retrieve memcache value.
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        '''
+
+        if self.DEBUG:
+            print ("reading memcached devicedata for " + user_agent)
+        key     = self.getMemCacheHashKey(user_agent, cookie, headers)
+        started = time.time()
+        try:
+            return self.decodeRecord(memcache.get(key = key))
+        finally:
+            self.metrics.observe('cache.memcache.get_ms', (time.time() - started) * 1000)
+
+    def getFileCache(self, user_agent, cookie, headers=None):
+        '''
+        FILE CACHE > Creates a cache path for this item by taking the md5 hash
+        and using the first 4 characters to create a directory structure.
+        This is done to prevent too many files existing in any one directory
+        as this can lead to slowdowns
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        '''
+        started = time.time()
+        try:
+            return self.__readFileCache(user_agent, cookie, headers)
+        finally:
+            self.metrics.observe('cache.cache.get_ms', (time.time() - started) * 1000)
+
+
+    def __readFileCache(self, user_agent, cookie, headers):
+        '''
+        FILE CACHE > Read and decode a cache item
+        @return dict device data or '' if not cached
+        '''
+        if self.FILE_CACHE_INDEXED:
+            device_data = self.getDiskCache().get(
+                self.getCacheKeySource(user_agent, cookie, headers)
+            )
+            try:
+                return self.decodeRecord(device_data) or ''
+            except ValueError:
+                # broken cache item, treat as a miss
+                return ''
+
+        path = self.getFileCacheDir(user_agent, cookie, headers)
+        if os.path.exists(path) and \
+           os.path.getmtime(path) + self.CACHE_ITEM_EXPIRY_SEC > time.time():
+
+            for i in (1, 2, 3, 4):
+                try:
+                    fp = open(path, 'rb')
+                    device_data = fp.read()
+                    fp.close()
+                    break
+
+                except Exception as err:
+                    time.sleep(1)
+            else:
+                return ''
+
+            try:
+                return self.decodeRecord(device_data) or ''
+            except ValueError:
+                # broken cache file, treat as a miss
+                return ''
+
+        return ''
+
+
+    def getDiskCache(self):
+        '''
+        FILE CACHE > Get the indexed file cache, it is opened on first use and
+        shared by all Client objects
+        @return DiskCache
+        '''
+        return self.__getShared('diskCache', lambda: DiskCache(
+            self.getCacheBasePath() + 'items.dat',
+            self.CACHE_ITEM_EXPIRY_SEC,
+            self.FILE_CACHE_COMPACT_RATIO
+        ))
+
+
+    def getCacheBasePath(self):
+        '''
+        FILE CACHE > Returns the path to save the file cache, it can be the
+        default path or the assigned one through the CUSTOM_CACHE_DIR constant
+        '''
+        if self.USE_SYSTEM_TEMP_DIR:
+            base_path = tempfile.gettempdir()
+        else:
+            base_path = self.CUSTOM_CACHE_DIR
+
+        return base_path + os.sep + self.CACHE_NAME + os.sep
+
+    def getFileCacheDir(self, user_agent, cookie, headers=None):
+        '''
+        FILE CACHE > Creates a cache path for this item by taking the md5 hash
+        and using the first 4 characters to create a directory structure.
+        This is done to prevent too many files existing in any one directory
+        as this can lead to slowdowns
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        '''
+        key = md5(self.getCacheKeySource(user_agent, cookie, headers).encode('utf-8')).hexdigest()
+        return \
+            self.getCacheBasePath() +\
+            key[0:2] +\
+            os.sep +\
+            key[2:4] +\
+            os.sep +\
+            key[4:len(key)]
+
+
+    def getCacheKeySource(self, user_agent, cookie, headers=None):
+        '''
+        Creates the string which identifies a cache item, the cache keys are
+        derived from this string
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        @param dict headers  request headers, None = headers of the current request
+        '''
+        if headers is None:
+            headers = self.getRequestContext().headers
+        # tokens which do not affect detection are removed from the user agent
+        if self.USE_UA_CANONICALIZATION:
+            user_agent = self.getCanonicalUserAgent(user_agent)
+        # cache key - combination of user agent and cookie
+        for header in self.ESSENTIAL_USER_AGENT_HEADERS:
+            if headers and header in headers:
+                user_agent += headers[header]
+                break
+
+        return 'py' + user_agent + cookie
+
+
+    def getCanonicalUserAgent(self, user_agent):
+        '''
+        Canonicalize a user agent for the cache keys. The user agent of the
+        lookup running in the thread is canonicalized (and counted in the
+        statistics) once, the result is kept by its RequestContext and reused
+        by every key derived in the lookup. Other user agents are not counted,
+        batch and async lookups count their requests themselves.
+        @return string canonical user agent
+        '''
+        canonicalizer = self.getUserAgentCanonicalizer()
+        context       = self.getRequestContext()
+        if user_agent != context.userAgent:
+            return canonicalizer.canonicalize(user_agent, False)
+        if context.canonicalUserAgent is None:
+            context.canonicalUserAgent = canonicalizer.canonicalize(user_agent)
+        return context.canonicalUserAgent
+
+
+    def getMemCacheHashKey(self, user_agent, cookie, headers=None):
+        '''
+        MEM CACHE > Creates a cache key for this item by taking the md5 hash
+        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        '''
+
+        if self.DEBUG:
+            print "getting memcache hash key for " + user_agent
+        key = md5(self.getCacheKeySource(user_agent, cookie, headers).encode('utf-8')).hexdigest()
+        if self.DEBUG:
+            print(self.MEMCACHE_KEY_PREFIX + key)
+        return self.MEMCACHE_KEY_PREFIX + key
+
+
+    def getServersLatencies(self, numRequests=AUTO_SERVER_RANKING_NUM_REQUESTS):
+        '''
+        Get servers and the latencies to provide service. Servers are probed
+        concurrently, SERVERS is not modified.
+        @param  number number of requests to do when testing an end pint
+        @return list [{avg:, latencies:, host:, port:},]
+        '''
+
+        if self.DEBUG:
+            print "getting server latencies"
+        servers   = [dict(server) for server in self.SERVERS]
+        latencies = runConcurrently(
+            [
+                lambda server=server: self.getServerLatency(server, numRequests)
+                for server in servers
+            ],
+            len(servers)
+        )
+
+        for server, server_latencies in zip(servers, latencies):
+            server['latencies'] = server_latencies
+            if -1 in server_latencies:
+                server['avg'] = -1
+            else:
+                server['avg'] = sum(server_latencies) / numRequests
+
+        return servers
+
+
+    def getServerLatency(self, server, numRequests):
+        '''
+        Send request(s) to a server and return the latencies
+        '''
+
+        if self.DEBUG:
+            print "getting server latency"
+        failures  = 0
+        latencies = []
+        # ignore the first call because it can take an unreal long time
+        for i in range(numRequests + 1):
+            if failures < self.AUTO_SERVER_RANKING_MAX_FAILURE:
+                errors = []
+                start = time.time()
+
+                response = self.__connectCloud(
+                    server,
+                    self.TEST_USERAGENT,
+                    '',
+                    errors,
+                    True,
+                    {}
+                )
+
+                if errors == [] and response != None:
+                    if i > 0:
+                        latencies.append((time.time() - start) * 1000)
+                    continue
+
+                failures += 1
+                latencies.append(-1)
+
+        return latencies
+
+
+    def getServers(self):
+        '''
+        Get server list sorted by preference. If no ranked list is cached the
+        servers are ranked in the background and SERVERS is used meanwhile.
+        @return dictionary Nodes/Instances list
+        '''
+
+
+        if self.DEBUG:
+            print "getting servers"
+
+        servers = self.SERVERS
+        keys    = []
+        if self.AUTO_SERVER_RANKING:
+            keys.append(self.MEMCACHE_KEY_SERVER_RANKS)
+        if self.USE_CIRCUIT_BREAKER:
+            keys.append(self.MEMCACHE_KEY_CIRCUITS)
+        if self.USE_ADAPTIVE_TIMEOUT:
+            keys.append(self.MEMCACHE_KEY_SERVER_LATENCIES)
+        cache = memcache.get_multi(keys) if keys else {}
+        if self.MEMCACHE_KEY_SERVER_LATENCIES in cache:
+            self.getLatencyTracker().merge(
+                json.loads(cache[self.MEMCACHE_KEY_SERVER_LATENCIES])
+            )
+
+        if self.AUTO_SERVER_RANKING:
+            # fetch server ranked list from cache if exists
+            if self.MEMCACHE_KEY_SERVER_RANKS in cache:
+                servers = json.loads(cache[self.MEMCACHE_KEY_SERVER_RANKS])
+            else:
+                self.startServerRanking()
+
+        return self.skipOpenServers(servers, cache.get(self.MEMCACHE_KEY_CIRCUITS))
+
+
+    def skipOpenServers(self, servers, circuits=None):
+        '''
+        Remove the servers which are phased out by the circuit breaker, if all
+        servers are phased out the list is returned as is
+        @param list   servers  servers sorted by preference
+        @param string circuits circuit states mirrored in memcache (JSON)
+        @return       list of servers sorted by preference
+        '''
+        if not self.USE_CIRCUIT_BREAKER:
+            return servers
+        breaker = self.getCircuitBreaker()
+        if circuits:
+            breaker.merge(json.loads(circuits))
+        available = [
+            server for server in servers if breaker.isAvailable(server['host'])
+        ]
+        return available or servers
+
+
+    def allowServer(self, server):
+        '''
+        Ask the circuit breaker if a request can be sent to a server. When all
+        the servers are phased out skipOpenServers() returns them all and the
+        request is let through as a trial request.
+        @param dict server {host:, port:}
+        @return    bool
+        '''
+        breaker = self.getCircuitBreaker()
+        return breaker.allow(server['host']) or \
+            breaker.allowTrial(server['host'], [x['host'] for x in self.SERVERS])
+
+
+    def recordServerResult(self, host, ok):
+        '''
+        Pass the result of a cloud request to the circuit breaker, when the
+        circuit of the server opens or closes the open circuits are mirrored
+        to memcache so other instances skip the server too
+        @param bool ok true = the server gave service
+        '''
+        breaker = self.getCircuitBreaker()
+        if breaker.record(host, ok):
+            if self.DEBUG:
+                print "server " + host + " circuit is " + breaker.getState(host)
+            try:
+                memcache.set(
+                    key   = self.MEMCACHE_KEY_CIRCUITS,
+                    value = json.dumps(breaker.getOpenCircuits()),
+                    time  = self.SERVER_PHASEOUT_LIFETIME * 60
+                )
+            except Exception as err:
+                if self.DEBUG:
+                    print "mirroring circuits failed: " + str(err)
+
+
+    def getCloudTimeout(self, server):
+        '''
+        Timeout (seconds) of a request to a server, with USE_ADAPTIVE_TIMEOUT
+        derived from the latency estimate of the server. The timeout is halved
+        for each request the server failed to answer since its last answer, so
+        a hanging server is not waited on for the full timeout every time, but
+        not below the latency the server is known to answer with.
+        @param dict server {host:, port:}
+        '''
+        if not self.USE_ADAPTIVE_TIMEOUT:
+            return self.CLOUD_SERVICE_TIMEOUT
+        tracker  = self.getLatencyTracker()
+        estimate = tracker.getEstimate(server['host'])
+        if estimate is None:
+            timeout = self.CLOUD_SERVICE_TIMEOUT
+        else:
+            timeout = max(estimate['p99'], estimate['ewma']) / 1000.0 * \
+                self.ADAPTIVE_TIMEOUT_FACTOR
+        failures = tracker.getFailures(server['host'])
+        if failures:
+            latency = tracker.getLatency(server['host']) or 0
+            timeout = max(
+                timeout / 2 ** min(failures, 10),
+                latency / 1000.0 * self.ADAPTIVE_TIMEOUT_FAILURE_MARGIN
+            )
+        return min(max(timeout, self.ADAPTIVE_TIMEOUT_MIN_SEC), self.CLOUD_SERVICE_TIMEOUT)
+
+
+    def recordServerLatency(self, host, ms):
+        '''
+        Pass the latency of an answered request to the latency tracker, the
+        estimates are published to memcache every ADAPTIVE_TIMEOUT_PUBLISH_SEC
+        @param float ms duration of the request in milliseconds
+        '''
+        tracker = self.getLatencyTracker()
+        tracker.record(host, ms)
+        cls = self.__class__
+        now = time.time()
+        with cls.sharedLock:
+            if cls.latenciesPublished + self.ADAPTIVE_TIMEOUT_PUBLISH_SEC > now:
+                return
+            cls.latenciesPublished = now
+        estimates = tracker.getEstimates()
+        if not estimates:
+            return
+        try:
+            memcache.set(
+                key   = self.MEMCACHE_KEY_SERVER_LATENCIES,
+                value = json.dumps(estimates),
+                time  = self.MEMCACHE_SERVER_RANKS_EXPIRY_SEC
+            )
+        except Exception as err:
+            if self.DEBUG:
+                print "publishing server latencies failed: " + str(err)
+
+
+    def getFailoverRanking(self, servers, i):
+        '''
+        Server list after servers[i] gave service: the servers which failed
+        before it are moved to the end, servers which were skipped (phased
+        out) come last
+        @param list servers servers in the order they were tried
+        @param int  i       index of the healthy server
+        '''
+        ranked = list(servers[i:]) + list(servers[:i])
+        hosts  = [server['host'] for server in ranked]
+        return ranked + [
+            server for server in self.SERVERS if server['host'] not in hosts
+        ]
+
+
+    def startServerRanking(self):
+        '''
+        Rank the servers in a background thread so no request waits for the
+        latency probes. Only one ranking thread runs per process and a
+        memcache lease makes sure only one instance ranks at a time.
+        @return bool true if a ranking thread was started
+        '''
+        cls = self.__class__
+        with cls.sharedLock:
+            if cls.rankingThread is not None and cls.rankingThread.is_alive():
+                return False
+            thread = threading.Thread(target=self.__rankServersInBackground)
+            thread.daemon     = True
+            cls.rankingThread = thread
+        thread.start()
+        return True
+
+
+    def __rankServersInBackground(self):
+        '''
+        Body of the ranking thread, ranks the servers if this instance gets
+        the ranking lease
+        '''
+        try:
+            if not memcache.add(
+                key   = self.MEMCACHE_KEY_SERVER_RANKS_LEASE,
+                value = 1,
+                time  = self.SERVER_RANKING_LEASE_SEC
+            ):
+                # another instance is ranking the servers
+                return
+            try:
+                self.rankServers()
+            finally:
+                memcache.delete(key = self.MEMCACHE_KEY_SERVER_RANKS_LEASE)
+
+        except Exception as err:
+            if self.DEBUG:
+                print "ranking servers failed: " + str(err)
+
+
+    def rankServers(self, servers=None):
+        '''
+         Rank DA cloud servers then put ranked server list in memcache. The
+         list is published with a single memcache set.
+         @param  servers array None: rank and memcache automatically
+                               list: brutally memcache given server list without ranking
+         @return bool state of success
+        '''
+
+        if self.DEBUG:
+            print "ranking servers"
+        # rank servers
+        if not servers:
+            self.metrics.increment('ranking.runs')
+            servers = []
+            for server in self.getServersLatencies():
+                if server['avg'] != -1:
+                    servers.append(server)
+            # no server detected
+            if servers == []:
+                return False
+            # sort by latency ASC
+            servers.sort(key=lambda x: x['avg'])
+        # cache ranked servers
+        return memcache.set(key = self.MEMCACHE_KEY_SERVER_RANKS, value = json.dumps(servers), time = self.MEMCACHE_SERVER_RANKS_EXPIRY_SEC)
+
+
+    def getCloudUrl(self, context=None):
+        '''
+        Get the DA cloud service server used to get the properties of the
+        last lookup made by the calling thread (returns None if cache was used).
+        @param  RequestContext context the context of an AsyncClient lookup,
+                                       None = the lookup of the calling thread
+        @return None: properties came from cache/no property was fetched or
+                {host: server-address, port: server-port}
+        '''
+        if context is None:
+            context = self.getRequestContext()
+        return context.calledServer
+
+
+
+class NdbMemcacheBackend:
+    '''
+    Default cache backend of AsyncClient. Memcache is used through the ndb
+    context so calls made by concurrent lookups are batched into few RPCs.
+    A custom backend must provide the same two methods returning futures.
+    '''
+
+    def getAsync(self, key):
+        '''
+        @return future of the cached value or None
+        '''
+        return ndb.get_context().memcache_get(key)
+
+
+    def setAsync(self, key, value, time=0):
+        '''
+        @return future of the success state
+        '''
+        return ndb.get_context().memcache_set(key, value, time=time)
+
+
+class AsyncClient(Client):
+    '''
+    Non blocking DeviceAtlas Cloud client. Configuration and results are the
+    same as Client but lookups are ndb tasklets so one event loop can keep
+    many of them in flight. Cache calls go through a pluggable async backend
+    and cloud calls use async urlfetch.
+
+        da     = AsyncClient()
+        future = da.getDeviceDataAsync(request.META)
+        data   = future.get_result()
 
-        key = self.getMemCacheHashKey(user_agent, cookie)
+    Or inside a tasklet:
+        data = yield da.getDeviceDataAsync(headers)
 
-        memcache.set(key = key, value = device_data, time = self.MEMCACHE_ITEM_EXPIRY_SEC)
+    The tasklets of a thread share it, so each lookup has its own
+    RequestContext: pass one to getDeviceDataAsync() and then to
+    getCloudUrl() to get the server called by the lookup. USE_SINGLE_FLIGHT
+    coalesces the lookups of a device running in the same thread (event
+    loop) at once, the memcache lease of SINGLE_FLIGHT_USE_LEASE is not
+    used. CLOUD_SERVICE_HEDGED is not supported (the lookups fail) and there
+    is no lookup budget, CLOUD_SERVICE_TIMEOUT is the urlfetch deadline.
+    '''
 
+    # cloud calls shared by the coalesced lookups by (thread, memcache key),
+    # see fetchDeviceDataAsync()
+    asyncFlights = {}
 
-    def getMemCache(self, user_agent, cookie):
+    def __init__(self, cache_backend=None):
         '''
-        MEM CACHE > Creates a memcache key for this item by taking the md5 hash.
-        Uses key to retrieve memcache value.
-        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        @param object cache_backend object with getAsync(key) and
+                      setAsync(key, value, time) methods returning futures,
+                      None = NdbMemcacheBackend
         '''
+        Client.__init__(self)
+        self.cacheBackend = cache_backend or NdbMemcacheBackend()
 
-        if self.DEBUG:
-            print ("reading memcached devicedata for " + user_agent)
-        key = self.getMemCacheHashKey(user_agent, cookie)
-        return memcache.get(key = key)
 
-    def getFileCache(self, user_agent, cookie):
+    @ndb.tasklet
+    def getDeviceDataAsync(self, headers={}, test_mode=False, context=None):
         '''
-        FILE CACHE > Creates a cache path for this item by taking the md5 hash
-        and using the first 4 characters to create a directory structure.
-        This is done to prevent too many files existing in any one directory
-        as this can lead to slowdowns
-        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        Non blocking getDeviceData()
+        @param dict           headers   a dictionary of HTTP headers set manually
+        @param bool           test_mode true = use a fake useragent to test and get results
+        @param RequestContext context   gets the state of this lookup (e.g. the
+                                        server called), None = a new one
+        @return     future of the getDeviceData() results
         '''
-        path = self.getFileCacheDir(user_agent, cookie)
-        if os.path.exists(path) and \
-           os.path.getmtime(path) + self.CACHE_ITEM_EXPIRY_SEC > time.time():
+        if self.CLOUD_SERVICE_HEDGED:
+            raise Exception('CLOUD_SERVICE_HEDGED is not supported by AsyncClient')
 
-            for i in (1, 2, 3, 4):
-                try:
-                    fp = open(path)
-                    device_data = fp.read()
-                    fp.close()
-                    return device_data
+        if self.DEBUG:
+            print "getting Device Data (async)"
+        user_agent, headers, cookie = self.prepareRequest(headers, test_mode)
+        cookie, cookie_properties   = self.splitClientCookie(cookie)
+        if context is None:
+            context = RequestContext()
+        context.userAgent = user_agent
+        context.headers   = headers
+        context.cookie    = cookie
+        if self.USE_UA_CANONICALIZATION:
+            # the tasklets share the thread context, the keys do not count it
+            context.canonicalUserAgent = \
+                self.getUserAgentCanonicalizer().canonicalize(user_agent)
+
+        results = {}
+        source  = self.SOURCE_NONE
+        tiers   = self.getCacheTiers()
+        try:
+            for i, tier in enumerate(tiers):
+                if tier == self.SOURCE_MEMCACHE:
+                    device_data = yield self.getMemCacheAsync(user_agent, cookie, headers)
+                else:
+                    device_data = self.getCacheTier(tier, user_agent, cookie, headers)
+                if device_data and self.PROPERTIES in device_data:
+                    self.metrics.increment('cache.' + tier + '.hits')
+                    yield self.setCachesAsync(
+                        user_agent, cookie, device_data, headers, tiers[:i]
+                    )
+                    results = self.copyDeviceData(device_data)
+                    source  = self.checkStale(
+                        user_agent, cookie, device_data, tier, headers
+                    )
+                    break
+                self.metrics.increment('cache.' + tier + '.misses')
+
+            if not results:
+                results, source = self.getLocalIndexData(user_agent, cookie)
 
+            if not results:
+                source  = self.SOURCE_CLOUD
+                try:
+                    results = yield self.fetchDeviceDataAsync(
+                        user_agent, cookie, headers, context
+                    )
                 except Exception as err:
-                    time.sleep(1)
+                    results, source = self.getLocalIndexData(user_agent, cookie, True)
+                    if not results:
+                        raise err
 
-        return ''
+            if not results:
+                results = {}
 
+        except Exception as err:
+            results = {self.ERROR: str(err)}
 
-    def getCacheBasePath(self):
-        '''
-        FILE CACHE > Returns the path to save the file cache, it can be the
-        default path or the assigned one through the CUSTOM_CACHE_DIR constant
-        '''
-        if self.USE_SYSTEM_TEMP_DIR:
-            base_path = tempfile.gettempdir()
-        else:
-            base_path = self.CUSTOM_CACHE_DIR
+        raise ndb.Return(
+            self.completeResults(results, source, user_agent, cookie_properties)
+        )
 
-        return base_path + os.sep + self.CACHE_NAME + os.sep
 
-    def getFileCacheDir(self, user_agent, cookie):
+    def fetchDeviceDataAsync(self, user_agent, cookie, headers, context):
         '''
-        FILE CACHE > Creates a cache path for this item by taking the md5 hash
-        and using the first 4 characters to create a directory structure.
-        This is done to prevent too many files existing in any one directory
-        as this can lead to slowdowns
-        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        Get device data from the cloud and cache it without blocking, with
+        USE_SINGLE_FLIGHT the lookups of the same device running in the
+        thread at once share one cloud call
+        @param RequestContext context gets the server called
+        @return future of the device data, a copy for each lookup
         '''
-        headers = self.__headers
-        # cache key - combination of user agent and cookie
-        for header in self.ESSENTIAL_USER_AGENT_HEADERS:
-            if header in headers:
-                user_agent += headers[header]
-                break
-
-        key = md5(('py' + user_agent + cookie).encode('utf-8')).hexdigest()
-        return \
-            self.getCacheBasePath() +\
-            key[0:2] +\
-            os.sep +\
-            key[2:4] +\
-            os.sep +\
-            key[4:len(key)]
+        key    = None
+        flight = None
+        if self.USE_SINGLE_FLIGHT:
+            # futures belong to the event loop of their thread
+            key = (
+                threading.current_thread().ident,
+                self.getMemCacheHashKey(user_agent, cookie, headers)
+            )
+            flight = self.asyncFlights.get(key)
+        if flight is None:
+            flight = self.__fetchShared(key, user_agent, cookie, headers)
+            if key is not None and not flight.done():
+                self.asyncFlights[key] = flight
+        return self.__joinFlight(flight, context)
 
 
-    def getMemCacheHashKey(self, user_agent, cookie):
+    @ndb.tasklet
+    def __fetchShared(self, key, user_agent, cookie, headers):
         '''
-        MEM CACHE > Creates a cache key for this item by taking the md5 hash
-        @param string cookie "DeviceAtlas Client Side Component" cookie data
+        The cloud call shared by the lookups of fetchDeviceDataAsync()
+        @return future of the tuple (device data, server called)
         '''
+        context = RequestContext(user_agent, headers, cookie)
+        try:
+            results = yield self.callCloudServiceAsync(
+                user_agent, cookie, headers, context
+            )
+            if self.CACHE_SOFT_EXPIRY_SEC:
+                results[self.CACHED_AT] = time.time()
+            yield self.setCachesAsync(
+                user_agent, cookie, results, headers, self.getCacheTiers()
+            )
+        finally:
+            if key is not None:
+                self.asyncFlights.pop(key, None)
+        raise ndb.Return((results, context.calledServer))
 
-        if self.DEBUG:
-            print "getting memcache hash key for " + user_agent
-        headers = self.__headers
-        # cache key - combination of user agent and cookie
-        for header in self.ESSENTIAL_USER_AGENT_HEADERS:
-            if header in headers:
-                user_agent += headers[header]
-                break
 
-        key = md5(('py' + user_agent + cookie).encode('utf-8')).hexdigest()
-        if self.DEBUG:
-            print(self.MEMCACHE_KEY_PREFIX + key)
-        return self.MEMCACHE_KEY_PREFIX + key
+    @ndb.tasklet
+    def __joinFlight(self, flight, context):
+        '''
+        Wait for a shared cloud call
+        @return future of the device data copied for the caller
+        '''
+        results, server = yield flight
+        context.calledServer = server
+        raise ndb.Return(self.copyDeviceData(results))
 
 
-    def getServersLatencies(self, numRequests=AUTO_SERVER_RANKING_NUM_REQUESTS):
+    @ndb.tasklet
+    def setCachesAsync(self, user_agent, cookie, device_data, headers, tiers):
         '''
-        Get servers and the latencies to provide service.
-        @param  number number of requests to do when testing an end pint
-        @return dict {{avg:, latencies:, server:, port:},}
+        Non blocking setCaches(), only the memcache tier is written without
+        blocking
+        @return future
         '''
-
-        if self.DEBUG:
-            print "getting server latencies"
-        # test servers in a randomly order
-        servers = self.SERVERS
-        seed    = list(range(len(servers)))
-        shuffle(seed)
-
-        for i in seed:
-            latencies = self.getServerLatency(servers[i], numRequests)
-            servers[i]['latencies'] = latencies
-            if -1 in latencies:
-                servers[i]['avg'] = -1
+        for tier in tiers:
+            if tier == self.SOURCE_MEMCACHE:
+                yield self.setMemCacheAsync(user_agent, cookie, device_data, headers)
             else:
-                servers[i]['avg'] = sum(servers[i]['latencies']) / numRequests
-        
-        return servers
+                self.setCacheTier(tier, user_agent, cookie, device_data, headers)
 
 
-    def getServerLatency(self, server, numRequests):
+    @ndb.tasklet
+    def getMemCacheAsync(self, user_agent, cookie, headers=None):
         '''
-        Send request(s) to a server and return the latencies
+        MEM CACHE > Non blocking getMemCache()
+        @return future of the cached device data or None
         '''
+        key     = self.getMemCacheHashKey(user_agent, cookie, headers)
+        started = time.time()
+        value   = yield self.cacheBackend.getAsync(key)
+        self.metrics.observe('cache.memcache.get_ms', (time.time() - started) * 1000)
+        raise ndb.Return(self.decodeRecord(value))
 
-        if self.DEBUG:
-            print "getting server latency"
-        failures  = 0
-        latencies = []
-        # ignore the first call because it can take an unreal long time
-        for i in range(numRequests + 1):
-            if failures < self.AUTO_SERVER_RANKING_MAX_FAILURE:
-                errors = []
-                start = time.time()
 
-                response = self.__connectCloud(
-                    server,
-                    self.TEST_USERAGENT,
-                    '',
-                    errors
-                )
+    def setMemCacheAsync(self, user_agent, cookie, device_data, headers=None):
+        '''
+        MEM CACHE > Non blocking setMemCache()
+        @return future of the success state
+        '''
+        key = self.getMemCacheHashKey(user_agent, cookie, headers)
+        return self.cacheBackend.setAsync(
+            key, self.encodeRecord(device_data), self.MEMCACHE_ITEM_EXPIRY_SEC
+        )
 
-                if errors == [] and response != None:
-                    if i > 0:
-                        latencies.append((time.time() - start) * 1000)
-                    continue
 
-                failures += 1
-                latencies.append(-1)
+    @ndb.tasklet
+    def callCloudServiceAsync(self, user_agent, cookie, headers=None, context=None):
+        '''
+        Get data from the DeviceAtlas Cloud service, servers are tried one
+        after another by preference
+        @param RequestContext context gets the server called, None = the
+                                      context of the thread
+        @return future of the device data, fails if no server gave service
+        '''
+        if context is None:
+            context = self.getRequestContext()
+        errors  = []
+        servers = yield self.getServersAsync()
 
-        return latencies
+        for i, server in enumerate(servers):
+            response = yield self.connectCloudAsync(
+                server, user_agent, cookie, errors, headers=headers
+            )
+            context.calledServer = server
+            if response != None:
+                # move the failed servers to the end of the list
+                if i > 0:
+                    self.metrics.increment('cloud.failovers')
+                    yield self.rankServersAsync(self.getFailoverRanking(servers, i))
+                raise ndb.Return(response)
 
+        self.metrics.increment('cloud.failures')
+        raise Exception(('\n').join(errors))
 
-    def getServers(self):
+
+    @ndb.tasklet
+    def connectCloudAsync(self, server, user_agent, cookie, errors, latency_checker=False, headers=None):
         '''
-        Get server list sorted by preference.
-        @return dictionary Nodes/Instances list
+        Connect to a cloud server using async urlfetch
+        @return future of the device data or None
         '''
+        if self.DEBUG:
+            print ("connecting to Device Atlas server (async) " + server['host'])
+        use_breaker = self.USE_CIRCUIT_BREAKER and not latency_checker
+        if use_breaker and not self.allowServer(server):
+            errors.append('Server ('+server['host']+') is phased out')
+            self.metrics.increment('cloud.' + server['host'] + '.phased_out')
+            raise ndb.Return(None)
+        path, headers = self.getCloudRequest(
+            user_agent, cookie, latency_checker, headers
+        )
+        if latency_checker:
+            timeout = self.CLOUD_SERVICE_TIMEOUT
+        else:
+            timeout = self.getCloudTimeout(server)
+        device_data = None
+        data        = None
+        started     = time.time()
+        try:
+            res = yield ndb.get_context().urlfetch(
+                'http://' + server['host'] + ':' + str(server['port']) + path,
+                headers=headers,
+                deadline=timeout
+            )
+            data = res.content
+            if res.status_code < 200 or res.status_code >= 300:
+                raise Exception('HTTP Error %d' % res.status_code)
+            device_data = self.parseCloudResponse(server, data, errors)
+
+        except Exception as err:
+            errors.append(
+                'Error fetching DeviceAtlas data from Cloud server "' + \
+                server['host'] + '". ' + str(err)
+            )
 
+        self.recordCloudMetrics(server, started, data, device_data, latency_checker)
+        if self.USE_ADAPTIVE_TIMEOUT and \
+           (self.ADAPTIVE_TIMEOUT_USE_PROBES or not latency_checker):
+            if device_data != None:
+                self.recordServerLatency(server['host'], (time.time() - started) * 1000)
+            else:
+                self.getLatencyTracker().recordFailure(server['host'])
+        if use_breaker:
+            self.recordServerResult(server['host'], device_data != None)
+        raise ndb.Return(device_data)
 
-        if self.DEBUG:
-            print "getting servers"
+
+    @ndb.tasklet
+    def getServersAsync(self):
+        '''
+        Non blocking getServers(), if there is no ranked list in the cache the
+        servers are ranked by the background ranking thread
+        @return future of the server list sorted by preference
+        '''
+        servers = self.SERVERS
+        # the three cache reads are started before waiting for any of them
+        ranks_future = circuits_future = latencies_future = None
+        ranks = circuits = latencies = None
+        if self.AUTO_SERVER_RANKING:
+            ranks_future = self.cacheBackend.getAsync(self.MEMCACHE_KEY_SERVER_RANKS)
+        if self.USE_CIRCUIT_BREAKER:
+            circuits_future = self.cacheBackend.getAsync(self.MEMCACHE_KEY_CIRCUITS)
+        if self.USE_ADAPTIVE_TIMEOUT:
+            latencies_future = self.cacheBackend.getAsync(
+                self.MEMCACHE_KEY_SERVER_LATENCIES
+            )
+        if ranks_future:
+            ranks = yield ranks_future
+        if circuits_future:
+            circuits = yield circuits_future
+        if latencies_future:
+            latencies = yield latencies_future
+        if latencies:
+            self.getLatencyTracker().merge(json.loads(latencies))
 
         if self.AUTO_SERVER_RANKING:
-            # fetch server ranked list from cache if exists
-            cache = memcache.get(key = self.MEMCACHE_KEY_SERVER_RANKS)
-            if cache != None:
-                return json.loads(cache)
-            self.rankOnDestruct = True
+            if ranks != None:
+                servers = json.loads(ranks)
+            else:
+                self.startServerRanking()
 
-        return self.SERVERS
+        raise ndb.Return(self.skipOpenServers(servers, circuits))
 
 
-    def rankServers(self, servers=[]):
+    @ndb.tasklet
+    def rankServersAsync(self, servers=None):
         '''
-         Rank DA cloud servers then put ranked server list in memcache.
-         @param  servers array None: rank and memcache automatically
-                               []: brutally memcache given server list without ranking
-         @return bool state of success
+        Non blocking rankServers(), all servers are probed concurrently
+        @param  servers list None: rank and cache automatically
+                             list: cache given server list without ranking
+        @return future of the success state
         '''
-
-        if self.DEBUG:
-            print "ranking servers"
-        # rank servers
-        if servers == []:
-            for server in self.getServersLatencies():
-                if server['avg'] != -1:
-                    servers.append(server)
-            # no server detected
+        if servers is None:
+            self.metrics.increment('ranking.runs')
+            servers = [
+                server for server in (yield self.getServersLatenciesAsync())
+                if server['avg'] != -1
+            ]
             if servers == []:
-                return False
-            # sort by latency ASC
+                raise ndb.Return(False)
             servers.sort(key=lambda x: x['avg'])
-        # cache ranked servers
-        ok       = True
-        # try to put cache
-        return memcache.set(key = self.MEMCACHE_KEY_SERVER_RANKS, value = json.dumps(servers), time = self.MEMCACHE_SERVER_RANKS_EXPIRY_SEC)
+
+        ok = yield self.cacheBackend.setAsync(
+            self.MEMCACHE_KEY_SERVER_RANKS,
+            json.dumps(servers),
+            self.MEMCACHE_SERVER_RANKS_EXPIRY_SEC
+        )
+        raise ndb.Return(ok)
 
 
-    def getCloudUrl(self):
+    @ndb.tasklet
+    def getServersLatenciesAsync(self, numRequests=Client.AUTO_SERVER_RANKING_NUM_REQUESTS):
         '''
-        Get the last DA cloud service server used to get property
-        (returns None if cache was used).
-        @return None: properties came from cache/no property was fetched or
-                {host: server-address, port: server-port}
+        Non blocking getServersLatencies(), servers are probed concurrently
+        @return future of the list [{avg:, latencies:, host:, port:},]
         '''
-        return self.calledServer
+        latencies = yield [
+            self.getServerLatencyAsync(server, numRequests)
+            for server in self.SERVERS
+        ]
+        servers = []
+        for server, server_latencies in zip(self.SERVERS, latencies):
+            server = dict(server)
+            server['latencies'] = server_latencies
+            if -1 in server_latencies:
+                server['avg'] = -1
+            else:
+                server['avg'] = sum(server_latencies) / numRequests
+            servers.append(server)
 
+        raise ndb.Return(servers)
 
-    def __del__(self):
+
+    @ndb.tasklet
+    def getServerLatencyAsync(self, server, numRequests):
         '''
-        If server list needs to be resorted or build > when object is deleted
+        Non blocking getServerLatency()
+        @return future of the list of latencies
         '''
-        if self.rankOnDestruct:
-            self.rankServers()
+        failures  = 0
+        latencies = []
+        # ignore the first call because it can take an unreal long time
+        for i in range(numRequests + 1):
+            if failures < self.AUTO_SERVER_RANKING_MAX_FAILURE:
+                errors   = []
+                start    = time.time()
+                response = yield self.connectCloudAsync(
+                    server, self.TEST_USERAGENT, '', errors, True, {}
+                )
+                if errors == [] and response != None:
+                    if i > 0:
+                        latencies.append((time.time() - start) * 1000)
+                    continue
+
+                failures += 1
+                latencies.append(-1)
+
+        raise ndb.Return(latencies)
 
 
 
@@ -696,6 +5285,332 @@ def test():
 
 
 
+class TopCounter:
+    '''
+    Counts items of a stream in bounded memory. When more than twice the
+    capacity distinct items are tracked only the most frequent ones are kept,
+    so counts of rare items are approximate (lossy counting).
+    '''
+
+    def __init__(self, capacity=10000):
+        '''
+        @param int capacity number of items kept after pruning
+        '''
+        self.capacity = capacity
+        self.total    = 0
+        self.__counts = {}
+
+
+    def add(self, item, count=1):
+        self.total += count
+        self.__counts[item] = self.__counts.get(item, 0) + count
+        if len(self.__counts) > self.capacity * 2:
+            self.__counts = dict(self.top(self.capacity))
+
+
+    def top(self, n):
+        '''
+        @return list [(item, count),] of the n most frequent items
+        '''
+        return sorted(self.__counts.items(), key=lambda x: -x[1])[:n]
+
+
+class RateLimiter:
+    '''
+    Thread safe limiter of the number of operations per second
+    '''
+
+    def __init__(self, rate):
+        '''
+        @param float rate max operations per second, 0 = no limit
+        '''
+        self.rate   = rate
+        self.__next = time.time()
+        self.__lock = threading.Lock()
+
+
+    def wait(self, n=1):
+        '''
+        Block until n more operations are allowed
+        '''
+        if not self.rate:
+            return
+        with self.__lock:
+            now         = time.time()
+            start       = max(now, self.__next)
+            self.__next = start + float(n) / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def readUserAgents(paths, pattern=r'"([^"]*)"\s*$'):
+    '''
+    Stream the user agents of access log files (gzip files are decompressed
+    on the fly), by default the last quoted field of each line is the user
+    agent as in the combined log format
+    @param list   paths   log file paths, '-' = stdin
+    @param string pattern regular expression, group 1 is the user agent
+    @return       generator of user agents
+    '''
+    import gzip
+    pattern = re.compile(pattern)
+    for path in paths:
+        if path == '-':
+            fp = sys.stdin
+        elif path.endswith('.gz'):
+            fp = gzip.open(path, 'rb')
+        else:
+            fp = open(path, 'rb')
+        try:
+            for line in fp:
+                if not isinstance(line, str):
+                    line = line.decode('utf-8', 'replace')
+                match = pattern.search(line)
+                if match and match.group(1) not in ('', '-'):
+                    yield match.group(1)
+        finally:
+            if fp is not sys.stdin:
+                fp.close()
+
+
+def warmCache(paths, top=1000, rate=20, client=None, capacity=100000, pattern=r'"([^"]*)"\s*$'):
+    '''
+    Pre-warm the device cache from access logs. The user agents of the logs
+    are counted in bounded memory, the most frequent ones which are not
+    cached yet are fetched from the cloud (rate limited) and cached with the
+    same keys getDeviceData() uses.
+    @param list   paths    access log file paths ('-' = stdin, *.gz = gzip)
+    @param int    top      number of most frequent user agents to warm
+    @param float  rate     max cloud requests per second, 0 = no limit
+    @param Client client   client to use, None = a new Client
+    @param int    capacity max number of distinct user agents counted
+    @param string pattern  regular expression, group 1 is the user agent
+    @return       dict report {lines:, distinct:, warmed:, cached:, fetched:,
+                  failed:, coverage_before:, coverage_after:, seconds:,
+                  lookups_per_sec:}
+    '''
+    da      = client or Client()
+    start   = time.time()
+    counter = TopCounter(capacity)
+    for user_agent in readUserAgents(paths, pattern):
+        counter.add(user_agent)
+    ranked  = counter.top(top)
+    counted = time.time()
+
+    # find which user agents are cached already, memcache is checked in batches
+    cached  = set()
+    tiers   = da.getCacheTiers()
+    if da.SOURCE_MEMCACHE in tiers:
+        batch_size = 500
+        for i in range(0, len(ranked), batch_size):
+            keys = dict(
+                (da.getMemCacheHashKey(user_agent, '', {}), user_agent)
+                for user_agent, count in ranked[i:i + batch_size]
+            )
+            for key, value in memcache.get_multi(list(keys)).items():
+                if (da.decodeRecord(value) or {}).get(da.PROPERTIES):
+                    cached.add(keys[key])
+    elif da.SOURCE_FILE_CACHE in tiers:
+        for user_agent, count in ranked:
+            if da.getFileCache(user_agent, '', {}):
+                cached.add(user_agent)
+
+    # fetch the missing ones, most frequent first
+    missing = [user_agent for user_agent, count in ranked if user_agent not in cached]
+    limiter = RateLimiter(rate)
+    warmed  = set(cached)
+    failed  = 0
+    batch_size = max(1, da.CLOUD_SERVICE_MAX_CONCURRENCY)
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        limiter.wait(len(batch))
+        results = da.getDeviceDataMulti(
+            [{'HTTP_USER_AGENT': user_agent} for user_agent in batch]
+        )
+        for user_agent, results in zip(batch, results):
+            if da.PROPERTIES in results:
+                warmed.add(user_agent)
+            else:
+                failed += 1
+                if da.DEBUG:
+                    print "warming failed for " + user_agent + ": " + \
+                        str(results.get(da.ERROR))
+
+    seconds = time.time() - start
+    fetch_seconds = time.time() - counted
+
+    def coverage(user_agents):
+        if not counter.total:
+            return 0.0
+        return float(sum(
+            count for user_agent, count in ranked if user_agent in user_agents
+        )) / counter.total
+
+    return {
+        'lines':           counter.total,
+        'distinct':        len(ranked),
+        'cached':          len(cached),
+        'fetched':         len(missing) - failed,
+        'failed':          failed,
+        'warmed':          len(warmed),
+        # share of the logged requests which are served from the cache
+        'coverage_before': coverage(cached),
+        'coverage_after':  coverage(warmed),
+        'seconds':         seconds,
+        'lines_per_sec':   counter.total / (counted - start) if counted > start else 0,
+        'lookups_per_sec': len(ranked) / fetch_seconds if fetch_seconds else 0,
+    }
+
+
+def readDeviceDataDump(paths):
+    '''
+    Stream the device data of result dumps, one JSON object per line with
+    the user agent as "_useragent" or "useragent" and the "properties"
+    @param list paths dump file paths, '-' = stdin
+    @return     generator of (user agent, device data)
+    '''
+    for path in paths:
+        fp = sys.stdin if path == '-' else open(path, 'rb')
+        try:
+            for line in fp:
+                if not isinstance(line, str):
+                    line = line.decode('utf-8', 'replace')
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                user_agent = item.pop('_useragent', None) or item.pop('useragent', None)
+                if user_agent and Client.PROPERTIES in item:
+                    yield user_agent, item
+        finally:
+            if fp is not sys.stdin:
+                fp.close()
+
+
+def buildLocalIndex(output, paths=(), dumps=(), client=None, capacity=100000, pattern=r'"([^"]*)"\s*$'):
+    '''
+    Build the local device index (see Client.LOCAL_INDEX_PATH) without any
+    cloud calls. The user agents of access logs are looked up in the device
+    cache (memcache or file cache), device data dumps are added as they are.
+    @param string output   index file path
+    @param list   paths    access log file paths ('-' = stdin, *.gz = gzip)
+    @param list   dumps    device data dump file paths, see readDeviceDataDump()
+    @param Client client   client to use, None = a new Client
+    @param int    capacity max number of distinct log user agents
+    @param string pattern  regular expression, group 1 is the user agent
+    @return       dict report {distinct:, cached:, dumped:, entries:, bytes:,
+                  seconds:}
+    '''
+    da     = client or Client()
+    start  = time.time()
+    items  = OrderedDict()
+
+    counter = TopCounter(capacity)
+    for user_agent in readUserAgents(paths, pattern):
+        counter.add(user_agent)
+    ranked = [user_agent for user_agent, count in counter.top(capacity)]
+
+    # only the cached device data is used, memcache is read in batches
+    cached = 0
+    tiers  = da.getCacheTiers()
+    if da.SOURCE_MEMCACHE in tiers:
+        batch_size = 500
+        for i in range(0, len(ranked), batch_size):
+            keys = dict(
+                (da.getMemCacheHashKey(user_agent, '', {}), user_agent)
+                for user_agent in ranked[i:i + batch_size]
+            )
+            for key, value in memcache.get_multi(list(keys)).items():
+                device_data = da.decodeRecord(value)
+                if device_data and da.PROPERTIES in device_data:
+                    items[keys[key]] = device_data
+                    cached += 1
+    elif da.SOURCE_FILE_CACHE in tiers:
+        for user_agent in ranked:
+            device_data = da.getFileCache(user_agent, '', {})
+            if device_data and da.PROPERTIES in device_data:
+                items[user_agent] = device_data
+                cached += 1
+
+    dumped = 0
+    for user_agent, device_data in readDeviceDataDump(dumps):
+        items[user_agent] = device_data
+        dumped += 1
+
+    entries = LocalIndex.build(
+        output, items.items(), da.getRecordCodec(),
+        da.getLocalIndexCanonicalizer(), da.PROPERTIES
+    )
+    return {
+        'distinct': len(ranked),
+        'cached':   cached,
+        'dumped':   dumped,
+        'entries':  entries,
+        'bytes':    os.path.getsize(output),
+        'seconds':  time.time() - start,
+    }
+
+
+def main(argv):
+    '''
+    Command line entry point:
+        python ClientGAE.py                                 basic tests of cloud lookup
+        python ClientGAE.py warm [options] LOG...           pre-warm the device cache
+        python ClientGAE.py build-index [options] [LOG...]  build the local device index
+    '''
+    if len(argv) < 2 or argv[1] not in ('warm', 'build-index'):
+        test()
+        return
+
+    import argparse
+    if argv[1] == 'build-index':
+        parser = argparse.ArgumentParser(
+            prog='ClientGAE.py build-index',
+            description='Build the local DeviceAtlas device index from the '
+                        'device cache and device data dumps'
+        )
+        parser.add_argument('logs', nargs='*',
+                            help='access log files, *.gz or - for stdin, the '
+                                 'user agents are looked up in the cache')
+        parser.add_argument('--output', required=True, help='index file path')
+        parser.add_argument('--dump', action='append', default=[],
+                            help='JSON lines file of device data with the '
+                                 '"_useragent", can be repeated')
+        parser.add_argument('--capacity', type=int, default=100000,
+                            help='max number of distinct log user agents')
+        parser.add_argument('--pattern', default=r'"([^"]*)"\s*$',
+                            help='regular expression, group 1 is the user agent')
+        args = parser.parse_args(argv[2:])
+
+        PrettyPrinter(indent=4).pprint(buildLocalIndex(
+            args.output, args.logs, args.dump, None, args.capacity, args.pattern
+        ))
+        return
+
+    parser = argparse.ArgumentParser(
+        prog='ClientGAE.py warm',
+        description='Pre-warm the DeviceAtlas device cache from access logs'
+    )
+    parser.add_argument('logs', nargs='+', help='access log files, *.gz or - for stdin')
+    parser.add_argument('--top', type=int, default=1000,
+                        help='number of most frequent user agents to warm')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='max cloud requests per second, 0 = no limit')
+    parser.add_argument('--capacity', type=int, default=100000,
+                        help='max number of distinct user agents counted')
+    parser.add_argument('--pattern', default=r'"([^"]*)"\s*$',
+                        help='regular expression, group 1 is the user agent')
+    args = parser.parse_args(argv[2:])
+
+    PrettyPrinter(indent=4).pprint(warmCache(
+        args.logs, args.top, args.rate, None, args.capacity, args.pattern
+    ))
+
+
+
 
 if __name__ == '__main__':
-    test()
+    main(sys.argv)
@@ -0,0 +1,1167 @@
+'''
+Benchmarks of the DeviceAtlas Cloud client which run offline. Nothing leaves
+the machine: the cloud regions are emulated by local HTTP servers and App
+Engine memcache is replaced by an in-memory stand-in.
+
+    Parts:
+        MockCloudRegion  a local HTTP server answering CLOUD_PATH requests with
+                         a configurable latency, jitter and failure rate
+        memcache/ndb     in-memory stand-ins installed as google.appengine.*
+                         before ClientGAE is imported
+        UserAgentCorpus  synthetic user agents requested with a Zipf
+                         distribution (a few devices make most of the traffic)
+
+    Scenarios:
+        cold          empty caches, every distinct user agent is fetched once
+        write-behind  cold with the cache writes queued and written in batches
+        warm          caches filled by a previous run of the same traffic
+        warm-shared   the shared memory cache filled, other caches empty (a new
+                      worker process)
+        outage        the preferred region does not answer, requests fail over
+        deadline      the outage with a 100 ms budget per lookup (errors =
+                      lookups which returned without device data)
+        ranking       server ranking (latency probes of all regions)
+        stress        thousands of concurrent lookups on one Client object,
+                      every result is checked against its request (errors =
+                      mix ups)
+
+Run:
+    python benchmark.py
+    python benchmark.py --requests 5000 --threads 16 --scenario cold warm
+    python benchmark.py --region 20:5:0 --region 80:20:0.1 --json
+    python benchmark.py --micro
+
+Every scenario reports the throughput, the p50/p95/p99 latency of a request
+and the number of cloud calls per request. The micro benchmarks (MicroBenchmark)
+report the CPU time of the request preprocessing per call, of the legacy code
+and the current one, and of reading the results of a cached device with and
+without USE_LAZY_RESULTS. The regions listen on 127.0.0.N
+addresses so the client (which keys servers by host) sees distinct hosts.
+'''
+
+import sys, os, json, time, tempfile, threading, socket, bisect, types
+from hashlib import md5
+from random import Random
+if sys.version_info[0] == 2:
+    # python 2:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+else:
+    # python 3:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+class MemcacheStandIn:
+    '''
+    In-memory stand-in of google.appengine.api.memcache with the functions
+    used by the client. An optional latency emulates the memcache RPC.
+    '''
+
+    def __init__(self, latency=0):
+        '''
+        @param float latency seconds added to every call
+        '''
+        self.latency = latency
+        self.calls   = 0
+        self.__items = {}
+        self.__lock  = threading.Lock()
+
+
+    def get(self, key, namespace=None):
+        self.__call()
+        with self.__lock:
+            return self.__get(key)
+
+
+    def get_multi(self, keys, key_prefix='', namespace=None):
+        self.__call()
+        with self.__lock:
+            items = {}
+            for key in keys:
+                value = self.__get(key_prefix + key)
+                if value is not None:
+                    items[key] = value
+            return items
+
+
+    def set(self, key, value, time=0, namespace=None):
+        self.__call()
+        with self.__lock:
+            self.__set(key, value, time)
+        return True
+
+
+    def set_multi(self, mapping, time=0, key_prefix='', namespace=None):
+        self.__call()
+        with self.__lock:
+            for key, value in mapping.items():
+                self.__set(key_prefix + key, value, time)
+        return []
+
+
+    def add(self, key, value, time=0, namespace=None):
+        self.__call()
+        with self.__lock:
+            if self.__get(key) is not None:
+                return False
+            self.__set(key, value, time)
+        return True
+
+
+    def delete(self, key, seconds=0, namespace=None):
+        self.__call()
+        with self.__lock:
+            return 2 if self.__items.pop(key, None) is not None else 1
+
+
+    def incr(self, key, delta=1, namespace=None, initial_value=None):
+        self.__call()
+        with self.__lock:
+            value = self.__get(key)
+            if value is None:
+                if initial_value is None:
+                    return None
+                value = initial_value
+            value += delta
+            self.__set(key, value, 0)
+            return value
+
+
+    def flush_all(self):
+        with self.__lock:
+            self.__items.clear()
+        return True
+
+
+    def __call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+    def __get(self, key):
+        item = self.__items.get(key)
+        if item is None:
+            return None
+        if item[0] and item[0] < time.time():
+            del self.__items[key]
+            return None
+        return item[1]
+
+
+    def __set(self, key, value, expiry):
+        # memcache takes relative times up to 30 days, absolute ones above
+        if expiry and expiry <= 2592000:
+            expiry += time.time()
+        self.__items[key] = (expiry, value)
+
+
+class NdbFuture:
+    '''
+    Result holder of the ndb stand-in, everything runs synchronously
+    '''
+
+    def __init__(self, result=None, error=None):
+        self.__result = result
+        self.__error  = error
+
+
+    def get_result(self):
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+
+class NdbReturn(StopIteration):
+    pass
+
+
+def ndbTasklet(func):
+    '''
+    Synchronous stand-in of ndb.tasklet: the generator is driven to the end,
+    yielded futures (or lists of futures) are resolved at once
+    '''
+    def run(*args, **kwargs):
+        try:
+            gen = func(*args, **kwargs)
+            if not isinstance(gen, types.GeneratorType):
+                return NdbFuture(gen)
+            value = error = None
+            while True:
+                try:
+                    if error is not None:
+                        yielded, error = gen.throw(error), None
+                    else:
+                        yielded = gen.send(value)
+                except NdbReturn as ret:
+                    return NdbFuture(ret.args[0] if ret.args else None)
+                except StopIteration:
+                    return NdbFuture(None)
+                try:
+                    if isinstance(yielded, list):
+                        value = [future.get_result() for future in yielded]
+                    else:
+                        value = yielded.get_result()
+                except Exception as err:
+                    error = err
+        except Exception as err:
+            return NdbFuture(error=err)
+    run.__name__ = func.__name__
+    return run
+
+
+def installStandIns(memcache_latency=0):
+    '''
+    Install the memcache and ndb stand-ins as google.appengine modules
+    @return MemcacheStandIn
+    '''
+    stand_in = MemcacheStandIn(memcache_latency)
+    memcache = types.ModuleType('google.appengine.api.memcache')
+    for name in ('get', 'get_multi', 'set', 'set_multi', 'add', 'delete',
+                 'incr', 'flush_all'):
+        setattr(memcache, name, getattr(stand_in, name))
+    ndb = types.ModuleType('google.appengine.ext.ndb')
+    ndb.tasklet     = ndbTasklet
+    ndb.Return      = NdbReturn
+    ndb.Future      = NdbFuture
+    ndb.get_context = lambda: None
+
+    modules = {
+        'google':                       types.ModuleType('google'),
+        'google.appengine':             types.ModuleType('google.appengine'),
+        'google.appengine.api':         types.ModuleType('google.appengine.api'),
+        'google.appengine.api.memcache': memcache,
+        'google.appengine.ext':         types.ModuleType('google.appengine.ext'),
+        'google.appengine.ext.ndb':     ndb,
+    }
+    modules['google'].appengine           = modules['google.appengine']
+    modules['google.appengine'].api       = modules['google.appengine.api']
+    modules['google.appengine'].ext       = modules['google.appengine.ext']
+    modules['google.appengine.api'].memcache = memcache
+    modules['google.appengine.ext'].ndb   = ndb
+    sys.modules.update(modules)
+    return stand_in
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        # connections of the request threads which have not finished yet
+        self.active    = set()
+        self.condition = threading.Condition()
+
+
+    def process_request(self, request, client_address):
+        with self.condition:
+            self.active.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.condition:
+                self.active.discard(request)
+                self.condition.notify_all()
+
+
+    def closeConnections(self, timeout):
+        '''
+        Shut the open (keep-alive) connections down and wait until their
+        request threads have finished
+        '''
+        deadline = time.time() + timeout
+        with self.condition:
+            for request in list(self.active):
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            while self.active and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+
+
+    def handle_error(self, request, client_address):
+        # the client abandons connections (timeouts, hedged requests)
+        pass
+
+
+class MockCloudRegion:
+    '''
+    Local HTTP server emulating one DeviceAtlas Cloud region. The answer to
+    a CLOUD_PATH request is a property set derived from the user agent.
+    '''
+
+    # failure modes: answer HTTP 500 or do not answer (until hang_sec)
+    FAIL_ERROR = 'error'
+    FAIL_HANG  = 'hang'
+
+    def __init__(self, host, latency=0.02, jitter=0.005, failure_rate=0,
+                 failure_mode='error', hang_sec=30, seed=0):
+        '''
+        @param string host         address to listen on e.g. "127.0.0.2"
+        @param float  latency      seconds before a response is sent
+        @param float  jitter       standard deviation of the latency (seconds)
+        @param float  failure_rate 0..1 part of the requests which fail
+        @param string failure_mode FAIL_ERROR or FAIL_HANG
+        '''
+        self.latency      = latency
+        self.jitter       = jitter
+        self.failure_rate = failure_rate
+        self.failure_mode = failure_mode
+        self.hang_sec     = hang_sec
+        self.seed         = seed
+        self.requests     = 0
+        self.probes       = 0
+        self.failures     = 0
+        self.__defaults   = (latency, jitter, failure_rate, failure_mode)
+        self.__random     = Random(seed)
+        self.__lock       = threading.Lock()
+        self.__stopped    = threading.Event()
+        region            = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                region.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, 0), Handler)
+        self.host   = host
+        self.port   = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+
+    def start(self):
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        # release the hanging requests
+        self.__stopped.set()
+        self.server.shutdown()
+        self.server.closeConnections(2)
+        self.server.server_close()
+
+
+    def getServer(self):
+        '''
+        @return dict the server entry for Client.SERVERS
+        '''
+        return {'host': self.host, 'port': self.port}
+
+
+    def resetCounters(self):
+        with self.__lock:
+            self.requests = self.probes = self.failures = 0
+
+
+    def reset(self):
+        '''
+        Back to the state the region was started in: the hanging requests
+        are released, the open connections are closed, the settings are
+        restored and the random sequence starts again
+        '''
+        self.__stopped.set()
+        self.server.closeConnections(2)
+        self.__stopped.clear()
+        with self.__lock:
+            self.latency, self.jitter, self.failure_rate, self.failure_mode = \
+                self.__defaults
+            self.__random.seed(self.seed)
+            self.requests = self.probes = self.failures = 0
+
+
+    def handle(self, request):
+        url   = urlparse(request.path)
+        query = parse_qs(url.query)
+        probe = bool(request.headers.get('X-DA-Latency-Checker'))
+        with self.__lock:
+            self.requests += 1
+            if probe:
+                self.probes += 1
+            delay = max(0, self.__random.gauss(self.latency, self.jitter))
+            fail  = self.__random.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+
+        if fail and self.failure_mode == self.FAIL_HANG:
+            self.__stopped.wait(self.hang_sec)
+            request.close_connection = True
+            return
+        time.sleep(delay)
+
+        if fail or not url.path.startswith('/v1/detect/properties'):
+            status, body = 500, b''
+        else:
+            user_agent = query.get('useragent', [''])[0]
+            status, body = 200, json.dumps(
+                {'properties': self.getProperties(user_agent)}
+            ).encode('utf-8')
+
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+    def getProperties(self, user_agent):
+        '''
+        Stable made up properties of a user agent, about as many as a real
+        cloud response has
+        '''
+        digest  = int(md5(user_agent.encode('utf-8')).hexdigest(), 16)
+        mobile  = 'Mobile' in user_agent or 'iPhone' in user_agent
+        properties = {
+            'mobileDevice':  mobile,
+            'isBrowser':     True,
+            'isTablet':      'iPad' in user_agent or 'Tablet' in user_agent,
+            'osAndroid':     'Android' in user_agent,
+            'osiOs':         'iPhone' in user_agent or 'iPad' in user_agent,
+            'displayWidth':  (320, 360, 375, 390, 412, 1366, 1920)[digest % 7],
+            'displayHeight': (568, 640, 667, 844, 915, 768, 1080)[digest % 7],
+            'vendor':        ('Apple', 'Samsung', 'Google', 'Xiaomi', 'Huawei')[digest % 5],
+            'model':         'Model %d' % (digest % 1000),
+            'browserName':   'Chrome' if 'Chrome' in user_agent else 'Safari',
+            'yearReleased':  2010 + digest % 15,
+        }
+        for i in range(40):
+            properties['property%d' % i] = (digest >> i) & 1 == 1
+        return properties
+
+
+class UserAgentCorpus:
+    '''
+    Synthetic user agents requested with a Zipf distribution: the k-th most
+    popular user agent is requested with a weight of 1 / k^exponent
+    '''
+
+    TEMPLATES = (
+        'Mozilla/5.0 (Linux; Android %(android)d; %(model)s Build/%(build)s) '
+        'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/%(chrome)s Mobile Safari/537.36',
+        'Mozilla/5.0 (iPhone; CPU iPhone OS %(ios)s like Mac OS X) AppleWebKit/605.1.15 '
+        '(KHTML, like Gecko) Version/%(safari)s Mobile/15E148 Safari/604.1',
+        'Mozilla/5.0 (iPad; CPU OS %(ios)s like Mac OS X) AppleWebKit/605.1.15 '
+        '(KHTML, like Gecko) Version/%(safari)s Mobile/15E148 Safari/604.1',
+        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+        '(KHTML, like Gecko) Chrome/%(chrome)s Safari/537.36',
+        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_%(mac)d) AppleWebKit/605.1.15 '
+        '(KHTML, like Gecko) Version/%(safari)s Safari/605.1.15',
+        'Mozilla/5.0 (X11; Linux x86_64; rv:%(firefox)d.0) Gecko/20100101 Firefox/%(firefox)d.0',
+    )
+
+    def __init__(self, size=1000, exponent=1.1, seed=0):
+        '''
+        @param int   size     number of distinct user agents
+        @param float exponent Zipf exponent, about 1 for web traffic
+        '''
+        self.__random   = Random(seed)
+        self.userAgents = self.__makeUserAgents(size)
+        total = 0.0
+        self.__cumulative = []
+        for rank in range(1, size + 1):
+            total += 1.0 / rank ** exponent
+            self.__cumulative.append(total)
+
+
+    def sample(self, count):
+        '''
+        @return list of count user agents
+        '''
+        total = self.__cumulative[-1]
+        return [
+            self.userAgents[bisect.bisect_left(
+                self.__cumulative, self.__random.random() * total
+            )]
+            for i in range(count)
+        ]
+
+
+    def __makeUserAgents(self, size):
+        rnd         = self.__random
+        user_agents = []
+        seen        = set()
+        while len(user_agents) < size:
+            user_agent = rnd.choice(self.TEMPLATES) % {
+                'android': rnd.randint(8, 14),
+                'model':   '%s-%s%d' % (
+                    rnd.choice(('SM', 'Pixel', 'M', 'CPH', 'moto')),
+                    rnd.choice('ABGNSX'), rnd.randint(100, 999)
+                ),
+                'build':   '%s%d.%d' % (
+                    rnd.choice(('QP1A', 'RP1A', 'SP1A', 'TP1A')),
+                    rnd.randint(190000, 230000), rnd.randint(1, 99)
+                ),
+                'chrome':  '%d.0.%d.%d' % (
+                    rnd.randint(100, 125), rnd.randint(4000, 6500), rnd.randint(1, 200)
+                ),
+                'ios':     '%d_%d' % (rnd.randint(13, 17), rnd.randint(0, 7)),
+                'safari':  '%d.%d' % (rnd.randint(13, 17), rnd.randint(0, 6)),
+                'mac':     rnd.randint(1, 7),
+                'firefox': rnd.randint(100, 125),
+            }
+            if user_agent not in seen:
+                seen.add(user_agent)
+                user_agents.append(user_agent)
+        return user_agents
+
+
+class Benchmark:
+    '''
+    Runs the scenarios against one set of mock regions
+    '''
+
+    def __init__(self, regions, memcache, requests=2000, threads=8,
+                 corpus_size=500, exponent=1.1, seed=0):
+        '''
+        @param list regions  MockCloudRegion objects in SERVERS order
+        @param MemcacheStandIn memcache the installed memcache stand-in
+        '''
+        import ClientGAE
+        self.ClientGAE = ClientGAE
+        self.regions   = regions
+        self.memcache  = memcache
+        self.requests  = requests
+        self.threads   = threads
+        self.corpus    = UserAgentCorpus(corpus_size, exponent, seed)
+        self.traffic   = self.corpus.sample(requests)
+        # error messages of the last run
+        self.errors    = []
+        # Client attributes set by the last reset() and their defaults
+        self.defaults  = {}
+
+
+    def reset(self, **config):
+        '''
+        Forget everything the client has shared between requests and
+        configure the Client class. The regions are reset and the work left
+        running by the previous scenario is finished first, it would write
+        into the state of the next one.
+        @param config Client attributes to set, the attributes set by the
+                      previous reset() get their defaults back
+        @return Client
+        '''
+        Client = self.ClientGAE.Client
+        for region in self.regions:
+            region.reset()
+        self.drain()
+        for name, value in self.defaults.items():
+            setattr(Client, name, value)
+        self.defaults = dict((name, getattr(Client, name)) for name in config)
+        if Client.writeBehindQueue is not None:
+            Client.writeBehindQueue.close()
+            Client.writeBehindQueue = None
+        if Client.connectionPool is not None:
+            Client.connectionPool.clear()
+        for name in ('localCache', 'connectionPool', 'singleFlight',
+                     'circuitBreaker', 'latencyTracker', 'diskCache',
+                     'rankingThread', 'calledServer', 'userAgentCanonicalizer'):
+            setattr(Client, name, None)
+        Client.staleRefreshes     = set()
+        Client.canonicalVerifications = set()
+        Client.backgroundFetches  = {}
+        Client.hedgesInFlight     = 0
+        Client.latenciesPublished = 0
+        Client.metrics        = self.ClientGAE.Metrics()
+        Client.LICENCE_KEY    = 'benchmark'
+        Client.SERVERS        = tuple(region.getServer() for region in self.regions)
+        Client.AUTO_SERVER_RANKING = False
+        for name, value in config.items():
+            setattr(Client, name, value)
+        self.memcache.flush_all()
+        for region in self.regions:
+            region.resetCounters()
+        return Client()
+
+
+    def drain(self, timeout=10):
+        '''
+        Wait for the client threads which outlive their lookups: the cloud
+        fetches of the lookups out of budget, the hedged requests, the
+        verifications of the canonical user agents and the server ranking
+        '''
+        Client   = self.ClientGAE.Client
+        deadline = time.time() + timeout
+        for fetch in list(Client.backgroundFetches.values()):
+            fetch['done'].wait(max(0, deadline - time.time()))
+        while (Client.hedgesInFlight or Client.canonicalVerifications) and \
+              time.time() < deadline:
+            time.sleep(0.01)
+        if Client.rankingThread is not None:
+            Client.rankingThread.join(max(0, deadline - time.time()))
+
+
+    def run(self, name, client, user_agents, check=None, threads=None, budget_ms=None):
+        '''
+        Look up the user agents using the benchmark threads
+        @param function check    checked lookups: the headers of lookup i are
+                                 made by makeHeaders(i, user_agent) and
+                                 check(i, user_agent, headers, data,
+                                 client.getCloudUrl()) is called after it,
+                                 returns an error message or None
+        @param int      threads  None = the benchmark threads
+        @param int      budget_ms the budget of each lookup, None = no limit
+        @return dict report
+        '''
+        latencies = []
+        errors    = []
+
+        def lookup(i, user_agent):
+            if check is None:
+                headers = {'user_agent': user_agent}
+            else:
+                headers = self.makeHeaders(i, user_agent)
+            started = time.time()
+            data    = client.getDeviceData(dict(headers), budget_ms=budget_ms)
+            latencies.append(time.time() - started)
+            if '_error' in data:
+                errors.append(data['_error'])
+            elif check is not None:
+                error = check(i, user_agent, headers, data, client.getCloudUrl())
+                if error is not None:
+                    errors.append(error)
+
+        for region in self.regions:
+            region.resetCounters()
+        started = time.time()
+        self.ClientGAE.runConcurrently(
+            [
+                lambda i=i, user_agent=user_agent: lookup(i, user_agent)
+                for i, user_agent in enumerate(user_agents)
+            ],
+            threads or self.threads
+        )
+        self.errors = errors
+        return self.report(name, time.time() - started, latencies, len(errors))
+
+
+    def makeHeaders(self, i, user_agent):
+        '''
+        Request headers of lookup i, every lookup has its own client side
+        component cookie so a result given to the wrong request is detected
+        @return dict
+        '''
+        return {
+            'user_agent':   user_agent,
+            'cookie':       'DAPROPS="srequestId:%d"' % i,
+            'x_forwarded_for': '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+        }
+
+
+    def report(self, name, duration, latencies, errors=0):
+        '''
+        @param list latencies seconds per request
+        @return dict {scenario:, requests:, errors:, throughput:, p50_ms:,
+                      p95_ms:, p99_ms:, cloud_calls_per_request:}
+        '''
+        latencies = sorted(latencies)
+        count     = len(latencies)
+
+        def percentile(rank):
+            if not latencies:
+                return 0
+            return latencies[min(count - 1, int(rank * count))] * 1000
+
+        cloud_calls = sum(region.requests - region.probes for region in self.regions)
+        return {
+            'scenario':   name,
+            'requests':   count,
+            'errors':     errors,
+            'throughput': count / duration if duration else 0,
+            'p50_ms':     percentile(0.5),
+            'p95_ms':     percentile(0.95),
+            'p99_ms':     percentile(0.99),
+            'cloud_calls_per_request': float(cloud_calls) / count if count else 0,
+        }
+
+
+    def scenarioCold(self):
+        '''
+        Empty caches, each distinct user agent costs one cloud call
+        '''
+        return self.run('cold', self.reset(), self.traffic)
+
+
+    def scenarioWriteBehind(self):
+        '''
+        The cold scenario with the memcache writes queued and written in
+        batches (compare with cold when memcache has a latency)
+        '''
+        client = self.reset(CACHE_WRITE_BEHIND=True)
+        return self.run('write-behind', client, self.traffic)
+
+
+    def scenarioWarm(self):
+        '''
+        The same traffic again after the caches have been filled
+        '''
+        client = self.reset()
+        self.run('fill', client, self.traffic)
+        return self.run('warm', client, self.traffic)
+
+
+    def scenarioWarmMemcache(self):
+        '''
+        Warm memcache but an empty in-process cache (e.g. a new instance)
+        '''
+        client = self.reset()
+        self.run('fill', client, self.traffic)
+        self.ClientGAE.Client.localCache = None
+        return self.run('warm-memcache', client, self.traffic)
+
+
+    def scenarioWarmShared(self):
+        '''
+        Warm shared memory cache but an empty in-process cache and memcache,
+        as seen by a new worker process of a pre-fork server
+        '''
+        Client = self.ClientGAE.Client
+        client = self.reset(
+            CACHE_TIERS=('localcache', 'sharedcache', 'memcache'),
+            SHARED_CACHE_PATH=os.path.join(
+                tempfile.gettempdir(), 'benchmark_shared_cache_%d' % os.getpid()
+            ),
+        )
+        try:
+            self.run('fill', client, self.traffic)
+            self.memcache.flush_all()
+            Client.localCache = None
+            return self.run('warm-shared', client, self.traffic)
+        finally:
+            if Client.sharedCache is not None:
+                Client.sharedCache.close()
+                os.remove(Client.sharedCache.path)
+                Client.sharedCache = None
+
+
+    def scenarioOutage(self):
+        '''
+        The preferred region hangs, requests have to fail over. The traffic
+        is first run with healthy regions (so the server latencies are
+        known), then with empty caches during the outage.
+        '''
+        client = self.reset()
+        self.run('fill', client, self.traffic)
+        self.memcache.flush_all()
+        self.ClientGAE.Client.localCache = None
+        region = self.regions[0]
+        region.failure_rate, region.failure_mode = 1, MockCloudRegion.FAIL_HANG
+        try:
+            return self.run('outage', client, self.traffic)
+        finally:
+            region.failure_rate, region.failure_mode = 0, MockCloudRegion.FAIL_ERROR
+
+
+    def scenarioDeadline(self, budget_ms=100):
+        '''
+        The outage scenario with a budget per lookup, the lookups which run
+        out of budget return without device data (counted as errors) while
+        the cloud fetch fills the cache in the background
+        '''
+        client = self.reset()
+        self.run('fill', client, self.traffic)
+        self.memcache.flush_all()
+        self.ClientGAE.Client.localCache = None
+        region = self.regions[0]
+        region.failure_rate, region.failure_mode = 1, MockCloudRegion.FAIL_HANG
+        try:
+            return self.run('deadline', client, self.traffic, budget_ms=budget_ms)
+        finally:
+            region.failure_rate, region.failure_mode = 0, MockCloudRegion.FAIL_ERROR
+
+
+    def scenarioRanking(self, runs=5):
+        '''
+        Rank the servers (latency probes of every region) a few times, a
+        "request" is one ranking run
+        '''
+        client    = self.reset(AUTO_SERVER_RANKING=True)
+        latencies = []
+        started   = time.time()
+        for i in range(runs):
+            run_started = time.time()
+            client.rankServers()
+            latencies.append(time.time() - run_started)
+        report = self.report('ranking', time.time() - started, latencies)
+        report['cloud_calls_per_request'] = \
+            float(sum(region.probes for region in self.regions)) / runs
+        return report
+
+
+    def scenarioStress(self, threads=32, lookups=5000):
+        '''
+        Thousands of concurrent lookups sharing one Client object, the small
+        in-process cache and hedged requests make the lookups interleave in
+        every stage. Each result is checked against the request it was made
+        for: user agent, cookie properties, device properties and the server
+        reported by getCloudUrl(). Any mix up is counted as an error.
+        '''
+        client   = self.reset(
+            CACHE_BY_USER_AGENT_ONLY=True,
+            LOCAL_CACHE_MAX_ITEMS=50,
+            CLOUD_SERVICE_HEDGED=True,
+        )
+        hosts    = set(region.host for region in self.regions)
+        expected = {}
+
+        def check(i, user_agent, headers, data, server):
+            if data['_useragent'] != user_agent:
+                return 'lookup %d got the user agent "%s"' % (i, data['_useragent'])
+            properties = data['properties']
+            if properties.get('requestId') != str(i):
+                return 'lookup %d got the cookie of lookup %s' % (
+                    i, properties.get('requestId')
+                )
+            if user_agent not in expected:
+                expected[user_agent] = self.regions[0].getProperties(user_agent)
+            if properties.get('model') != expected[user_agent]['model']:
+                return 'lookup %d got the device "%s"' % (i, properties.get('model'))
+            if data['_source'] == 'cloud' and (server is None or server['host'] not in hosts):
+                return 'lookup %d got the server %s' % (i, server)
+            if data['_source'] != 'cloud' and server is not None:
+                return 'lookup %d from %s got the server %s' % (
+                    i, data['_source'], server
+                )
+            return None
+
+        traffic = self.corpus.sample(max(lookups, self.requests))
+        report  = self.run('stress', client, traffic, check, max(threads, self.threads))
+        for error in self.errors[:5]:
+            print('stress: ' + error)
+        return report
+
+
+    SCENARIOS = ('cold', 'write-behind', 'warm', 'warm-memcache', 'warm-shared',
+                 'outage', 'deadline', 'ranking', 'stress')
+
+    def runScenario(self, name):
+        return {
+            'cold':          self.scenarioCold,
+            'write-behind':  self.scenarioWriteBehind,
+            'warm':          self.scenarioWarm,
+            'warm-memcache': self.scenarioWarmMemcache,
+            'warm-shared':   self.scenarioWarmShared,
+            'outage':        self.scenarioOutage,
+            'deadline':      self.scenarioDeadline,
+            'ranking':       self.scenarioRanking,
+            'stress':        self.scenarioStress,
+        }[name]()
+
+
+def printHeader():
+    print('%-14s %8s %6s %10s %9s %9s %9s %10s' % (
+        'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+        'cloud/req'
+    ))
+
+
+def printReport(report):
+    print('%-14s %8d %6d %10.1f %9.2f %9.2f %9.2f %10.3f' % (
+        report['scenario'], report['requests'], report['errors'],
+        report['throughput'], report['p50_ms'], report['p95_ms'],
+        report['p99_ms'], report['cloud_calls_per_request']
+    ))
+
+
+def legacyPrepareRequest(client, headers):
+    '''
+    The request preprocessing of the client before HeaderTables, kept for
+    the micro benchmarks: the header name table was built and the whole
+    Cookie header split into a dict on every request
+    @return tuple (user_agent, headers, cookie)
+    '''
+    legacy_headers = {
+        'user_agent': 'HTTP_USER_AGENT',
+        'cookie':     'HTTP_COOKIE',
+    }
+    for header in client.ESSENTIAL_HEADERS:
+        legacy_headers[header.lower().replace('http_', '')] = header
+    for header in client.ESSENTIAL_USER_AGENT_HEADERS:
+        legacy_headers[header.lower().replace('http_', '')] = header
+    for header in client.EXTRA_HEADERS:
+        legacy_headers[header.lower().replace('http_', '')] = header
+    new_headers = {}
+    for header in headers:
+        headerX = header.lower().replace('-', '_').replace('http_', '')
+        if headerX in legacy_headers:
+            new_headers[legacy_headers[headerX]] = headers[header]
+    headers    = new_headers
+    user_agent = headers.pop('HTTP_USER_AGENT', '')
+
+    cookie  = ''
+    cookies = {}
+    if 'HTTP_COOKIE' in headers:
+        for raw in headers['HTTP_COOKIE'].split(';'):
+            raw_list = raw.split('=', 1)
+            if len(raw_list) == 2:
+                cookies[raw_list[0].strip()] = raw_list[1].strip()
+        if client.CLIENT_COOKIE_NAME in cookies:
+            cookie = cookies[client.CLIENT_COOKIE_NAME]
+    return user_agent, headers, cookie
+
+
+def legacyCloudHeaders(client, headers):
+    '''
+    The X-DA- header names of a cloud request as they were derived on every
+    request before HeaderTables
+    '''
+    new_headers = {}
+    for header in client.ESSENTIAL_HEADERS + client.ESSENTIAL_USER_AGENT_HEADERS:
+        if header.startswith('HTTP_'):
+            key = header[5:].lower().replace('_', '-')
+        else:
+            key = header.lower().replace('_', '-')
+        if headers and header in headers:
+            new_headers[client.DA_HEADER_PREFIX + key] = headers[header]
+    return new_headers
+
+
+class MicroBenchmark:
+    '''
+    CPU time per request of the request preprocessing, the legacy code next
+    to the current one, for the header mappings of the common frameworks.
+    The result cases look up a cached device and read two properties, the
+    dictionary results next to the USE_LAZY_RESULTS ones.
+    '''
+
+    USER_AGENT = 'Mozilla/5.0 (Linux; Android 10; SM-G973F) AppleWebKit/537.36 ' \
+                 '(KHTML, like Gecko) Chrome/83.0.4103.106 Mobile Safari/537.36'
+    # cookies of a page using the client side component, the DACACHEN and
+    # DACACHEV cookies are several KB
+    COOKIE     = 'DACACHEN=' + '-'.join('property%d' % i for i in range(120)) + \
+                 '; DACACHEV=%5B' + '%2C'.join('true' for i in range(120)) + '%5D' + \
+                 '; _ga=GA1.2.1234567890.1234567890; sessionid=abcdef0123456789' + \
+                 '; DAPROPS="bjs.webGl:1|bjs.geoLocation:1|bhtml.canvas:1|' \
+                 'idisplayColorDepth:24|sdeviceAspectRatio:16/9|bcookieSupport:1"'
+
+    def __init__(self, iterations=20000):
+        import ClientGAE
+        self.client     = ClientGAE.Client()
+        self.iterations = iterations
+
+
+    def getRequests(self):
+        '''
+        @return list of (name, headers) the same request as each framework
+                gives it
+        '''
+        environ = {
+            'REQUEST_METHOD': 'GET', 'SCRIPT_NAME': '', 'PATH_INFO': '/page',
+            'QUERY_STRING': 'a=1', 'SERVER_NAME': 'example.com',
+            'SERVER_PORT': '443', 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '10.0.0.1', 'CONTENT_TYPE': '', 'CONTENT_LENGTH': '',
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': 'https',
+            'wsgi.input': None, 'wsgi.errors': None, 'wsgi.multithread': True,
+            'wsgi.multiprocess': False, 'wsgi.run_once': False,
+            'HTTP_HOST': 'example.com',
+            'HTTP_USER_AGENT': self.USER_AGENT,
+            'HTTP_ACCEPT': 'text/html,application/xhtml+xml,*/*;q=0.8',
+            'HTTP_ACCEPT_LANGUAGE': 'en-US,en;q=0.9',
+            'HTTP_ACCEPT_ENCODING': 'gzip, deflate, br',
+            'HTTP_CONNECTION': 'keep-alive',
+            'HTTP_UPGRADE_INSECURE_REQUESTS': '1',
+            'HTTP_X_FORWARDED_FOR': '203.0.113.7',
+            'HTTP_COOKIE': self.COOKIE,
+        }
+        meta = dict(environ)
+        meta.update({
+            'CSRF_COOKIE': 'x' * 32, 'PATH_TRANSLATED': '/srv/page',
+            'DJANGO_SETTINGS_MODULE': 'site.settings', 'HOME': '/home/app',
+            'LANG': 'C.UTF-8', 'PATH': '/usr/bin:/bin', 'PWD': '/srv',
+            'SHELL': '/bin/sh', 'TZ': 'UTC', 'USER': 'app',
+        })
+        plain = {
+            'Host': 'example.com',
+            'User-Agent': self.USER_AGENT,
+            'Accept': environ['HTTP_ACCEPT'],
+            'Accept-Language': environ['HTTP_ACCEPT_LANGUAGE'],
+            'Accept-Encoding': environ['HTTP_ACCEPT_ENCODING'],
+            'Connection': 'keep-alive',
+            'X-Forwarded-For': '203.0.113.7',
+            'Cookie': self.COOKIE,
+        }
+        return [('wsgi environ', environ), ('django META', meta), ('plain dict', plain)]
+
+
+    def measure(self, func, headers):
+        '''
+        @return float microseconds of CPU per call
+        '''
+        # CPU time of the process
+        clock      = getattr(time, 'process_time', None) or time.clock
+        iterations = self.iterations
+        started    = clock()
+        for i in range(iterations):
+            func(headers)
+        return (clock() - started) * 1000000.0 / iterations
+
+
+    def run(self):
+        '''
+        @return list of dicts {case:, legacy_us:, current_us:, speedup:}
+        '''
+        client  = self.client
+        reports = []
+
+        def report(case, legacy, current):
+            reports.append({
+                'case':       case,
+                'legacy_us':  legacy,
+                'current_us': current,
+                'speedup':    legacy / current if current else 0,
+            })
+
+        for name, headers in self.getRequests():
+            report(
+                'prepare ' + name,
+                self.measure(lambda h: legacyPrepareRequest(client, h), headers),
+                self.measure(client.prepareRequest, headers)
+            )
+
+        user_agent, headers, cookie = client.prepareRequest(self.getRequests()[0][1])
+        report(
+            'cloud headers',
+            self.measure(lambda h: legacyCloudHeaders(client, h), headers),
+            self.measure(client.getHeaderTables().getCloudHeaders, headers)
+        )
+
+        for case, lookup in self.getResultClients():
+            def read(h):
+                properties = lookup.getDeviceData(h)[lookup.PROPERTIES]
+                return properties['mobileDevice'], properties.get('displayWidth')
+
+            headers = self.getRequests()[2][1]
+            lookup.USE_LAZY_RESULTS = False
+            eager = self.measure(read, headers)
+            lookup.USE_LAZY_RESULTS = True
+            report(case, eager, self.measure(read, headers))
+        return reports
+
+
+    def getResultClients(self):
+        '''
+        @return list of (case, Client) clients with the device of the plain
+                dict request cached in one tier, the client side component
+                cookie properties are merged into the results
+        '''
+        import ClientGAE
+        properties = MockCloudRegion('127.0.0.1').getProperties(self.USER_AGENT)
+        clients    = []
+        for case, tier in (('result local hit', ClientGAE.Client.SOURCE_LOCAL_CACHE),
+                           ('result memcache hit', ClientGAE.Client.SOURCE_MEMCACHE)):
+            lookup = ClientGAE.Client()
+            lookup.CACHE_TIERS              = (tier,)
+            lookup.USE_COMPACT_RECORDS      = True
+            lookup.CACHE_BY_USER_AGENT_ONLY = True
+            user_agent, headers, cookie = lookup.prepareRequest(self.getRequests()[2][1])
+            lookup.setCaches(user_agent, '', {lookup.PROPERTIES: properties}, headers)
+            clients.append((case, lookup))
+        return clients
+
+
+def printMicroReports(reports):
+    print('%-22s %10s %10s %8s' % ('case', 'legacy us', 'current us', 'speedup'))
+    for report in reports:
+        print('%-22s %10.2f %10.2f %7.1fx' % (
+            report['case'], report['legacy_us'], report['current_us'], report['speedup']
+        ))
+
+
+def parseRegion(value):
+    '''
+    @param string value "latency_ms:jitter_ms:failure_rate"
+    @return tuple (latency, jitter, failure_rate) in seconds
+    '''
+    parts = (value.split(':') + ['0', '0'])[:3]
+    return float(parts[0]) / 1000, float(parts[1]) / 1000, float(parts[2])
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Offline benchmarks of the DeviceAtlas Cloud client'
+    )
+    parser.add_argument('--scenario', nargs='+', choices=Benchmark.SCENARIOS,
+                        default=list(Benchmark.SCENARIOS))
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests per scenario (default 2000)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='concurrent requests (default 8)')
+    parser.add_argument('--user-agents', type=int, default=500,
+                        help='distinct user agents (default 500)')
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='Zipf exponent of the traffic (default 1.1)')
+    parser.add_argument('--region', action='append', default=[],
+                        metavar='LATENCY_MS:JITTER_MS:FAILURE_RATE',
+                        help='a mock region, repeat for more regions '
+                             '(default 20:5:0 60:10:0 120:20:0 250:40:0)')
+    parser.add_argument('--memcache-latency', type=float, default=0.5,
+                        help='milliseconds added to every memcache call (default 0.5)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='print the reports as JSON')
+    parser.add_argument('--micro', action='store_true',
+                        help='run the micro benchmarks of the request '
+                             'preprocessing and of the results instead of '
+                             'the scenarios')
+    parser.add_argument('--iterations', type=int, default=20000,
+                        help='calls per micro benchmark (default 20000)')
+    args = parser.parse_args(argv[1:])
+
+    memcache = installStandIns(args.memcache_latency / 1000)
+    if args.micro:
+        reports = MicroBenchmark(args.iterations).run()
+        if args.json:
+            print(json.dumps(reports, indent=4, sort_keys=True))
+        else:
+            printMicroReports(reports)
+        return 0
+
+    regions  = []
+    for i, value in enumerate(args.region or ['20:5:0', '60:10:0', '120:20:0', '250:40:0']):
+        latency, jitter, failure_rate = parseRegion(value)
+        regions.append(MockCloudRegion(
+            '127.0.0.%d' % (i + 1), latency, jitter, failure_rate, seed=args.seed + i
+        ).start())
+
+    try:
+        benchmark = Benchmark(
+            regions, memcache, args.requests, args.threads, args.user_agents,
+            args.zipf, args.seed
+        )
+        reports = []
+        if not args.json:
+            printHeader()
+        for name in args.scenario:
+            reports.append(benchmark.runScenario(name))
+            if not args.json:
+                printReport(reports[-1])
+    finally:
+        pool = sys.modules['ClientGAE'].Client.connectionPool \
+            if 'ClientGAE' in sys.modules else None
+        if pool is not None:
+            pool.clear()
+        for region in regions:
+            region.stop()
+
+    if args.json:
+        print(json.dumps(reports, indent=4, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,50 @@
+'''
+Shared set up of the tests: the memcache and ndb stand-ins and the mock
+cloud regions of benchmark.py, so the tests run offline like the benchmarks.
+The stand-ins are installed once, ClientGAE keeps the modules it imported.
+'''
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+# the installed MemcacheStandIn, see getMemcache()
+memcache = []
+
+
+def getMemcache():
+    '''
+    Install the stand-ins on first use, before ClientGAE is imported
+    @return MemcacheStandIn
+    '''
+    if not memcache:
+        memcache.append(benchmark.installStandIns())
+    return memcache[0]
+
+
+def startRegions(latencies):
+    '''
+    Start one mock cloud region per latency
+    @param list latencies seconds before each region answers
+    @return list MockCloudRegion
+    '''
+    return [
+        benchmark.MockCloudRegion(
+            '127.0.0.%d' % (i + 1), latency, latency / 4, seed=i
+        ).start()
+        for i, latency in enumerate(latencies)
+    ]
+
+
+def stopRegions(regions):
+    '''
+    Close the pooled connections of the client and stop the regions
+    '''
+    if 'ClientGAE' in sys.modules:
+        pool = sys.modules['ClientGAE'].Client.connectionPool
+        if pool is not None:
+            pool.clear()
+    for region in regions:
+        region.stop()
@@ -0,0 +1,148 @@
+'''
+The adaptive timeout of the cloud requests: the latency percentiles, the
+back off on the servers which fail and the recovery of a slow server.
+
+Run:
+    python -m unittest discover -s tests
+    python tests/test_adaptive_timeout.py
+'''
+
+import time, unittest
+
+import support
+
+
+class LatencyTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        support.getMemcache()
+        import ClientGAE
+        self.tracker = ClientGAE.LatencyTracker(
+            min_samples=20, max_age=0.2, failure_ttl=0.2
+        )
+
+
+    def testPercentiles(self):
+        for i in range(100):
+            self.tracker.record('a', i + 1)
+        estimate = self.tracker.getEstimate('a')
+        self.assertAlmostEqual(estimate['p50'], 50.5)
+        self.assertAlmostEqual(estimate['p90'], 90.1)
+        self.assertAlmostEqual(estimate['p99'], 99.01)
+
+
+    def testOutlier(self):
+        # one slow answer is not the p99
+        for _ in range(99):
+            self.tracker.record('a', 10)
+        self.tracker.record('a', 1000)
+        self.assertTrue(self.tracker.getEstimate('a')['p99'] < 50)
+
+
+    def testExpiry(self):
+        for _ in range(20):
+            self.tracker.record('a', 100)
+        self.assertNotEqual(self.tracker.getEstimate('a'), None)
+        time.sleep(0.25)
+        self.assertEqual(self.tracker.getEstimate('a'), None)
+        self.assertEqual(self.tracker.getEstimates(), {})
+        # the latency is still known
+        self.assertAlmostEqual(self.tracker.getLatency('a'), 100)
+        self.assertEqual(self.tracker.getLatency('b'), None)
+
+
+    def testFailures(self):
+        self.tracker.recordFailure('a')
+        self.tracker.recordFailure('a')
+        self.assertEqual(self.tracker.getFailures('a'), 2)
+        self.tracker.record('a', 10)
+        self.assertEqual(self.tracker.getFailures('a'), 0)
+        self.tracker.recordFailure('a')
+        time.sleep(0.25)
+        # a new failure does not keep the old ones counted
+        self.tracker.recordFailure('a')
+        self.assertEqual(self.tracker.getFailures('a'), 0)
+        self.tracker.recordFailure('a')
+        self.assertEqual(self.tracker.getFailures('a'), 1)
+
+
+class CloudTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        support.getMemcache()
+        import ClientGAE
+        self.Client = ClientGAE.Client
+        self.Client.latencyTracker = ClientGAE.LatencyTracker(min_samples=20)
+        self.client = self.Client()
+
+
+    def tearDown(self):
+        self.Client.latencyTracker = None
+
+
+    def getCloudTimeout(self, host):
+        return self.client.getCloudTimeout({'host': host, 'port': 80})
+
+
+    def testBackOff(self):
+        tracker = self.Client.latencyTracker
+        for _ in range(20):
+            tracker.record('fast', 100)
+        self.assertAlmostEqual(self.getCloudTimeout('fast'), 0.3)
+        self.assertEqual(self.getCloudTimeout('new'), self.Client.CLOUD_SERVICE_TIMEOUT)
+        for _ in range(3):
+            tracker.recordFailure('new')
+        self.assertAlmostEqual(self.getCloudTimeout('new'), 0.3)
+
+
+    def testSlowServerFloor(self):
+        tracker = self.Client.latencyTracker
+        for _ in range(20):
+            tracker.record('slow', 450)
+        for _ in range(10):
+            tracker.recordFailure('slow')
+        self.assertAlmostEqual(
+            self.getCloudTimeout('slow'),
+            0.45 * self.Client.ADAPTIVE_TIMEOUT_FAILURE_MARGIN
+        )
+
+
+class SlowRegionTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.regions   = support.startRegions([0.45])
+        cls.benchmark = support.benchmark.Benchmark(
+            cls.regions, support.getMemcache(), requests=1
+        )
+
+
+    @classmethod
+    def tearDownClass(cls):
+        # restore the Client settings of the tests
+        cls.benchmark.reset()
+        support.stopRegions(cls.regions)
+
+
+    def testRecovery(self):
+        client = self.benchmark.reset(
+            USE_CIRCUIT_BREAKER=False, ADAPTIVE_TIMEOUT_MIN_SAMPLES=5
+        )
+
+        def lookup(i):
+            return client.getDeviceData({'user_agent': 'Slow Region %d' % i})
+
+        for i in range(5):
+            self.assertFalse(client.ERROR in lookup(i))
+        self.regions[0].failure_rate = 1
+        for i in range(5, 8):
+            self.assertTrue(client.ERROR in lookup(i))
+        # the region answers again, slower than ADAPTIVE_TIMEOUT_MIN_SEC
+        self.regions[0].failure_rate = 0
+        for i in range(8, 11):
+            data = lookup(i)
+            self.assertFalse(client.ERROR in data, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+'''
+Lookups out of budget return without the device data of the cloud but with
+the properties of the "DeviceAtlas Client Side Component" cookie, whatever
+CACHE_BY_USER_AGENT_ONLY is.
+
+Run:
+    python -m unittest discover -s tests
+    python tests/test_budget.py
+'''
+
+import unittest
+
+import support
+
+
+class BudgetTest(unittest.TestCase):
+
+    USER_AGENT = 'Mozilla/5.0 (Linux; Android 9; Budget Test) Mobile'
+    COOKIE     = 'DAPROPS="sscreenSize:1080x1920|idisplayColorDepth:24|bjs.webGl:1"'
+
+    @classmethod
+    def setUpClass(cls):
+        # slower than any budget of the tests
+        cls.regions   = support.startRegions([0.5])
+        cls.benchmark = support.benchmark.Benchmark(
+            cls.regions, support.getMemcache(), requests=1
+        )
+
+
+    @classmethod
+    def tearDownClass(cls):
+        # restore the Client settings of the tests
+        cls.benchmark.reset()
+        support.stopRegions(cls.regions)
+
+
+    def getDeviceData(self, **config):
+        client = self.benchmark.reset(**config)
+        return client, client.getDeviceData(
+            {'user_agent': self.USER_AGENT, 'cookie': self.COOKIE}, budget_ms=50
+        )
+
+
+    def assertCookieProperties(self, client, data):
+        self.assertTrue(client.ERROR in data, data)
+        self.assertEqual(data[client.SOURCE], client.SOURCE_COOKIE)
+        properties = data[client.PROPERTIES]
+        self.assertEqual(properties['screenSize'], '1080x1920')
+        self.assertEqual(properties['displayColorDepth'], 24)
+        self.assertEqual(properties['js.webGl'], True)
+
+
+    def testCookieProperties(self):
+        client, data = self.getDeviceData()
+        self.assertCookieProperties(client, data)
+
+
+    def testCookiePropertiesByUserAgentOnly(self):
+        client, data = self.getDeviceData(CACHE_BY_USER_AGENT_ONLY=True)
+        self.assertCookieProperties(client, data)
+
+
+    def testLazyCookieProperties(self):
+        client, data = self.getDeviceData(USE_LAZY_RESULTS=True)
+        self.assertCookieProperties(client, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
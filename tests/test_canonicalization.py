@@ -0,0 +1,52 @@
+'''
+The verification of the user agent canonicalization makes its cloud request
+in the background, the lookup returns without waiting for it.
+
+Run:
+    python -m unittest discover -s tests
+    python tests/test_canonicalization.py
+'''
+
+import time, unittest
+
+import support
+
+
+class CanonicalizationTest(unittest.TestCase):
+
+    USER_AGENT = 'Mozilla/5.0 (Linux; Android 9) Mobile ' \
+                 'session/0f8fad5b-d9cb-469f-a165-70867728950e'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.regions   = support.startRegions([0.3])
+        cls.benchmark = support.benchmark.Benchmark(
+            cls.regions, support.getMemcache(), requests=1
+        )
+
+
+    @classmethod
+    def tearDownClass(cls):
+        # restore the Client settings of the tests
+        cls.benchmark.reset()
+        support.stopRegions(cls.regions)
+
+
+    def testVerifyInBackground(self):
+        client = self.benchmark.reset(
+            USE_UA_CANONICALIZATION=True, UA_CANONICALIZATION_VERIFY_RATE=1
+        )
+        self.assertNotEqual(client.getCanonicalUserAgent(self.USER_AGENT), self.USER_AGENT)
+        started = time.time()
+        data    = client.getDeviceData({'user_agent': self.USER_AGENT})
+        self.assertFalse(client.ERROR in data, data)
+        # one cloud request, not two
+        self.assertTrue(time.time() - started < 0.5)
+
+        self.benchmark.drain()
+        self.assertEqual(self.regions[0].requests, 2)
+        self.assertEqual(client.getUserAgentCanonicalizer().getStats()['verified'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+'''
+The circuit breaker phases out failing servers and lets them back in after
+a successful trial request. When all the servers are phased out the lookups
+still reach the servers as trial requests.
+
+Run:
+    python -m unittest discover -s tests
+    python tests/test_circuit_breaker.py
+'''
+
+import time, unittest
+
+import support
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        support.getMemcache()
+        import ClientGAE
+        self.breaker = ClientGAE.CircuitBreaker(
+            max_failures=3, failure_rate=0.5, window_sec=60, phaseout_sec=0.2,
+            trial_timeout=0.2, max_consecutive=5
+        )
+
+
+    def fail(self, host, count):
+        for _ in range(count):
+            self.breaker.record(host, False)
+
+
+    def testOpen(self):
+        self.fail('a', 2)
+        self.assertEqual(self.breaker.getState('a'), 'closed')
+        self.assertTrue(self.breaker.allow('a'))
+        self.fail('a', 1)
+        self.assertEqual(self.breaker.getState('a'), 'open')
+        self.assertFalse(self.breaker.allow('a'))
+        self.assertFalse(self.breaker.isAvailable('a'))
+        self.assertTrue(self.breaker.allow('b'))
+
+
+    def testOpenOnConsecutiveFailures(self):
+        for _ in range(50):
+            self.breaker.record('a', True)
+        self.fail('a', 4)
+        self.assertEqual(self.breaker.getState('a'), 'closed')
+        self.fail('a', 1)
+        self.assertEqual(self.breaker.getState('a'), 'open')
+
+
+    def testHalfOpen(self):
+        self.fail('a', 3)
+        time.sleep(0.25)
+        self.assertTrue(self.breaker.isAvailable('a'))
+        # one trial request at a time
+        self.assertTrue(self.breaker.allow('a'))
+        self.assertEqual(self.breaker.getState('a'), 'half-open')
+        self.assertFalse(self.breaker.allow('a'))
+        # a failed trial opens the circuit again
+        self.breaker.record('a', False)
+        self.assertEqual(self.breaker.getState('a'), 'open')
+        self.assertFalse(self.breaker.allow('a'))
+
+
+    def testRecovery(self):
+        self.fail('a', 3)
+        time.sleep(0.25)
+        self.assertTrue(self.breaker.allow('a'))
+        self.assertTrue(self.breaker.record('a', True))
+        self.assertEqual(self.breaker.getState('a'), 'closed')
+        self.assertEqual(self.breaker.getOpenCircuits(), {})
+        self.assertTrue(self.breaker.allow('a'))
+
+
+    def testAllOpen(self):
+        self.fail('a', 3)
+        self.assertFalse(self.breaker.allowTrial('a', ['a', 'b']))
+        self.fail('b', 3)
+        # every server is phased out, one trial request per server
+        self.assertFalse(self.breaker.allow('a'))
+        self.assertTrue(self.breaker.allowTrial('a', ['a', 'b']))
+        self.assertFalse(self.breaker.allowTrial('a', ['a', 'b']))
+        self.assertTrue(self.breaker.allowTrial('b', ['a', 'b']))
+        self.breaker.record('b', True)
+        self.assertEqual(self.breaker.getState('b'), 'closed')
+        # b is back, a waits for its phase out time again
+        self.breaker.record('a', False)
+        self.assertFalse(self.breaker.allowTrial('a', ['a', 'b']))
+
+
+    def testMerge(self):
+        self.breaker.merge({'a': time.time(), 'b': time.time() - 60})
+        self.assertEqual(self.breaker.getState('a'), 'open')
+        self.assertEqual(self.breaker.getState('b'), 'closed')
+
+
+class ClientCircuitTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.regions   = support.startRegions([0.005, 0.005])
+        cls.benchmark = support.benchmark.Benchmark(
+            cls.regions, support.getMemcache(), requests=1
+        )
+
+
+    @classmethod
+    def tearDownClass(cls):
+        # restore the Client settings of the tests
+        cls.benchmark.reset()
+        support.stopRegions(cls.regions)
+
+
+    def getDeviceData(self, client, i):
+        return client.getDeviceData({'user_agent': 'Circuit Test %d' % i})
+
+
+    def testAllServersDown(self):
+        client = self.benchmark.reset()
+        for region in self.regions:
+            region.failure_rate = 1
+        for i in range(3):
+            self.assertTrue(client.ERROR in self.getDeviceData(client, i))
+        for region in self.regions:
+            self.assertEqual(client.getCircuitBreaker().getState(region.host), 'open')
+
+        # the lookups keep reaching the servers
+        requests = sum(region.requests for region in self.regions)
+        self.assertTrue(client.ERROR in self.getDeviceData(client, 3))
+        self.assertTrue(sum(region.requests for region in self.regions) > requests)
+
+        # and the first answer closes the circuit
+        for region in self.regions:
+            region.failure_rate = 0
+        data = self.getDeviceData(client, 4)
+        self.assertFalse(client.ERROR in data, data)
+        self.assertEqual(data[client.SOURCE], client.SOURCE_CLOUD)
+        self.assertEqual(
+            client.getCircuitBreaker().getState(self.regions[0].host), 'closed'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
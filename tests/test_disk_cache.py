@@ -0,0 +1,192 @@
+'''
+DiskCache, the indexed append-only file cache: items, expiry, compaction,
+readers during a compaction and processes sharing the file.
+
+Run:
+    python -m unittest discover -s tests
+    python tests/test_disk_cache.py
+'''
+
+import os, sys, json, time, shutil, tempfile, threading, subprocess, unittest
+
+import support
+
+# the script of the second process, reads the keys given as arguments,
+# writes "key=value" items and compacts the file on "compact"
+CHILD = '''
+import sys, json
+sys.path.insert(0, %r)
+import support
+support.getMemcache()
+import ClientGAE
+cache = ClientGAE.DiskCache(sys.argv[1])
+read = {}
+for arg in sys.argv[2:]:
+    if arg == 'compact':
+        cache.compact()
+    elif '=' in arg:
+        key, value = arg.split('=', 1)
+        cache.set(key, value.encode('utf-8'))
+    else:
+        read[arg] = (cache.get(arg) or b'').decode('utf-8')
+print(json.dumps(read))
+''' % os.path.dirname(os.path.abspath(__file__))
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        support.getMemcache()
+        import ClientGAE
+        self.DiskCache = ClientGAE.DiskCache
+        self.directory = tempfile.mkdtemp()
+        self.path      = os.path.join(self.directory, 'cache', 'items.dat')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def runChild(self, *args):
+        '''
+        Run the second process
+        @return dict {key: value,} of the keys it read
+        '''
+        child = subprocess.Popen(
+            [sys.executable, '-c', CHILD, self.path] + list(args),
+            stdout=subprocess.PIPE
+        )
+        out, _ = child.communicate()
+        self.assertEqual(child.returncode, 0)
+        return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+    def testSetGetDelete(self):
+        cache = self.DiskCache(self.path)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', b'1')
+        cache.set(u'\xe9', b'2')
+        cache.setMulti({'b': b'3', 'c': b''})
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get(u'\xe9'), b'2')
+        self.assertEqual(cache.get('b'), b'3')
+        self.assertEqual(cache.get('c'), b'')
+        cache.set('a', b'4')
+        self.assertEqual(cache.get('a'), b'4')
+        cache.delete('b')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(len(cache), 3)
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+
+    def testReopen(self):
+        cache = self.DiskCache(self.path)
+        cache.set('a', b'1')
+        cache.set('a', b'2')
+        cache.set('b', b'3')
+        cache.delete('b')
+        cache = self.DiskCache(self.path)
+        self.assertEqual(cache.get('a'), b'2')
+        self.assertEqual(cache.get('b'), None)
+
+
+    def testExpiry(self):
+        cache = self.DiskCache(self.path, expiry_sec=0.2)
+        cache.set('a', b'1')
+        cache.set('b', b'2', expiry_sec=60)
+        self.assertEqual(cache.get('a'), b'1')
+        time.sleep(0.25)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), b'2')
+        cache.compact()
+        self.assertEqual(len(cache), 1)
+
+
+    def testTornEntry(self):
+        cache = self.DiskCache(self.path)
+        cache.set('a', b'1')
+        # the remains of a writer which died while appending
+        with open(self.path, 'ab') as fp:
+            fp.write(cache.HEADER.pack(cache.MAGIC, 0, 100, time.time() + 60, 0, b'x' * 16))
+        cache = self.DiskCache(self.path)
+        self.assertEqual(cache.get('a'), b'1')
+        cache.set('b', b'2')
+        cache = self.DiskCache(self.path)
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get('b'), b'2')
+
+
+    def testCompaction(self):
+        cache = self.DiskCache(self.path, compact_min_bytes=0)
+        for i in range(100):
+            cache.set('a', b'x' * 100)
+            cache.set('b%d' % i, b'%d' % i)
+        size = os.path.getsize(self.path)
+        cache.compact()
+        self.assertTrue(os.path.getsize(self.path) < size)
+        self.assertEqual(cache.get('a'), b'x' * 100)
+        for i in range(100):
+            self.assertEqual(cache.get('b%d' % i), b'%d' % i)
+
+
+    def testBackgroundCompaction(self):
+        cache = self.DiskCache(self.path, compact_ratio=0.5, compact_min_bytes=4096)
+        for i in range(200):
+            cache.set('a', b'x' * 100)
+        time.sleep(0.2)
+        self.assertTrue(cache.compactions > 0)
+        self.assertEqual(cache.get('a'), b'x' * 100)
+
+
+    def testReadsDuringCompaction(self):
+        cache  = self.DiskCache(self.path, compact_min_bytes=0)
+        values = dict(('k%d' % i, ('v%d' % i).encode('utf-8') * 20) for i in range(200))
+        cache.setMulti(values)
+        errors = []
+        done   = threading.Event()
+
+        def read():
+            while not done.is_set():
+                for key, value in values.items():
+                    cached = cache.get(key)
+                    if cached != value:
+                        errors.append((key, cached))
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        try:
+            for i in range(30):
+                cache.set('garbage', b'x' * 1000)
+                cache.compact()
+        finally:
+            done.set()
+            for reader in readers:
+                reader.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(cache.compactions >= 30)
+
+
+    def testSecondProcess(self):
+        cache = self.DiskCache(self.path, refresh_sec=0)
+        cache.set('a', b'1')
+        # the child reads the items of this process and writes its own
+        self.assertEqual(self.runChild('a', 'b=2', 'b'), {'a': '1', 'b': '2'})
+        self.assertEqual(cache.get('b'), b'2')
+
+        # the file replaced by a compaction of one process is reopened by
+        # the other
+        cache.set('a', b'3')
+        cache.compact()
+        self.assertEqual(self.runChild('a', 'b'), {'a': '3', 'b': '2'})
+        self.runChild('c=4', 'compact')
+        self.assertEqual(cache.get('c'), b'4')
+        self.assertEqual(cache.get('a'), b'3')
+        cache.set('d', b'5')
+        self.assertEqual(self.runChild('c', 'd'), {'c': '4', 'd': '5'})
+
+
+if __name__ == '__main__':
+    unittest.main()
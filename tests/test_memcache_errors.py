@@ -0,0 +1,76 @@
+'''
+A failing memcache does not fail the lookups: the device data fetched from
+the cloud is returned and the other cache tiers are still written.
+
+Run:
+    python -m unittest discover -s tests
+    python tests/test_memcache_errors.py
+'''
+
+import sys, shutil, tempfile, unittest
+
+import support
+
+
+class MemcacheErrorsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.regions   = support.startRegions([0.005])
+        cls.benchmark = support.benchmark.Benchmark(
+            cls.regions, support.getMemcache(), requests=1
+        )
+
+
+    @classmethod
+    def tearDownClass(cls):
+        # restore the Client settings of the tests
+        cls.benchmark.reset()
+        support.stopRegions(cls.regions)
+
+
+    def setUp(self):
+        self.memcache  = sys.modules['google.appengine.api.memcache']
+        self.set_multi = self.memcache.set_multi
+
+        def fail(*args, **kwargs):
+            raise Exception('memcache is down')
+
+        self.memcache.set_multi = fail
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        self.memcache.set_multi = self.set_multi
+        shutil.rmtree(self.directory)
+
+
+    def testGetDeviceDataMulti(self):
+        client  = self.benchmark.reset()
+        results = client.getDeviceDataMulti([
+            {'user_agent': 'Memcache Errors %d' % i} for i in range(3)
+        ])
+        for result in results:
+            self.assertFalse(client.ERROR in result, result)
+            self.assertEqual(result[client.SOURCE], client.SOURCE_CLOUD)
+            self.assertTrue(result[client.PROPERTIES])
+
+
+    def testWriteBehind(self):
+        client = self.benchmark.reset(
+            FILE_CACHE_INDEXED=True, USE_SYSTEM_TEMP_DIR=False,
+            CUSTOM_CACHE_DIR=self.directory
+        )
+        user_agent  = 'Memcache Errors Write Behind'
+        device_data = {client.PROPERTIES: {'model': 'Write Behind'}}
+        key         = client.getMemCacheHashKey(user_agent, '', {})
+        client.writeBehind([
+            ((client.SOURCE_MEMCACHE, key), (user_agent, '', device_data, {})),
+            ((client.SOURCE_FILE_CACHE, key), (user_agent, '', device_data, {})),
+        ])
+        cached = client.getFileCache(user_agent, '', {})
+        self.assertEqual(cached[client.PROPERTIES]['model'], 'Write Behind')
+
+
+if __name__ == '__main__':
+    unittest.main()
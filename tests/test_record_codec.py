@@ -0,0 +1,191 @@
+'''
+RecordCodec, the compact binary cache records, and DeviceProperties, the
+lazy properties decoded from them.
+
+Run:
+    python -m unittest discover -s tests
+    python tests/test_record_codec.py
+'''
+
+import sys, json, pickle, unittest
+
+import support
+
+if sys.version_info[0] == 2:
+    integer_types = (int, long)
+else:
+    integer_types = (int,)
+
+PROPERTIES = {
+    # in the name table
+    'vendor':            u'Samsung',
+    'model':             u'Galaxy S\xe9rie \u2603',
+    'isTablet':          False,
+    'mobileDevice':      True,
+    'displayWidth':      1080,
+    'yearReleased':      2019,
+    'devicePixelRatio':  2.625,
+    'osVersion':         None,
+    # not in the name table
+    'zero':              0,
+    'negative':          -1,
+    'smallNegative':     -64,
+    'bigNegative':       -2 ** 40,
+    'big':               2 ** 63 + 1,
+    'huge':              10 ** 30,
+    'unknown.name':      u'x',
+    u'n\xe4me':          u'\xfcnicode',
+    'empty':             u'',
+    'list':              [1, u'a', None],
+    'dict':              {u'a': [True, 1.5]},
+    'long' * 50:         u'v' * 300,
+}
+
+
+class RecordCodecTest(unittest.TestCase):
+
+    def setUp(self):
+        support.getMemcache()
+        import ClientGAE
+        self.RecordCodec      = ClientGAE.RecordCodec
+        self.DeviceProperties = ClientGAE.DeviceProperties
+        self.codec            = ClientGAE.RecordCodec()
+        self.device_data      = {'properties': PROPERTIES, '_cachedAt': 12.5}
+
+
+    def assertSameProperties(self, properties):
+        self.assertEqual(sorted(properties.keys()), sorted(PROPERTIES.keys()))
+        for name, value in PROPERTIES.items():
+            self.assertEqual(properties[name], value, name)
+            if isinstance(value, bool):
+                self.assertTrue(properties[name] is value, name)
+            elif isinstance(value, integer_types):
+                self.assertTrue(isinstance(properties[name], integer_types), name)
+
+
+    def testRoundTrip(self):
+        record = self.codec.encode(self.device_data)
+        self.assertTrue(self.codec.isEncoded(record))
+        device_data = self.codec.decode(record)
+        self.assertEqual(device_data['_cachedAt'], 12.5)
+        self.assertSameProperties(device_data['properties'])
+
+
+    def testIntegers(self):
+        for value in (0, 1, -1, 63, 64, -64, -65, 127, 128, 2 ** 31, -2 ** 31,
+                      2 ** 64, -2 ** 64 - 1, 10 ** 40):
+            record = self.codec.encode({'properties': {'displayWidth': value}})
+            self.assertEqual(self.codec.decode(record)['properties']['displayWidth'], value)
+            self.assertEqual(self.codec.getProperty(record, 'displayWidth'), value)
+
+
+    def testCompressed(self):
+        codec  = self.RecordCodec(compress=True, compress_min_bytes=16)
+        record = codec.encode(self.device_data)
+        self.assertTrue(len(record) < len(self.codec.encode(self.device_data)))
+        self.assertSameProperties(codec.decode(record)['properties'])
+        self.assertSameProperties(codec.decodeLazy(record)['properties'])
+        self.assertEqual(codec.getProperty(record, 'huge'), 10 ** 30)
+        # any codec reads compressed records
+        self.assertSameProperties(self.codec.decode(record)['properties'])
+
+
+    def testEmpty(self):
+        record = self.codec.encode({})
+        self.assertEqual(self.codec.decode(record), {'properties': {}})
+        self.assertEqual(self.codec.decode(b''), None)
+        self.assertEqual(self.codec.decode(None), None)
+
+
+    def testOlderFormats(self):
+        # dictionaries and JSON written before the records
+        self.assertEqual(self.codec.decode({'properties': {'a': 1}}), {'properties': {'a': 1}})
+        as_json = json.dumps({'properties': {'a': u'\xe9'}})
+        self.assertEqual(self.codec.decode(as_json), {'properties': {'a': u'\xe9'}})
+        self.assertEqual(self.codec.decode(as_json.encode('utf-8')), {'properties': {'a': u'\xe9'}})
+        self.assertEqual(self.codec.getProperty(as_json, 'a'), u'\xe9')
+        lazy = self.codec.decodeLazy(as_json)['properties']
+        self.assertTrue(isinstance(lazy, self.DeviceProperties))
+        self.assertEqual(lazy['a'], u'\xe9')
+
+
+    def testNewerVersion(self):
+        record = bytearray(self.codec.encode(self.device_data))
+        record[len(self.RecordCodec.MAGIC)] = self.RecordCodec.VERSION + 1
+        self.assertRaises(Exception, self.codec.decode, bytes(record))
+
+
+    def testGetProperty(self):
+        record = self.codec.encode(self.device_data)
+        for name, value in PROPERTIES.items():
+            self.assertEqual(self.codec.getProperty(record, name), value, name)
+        self.assertEqual(self.codec.getProperty(record, 'missing'), None)
+        self.assertEqual(self.codec.getProperty(record, 'missing', 'default'), 'default')
+        # a property which is None is not the default
+        self.assertEqual(self.codec.getProperty(record, 'osVersion', 'default'), None)
+
+
+class DevicePropertiesTest(unittest.TestCase):
+
+    def setUp(self):
+        support.getMemcache()
+        import ClientGAE
+        self.codec       = ClientGAE.RecordCodec()
+        self.record      = self.codec.encode({'properties': PROPERTIES, '_cachedAt': 12.5})
+        self.device_data = self.codec.decodeLazy(self.record)
+        self.properties  = self.device_data['properties']
+
+
+    def testLazy(self):
+        self.assertEqual(self.device_data['_cachedAt'], 12.5)
+        self.assertEqual(len(self.properties), len(PROPERTIES))
+        self.assertTrue('huge' in self.properties)
+        self.assertFalse('missing' in self.properties)
+        for name, value in PROPERTIES.items():
+            self.assertEqual(self.properties[name], value, name)
+            self.assertEqual(self.properties.get(name, 'default'), value, name)
+        self.assertEqual(self.properties.get('missing'), None)
+        self.assertEqual(self.properties.get('missing', 'default'), 'default')
+        self.assertRaises(KeyError, lambda: self.properties['missing'])
+        self.assertEqual(self.properties.copy(), PROPERTIES)
+        self.assertEqual(self.properties, PROPERTIES)
+
+
+    def testDecodedOnce(self):
+        calls = []
+        decode = self.codec.decodeValue
+
+        def counting(*args):
+            calls.append(args)
+            return decode(*args)
+
+        self.codec.decodeValue = counting
+        for _ in range(3):
+            self.assertEqual(self.properties['model'], PROPERTIES['model'])
+            self.assertEqual(self.properties['list'], PROPERTIES['list'])
+        self.assertEqual(len(calls), 2)
+        # the properties with overrides share the decoded values
+        self.assertEqual(self.properties.withOverrides({'a': 1})['model'], PROPERTIES['model'])
+        self.assertEqual(len(calls), 2)
+
+
+    def testOverrides(self):
+        properties = self.properties.withOverrides({'vendor': u'Cookie', 'extra': 1})
+        properties = properties.withOverrides({'extra': 2})
+        self.assertEqual(properties['vendor'], u'Cookie')
+        self.assertEqual(properties['extra'], 2)
+        self.assertEqual(properties['model'], PROPERTIES['model'])
+        self.assertEqual(len(properties), len(PROPERTIES) + 1)
+        # the shared properties are not changed
+        self.assertEqual(self.properties['vendor'], PROPERTIES['vendor'])
+        self.assertFalse('extra' in self.properties)
+
+
+    def testPickle(self):
+        properties = pickle.loads(pickle.dumps(self.properties))
+        self.assertTrue(isinstance(properties, dict))
+        self.assertEqual(properties, PROPERTIES)
+
+
+if __name__ == '__main__':
+    unittest.main()
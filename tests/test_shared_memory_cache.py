@@ -0,0 +1,215 @@
+'''
+SharedMemoryCache, the memory mapped hash table shared by processes: items,
+values too large for a slot, the clock eviction and readers racing writers
+(the seqlock).
+
+Run:
+    python -m unittest discover -s tests
+    python tests/test_shared_memory_cache.py
+'''
+
+import os, sys, time, shutil, tempfile, threading, subprocess, unittest
+
+import support
+
+# the script of the writer process, rewrites the key "k" until it is killed
+WRITER = '''
+import sys
+sys.path.insert(0, %r)
+import support
+support.getMemcache()
+import ClientGAE
+cache = ClientGAE.SharedMemoryCache(sys.argv[1])
+sys.stdout.write('ready\\n')
+sys.stdout.flush()
+i = 0
+while True:
+    cache.set('k', (b'%%08d' %% i) * (1 + i %% 200))
+    i += 1
+''' % os.path.dirname(os.path.abspath(__file__))
+
+
+def isConsistent(value):
+    '''
+    @return bool true if the value is one of the values of the writers:
+            its 8 digit number repeated 1 + number % 200 times
+    '''
+    number = int(value[:8])
+    return value == value[:8] * (1 + number % 200)
+
+
+class SharedMemoryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        support.getMemcache()
+        import ClientGAE
+        self.SharedMemoryCache = ClientGAE.SharedMemoryCache
+        self.directory = tempfile.mkdtemp()
+        self.path      = os.path.join(self.directory, 'shm', 'items.dat')
+        self.caches    = []
+
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.directory)
+
+
+    def open(self, **kwargs):
+        cache = self.SharedMemoryCache(self.path, **kwargs)
+        self.caches.append(cache)
+        return cache
+
+
+    def testSetGetDelete(self):
+        cache = self.open(slots=64)
+        self.assertEqual(cache.get('a'), None)
+        self.assertTrue(cache.set('a', b'1'))
+        self.assertTrue(cache.set(u'\xe9', b'2'))
+        self.assertTrue(cache.set('c', b''))
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get(u'\xe9'), b'2')
+        self.assertEqual(cache.get('c'), b'')
+        cache.set('a', b'3')
+        self.assertEqual(cache.get('a'), b'3')
+        self.assertEqual(len(cache), 2)
+        cache.delete('a')
+        cache.delete('missing')
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 1)
+
+
+    def testExpiry(self):
+        cache = self.open(slots=64, expiry_sec=0.2)
+        cache.set('a', b'1')
+        cache.set('b', b'2', expiry_sec=60)
+        time.sleep(0.25)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), b'2')
+
+
+    def testTooLarge(self):
+        cache = self.open(slots=8, slot_bytes=256)
+        self.assertTrue(cache.set('a', b'x' * cache.capacity))
+        self.assertEqual(cache.get('a'), b'x' * cache.capacity)
+        self.assertFalse(cache.set('b', b'x' * (cache.capacity + 1)))
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.rejected, 1)
+        # the cached value of the key is kept
+        self.assertFalse(cache.set('a', b'y' * (cache.capacity + 1)))
+        self.assertEqual(cache.get('a'), b'x' * cache.capacity)
+
+
+    def testGeometry(self):
+        self.open(slots=8, slot_bytes=256, ways=4).set('a', b'1')
+        # an existing file keeps its geometry
+        cache = self.open(slots=1024, slot_bytes=4096, ways=8)
+        self.assertEqual((cache.buckets, cache.ways, cache.slot_bytes), (2, 4, 256))
+        self.assertEqual(cache.get('a'), b'1')
+
+
+    def testClockEviction(self):
+        # one bucket of 4 slots
+        cache = self.open(slots=4, ways=4)
+        for i in range(4):
+            cache.set('k%d' % i, b'%d' % i)
+        self.assertEqual(cache.evictions, 0)
+        # k0 is referenced, the hand passes it and evicts k1
+        self.assertEqual(cache.get('k0'), b'0')
+        cache.set('k4', b'4')
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.get('k1'), None)
+        for i in (0, 2, 3, 4):
+            self.assertEqual(cache.get('k%d' % i), b'%d' % i)
+        # all referenced, a full turn of the hand clears them and evicts k2
+        cache.set('k5', b'5')
+        self.assertEqual(cache.get('k2'), None)
+        self.assertEqual(len(cache), 4)
+
+
+    def testExpiredSlotsFirst(self):
+        cache = self.open(slots=4, ways=4)
+        for i in range(4):
+            cache.set('k%d' % i, b'%d' % i, expiry_sec=60 if i != 2 else -1)
+        cache.set('k4', b'4')
+        self.assertEqual(cache.evictions, 0)
+        for i in (0, 1, 3, 4):
+            self.assertEqual(cache.get('k%d' % i), b'%d' % i)
+
+
+    def testSlotBeingWritten(self):
+        # one slot, right after the file header and the bucket header
+        cache = self.open(slots=1, ways=1)
+        cache.set('a', b'1')
+        offset = cache.HEADER.size + cache.BUCKET_HEADER
+        with open(self.path, 'r+b') as fp:
+            fp.seek(offset)
+            sequence = cache.SEQUENCE.unpack(fp.read(cache.SEQUENCE.size))[0]
+            # a writer died or is writing: the odd sequence hides the slot
+            fp.seek(offset)
+            fp.write(cache.SEQUENCE.pack(sequence | 1))
+            fp.flush()
+            self.assertEqual(cache.get('a'), None)
+            fp.seek(offset)
+            fp.write(cache.SEQUENCE.pack(sequence + 2))
+            fp.flush()
+        self.assertEqual(cache.get('a'), b'1')
+
+
+    def testConcurrentThreads(self):
+        # one slot rewritten by two threads while two threads read it
+        cache  = self.open(slots=1, ways=1)
+        errors = []
+        done   = threading.Event()
+
+        def write(first):
+            i = first
+            while not done.is_set():
+                cache.set('k', (b'%08d' % i) * (1 + i % 200))
+                i += 2
+
+        def read():
+            while not done.is_set():
+                value = cache.get('k')
+                if value is not None and not isConsistent(value):
+                    errors.append(value[:16])
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(2)] + \
+                  [threading.Thread(target=read) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        time.sleep(1)
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+    def testConcurrentProcess(self):
+        # the writer runs in parallel, the reads race its writes
+        cache  = self.open(slots=1, ways=1)
+        writer = subprocess.Popen(
+            [sys.executable, '-c', WRITER, self.path], stdout=subprocess.PIPE
+        )
+        try:
+            writer.stdout.readline()
+            hits   = 0
+            errors = []
+            until  = time.time() + 1.5
+            while time.time() < until:
+                value = cache.get('k')
+                if value is None:
+                    continue
+                hits += 1
+                if not isConsistent(value):
+                    errors.append(value[:16])
+        finally:
+            writer.kill()
+            writer.wait()
+        # without the sequence checks of get() torn values show up here
+        self.assertEqual(errors, [])
+        self.assertTrue(hits > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+'''
+The objects shared by the Client objects (the in-process cache, the circuit
+breaker, the latency estimates...) are kept by each Client class, a subclass
+which changes their settings gets its own whatever class is used first.
+
+Run:
+    python -m unittest discover -s tests
+    python tests/test_shared_objects.py
+'''
+
+import unittest
+
+import support
+
+
+class SharedObjectsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.benchmark = support.benchmark.Benchmark([], support.getMemcache(), requests=1)
+
+
+    @classmethod
+    def tearDownClass(cls):
+        # restore the Client settings of the tests
+        cls.benchmark.reset()
+
+
+    def setUp(self):
+        self.client = self.benchmark.reset()
+        Client      = self.client.__class__
+
+        class SmallClient(Client):
+            LOCAL_CACHE_MAX_ITEMS    = 10
+            SERVER_PHASEOUT_LIFETIME = 1
+
+        self.Client      = Client
+        self.SmallClient = SmallClient
+
+
+    def testSubclassSettings(self):
+        # the parent class creates its objects first
+        cache   = self.client.getLocalCache()
+        breaker = self.client.getCircuitBreaker()
+        small   = self.SmallClient()
+        self.assertEqual(small.getLocalCache().max_items, 10)
+        self.assertEqual(small.getCircuitBreaker().phaseout_sec, 60)
+        self.assertEqual(cache.max_items, self.Client.LOCAL_CACHE_MAX_ITEMS)
+        self.assertEqual(breaker.phaseout_sec, self.Client.SERVER_PHASEOUT_LIFETIME * 60)
+        self.assertTrue(self.client.getLocalCache() is cache)
+        self.assertTrue(self.client.getCircuitBreaker() is breaker)
+
+
+    def testSubclassFirst(self):
+        cache = self.SmallClient().getLocalCache()
+        self.assertEqual(cache.max_items, 10)
+        self.assertEqual(self.client.getLocalCache().max_items, self.Client.LOCAL_CACHE_MAX_ITEMS)
+
+
+    def testShared(self):
+        for get in ('getLocalCache', 'getCircuitBreaker', 'getLatencyTracker',
+                    'getConnectionPool', 'getSingleFlight', 'getRecordCodec',
+                    'getUserAgentCanonicalizer'):
+            self.assertTrue(getattr(self.Client(), get)() is getattr(self.client, get)(), get)
+            self.assertTrue(
+                getattr(self.SmallClient(), get)() is getattr(self.SmallClient(), get)(), get
+            )
+        # the objects are reset by setting the attribute of the class
+        cache = self.client.getLocalCache()
+        self.Client.localCache = None
+        self.assertFalse(self.client.getLocalCache() is cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+'''
+Concurrent lookups sharing one Client object must each get the result of
+their own request. Runs the "stress" scenario of benchmark.py and fails on
+any lookup error or mixed up result.
+
+Run:
+    python -m unittest discover -s tests
+    python tests/test_stress.py
+'''
+
+import unittest
+
+import support
+
+
+class StressTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.regions   = support.startRegions([0.005, 0.015, 0.03])
+        cls.benchmark = support.benchmark.Benchmark(
+            cls.regions, support.getMemcache(), requests=100, corpus_size=200
+        )
+
+
+    @classmethod
+    def tearDownClass(cls):
+        # restore the Client settings of the tests
+        cls.benchmark.reset()
+        support.stopRegions(cls.regions)
+
+
+    def assertNoErrors(self, report):
+        errors = self.benchmark.errors
+        self.assertEqual(report['errors'], 0, '%d lookups failed or were mixed up:\n%s' % (
+            len(errors), '\n'.join(errors[:10])
+        ))
+
+
+    def testStress(self):
+        report = self.benchmark.scenarioStress(threads=32, lookups=2000)
+        self.assertEqual(report['requests'], 2000)
+        self.assertNoErrors(report)
+
+
+if __name__ == '__main__':
+    unittest.main()